@@ -2,17 +2,35 @@
 # -*- coding: utf-8 -*-
 
 from abc import ABCMeta, abstractmethod
-import json
 import datetime
 import logging
-import hashlib
 import uuid
+import os
+import selectors
+import signal
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from functools import partial
 from optparse import OptionParser
 from http.server import HTTPServer, BaseHTTPRequestHandler
 from collections import namedtuple
 import re
-from scoring import get_interests, get_score
-from store import Store
+import codec
+import metrics
+import scoring
+from scoring import get_interests_many, get_score, score_flight
+from store import PrefixRouterStore, Store, StorePool, probe_store
+from memstore import MemoryStore
+from sqlitestore import SQLiteStore
+from cache import LRUCache, L1CachedStore, CacheWriteQueue, WriteBehindStore, BatchStore, Revalidator
+from auth import Authenticator
+from breaker import STATE_VALUES, CircuitBreaker
+from expiry import ExpirySweeper
+from logs import BackgroundLogging, RequestLogger
+from profiling import Profiler
 
 SALT = "Otus"
 ADMIN_LOGIN = "admin"
@@ -39,7 +57,11 @@ GENDERS = {
     FEMALE: "female",
 }
 MAX_YEARS_FOR_BIRTHDAY = 70
+MAX_BATCH_SIZE = 1000
+BATCH_THREADS = 8
+KEEPALIVE_TIMEOUT = 5
 validation_res = namedtuple("validation_res", ["is_valid", "reason"])
+VALID = validation_res(True, "")
 
 
 # ====Fields====
@@ -214,11 +236,52 @@ class ClientIDsField(Field):
 
 # ====Request classes====
 
+def compile_validator(fields):
+    """
+    Return function validating fields of a request class, same result as Field.validate for each field.
+    Checks of every field are inlined into generated code, reasons are built only for invalid fields
+    """
+
+    namespace = {"FieldValidationError": FieldValidationError, "validation_res": validation_res, "VALID": VALID}
+    lines = ["def validate_fields(self):",
+             "    reasons = []"]
+    for i, (name, field) in enumerate(fields.items()):
+        namespace[f"field_{i}"] = field
+        namespace[f"required_{i}"] = f"field '{field.label}' is required"
+        namespace[f"empty_{i}"] = f"field '{field.label}' is empty"
+        namespace[f"invalid_{i}"] = f"field '{field.label}', invalid value: "
+        check = ["try:",
+                 f"    field_{i}.check_valid_value(value)",
+                 "except FieldValidationError as e:",
+                 f"    reasons.append(invalid_{i} + str(value) + ' (' + str(e) + ')')"]
+        if not field.nullable:
+            check = [f"if not field_{i}.is_not_empty_value(value):",
+                     f"    reasons.append(empty_{i})",
+                     "else:"] + ["    " + line for line in check]
+
+        lines.append(f"    value = self.{field.name}")
+        if field.required:
+            lines += ["    if value is None:",
+                      f"        reasons.append(required_{i})",
+                      "    else:"]
+        else:
+            lines.append("    if value is not None:")
+        lines += ["        " + line for line in check]
+
+    lines += ["    if reasons:",
+              "        return validation_res(False, 'Invalid fields: ' + ','.join(reasons))",
+              "    return VALID"]
+    exec("\n".join(lines), namespace)
+    return namespace["validate_fields"]
+
+
 class MetaRequest(type):
     """
     Metaclass for request
     Add all declared fields objects to declared_fields class attribute and
-    declared fields names to fields_name class attribute
+    declared fields names to fields_name class attribute.
+    Store fields values in __slots__, so requests have fixed layout and no instance dict.
+    Generate validate_fields method checking declared fields
     """
 
     def __new__(mcs, name, bases, dct):
@@ -227,9 +290,12 @@ class MetaRequest(type):
             if isinstance(v, Field):
                 current_fields.append((k, v))
         fields = dict(current_fields)
+        dct["__slots__"] = tuple(dct.get("__slots__", ())) + tuple("_" + k for k in fields)
         new_class = super().__new__(mcs, name, bases, dct)
         new_class.declared_fields = fields
         new_class.fields_name = fields.keys()
+        new_class.fields_slots = tuple((k, v.name) for k, v in fields.items())
+        new_class.validate_fields = compile_validator(fields)
         return new_class
 
 
@@ -238,25 +304,35 @@ class Request(metaclass=MetaRequest):
     Base class for request
     """
 
+    __slots__ = ("request",)
+
+    def __init__(self, attrs=None, request=None):
+        self.set_attributes(attrs or {})
+        self.request = request
+
     @classmethod
     def from_request(cls, attrs, request=None):
         """return Request instance with seted attributes"""
-        obj = cls()
-        obj.set_attributes(attrs)
-        obj.request = request
-        return obj
+        return cls(attrs, request)
 
     def set_attributes(self, attrs):
-        """set fields values"""
-        for k, v in attrs.items():
-            if k in self.fields_name:
-                setattr(self, k, v)
+        """set fields values, fields absent in attrs are set to None"""
+        for name, slot in self.fields_slots:
+            setattr(self, slot, attrs.get(name))
 
     def validate(self):
         """
         validate fields values. In child may also have additional checks
         """
 
+        return self.validate_fields()
+
+    def validate_fields_generic(self):
+        """
+        validate fields values with Field.validate of each field
+        Reference implementation of generated validate_fields
+        """
+
         invalid_fields = []
         invalid_reasons = []
         for field_name, field in self.declared_fields.items():
@@ -320,44 +396,50 @@ class OnlineScoreRequest(Request):
         return res
 
 
+authenticator = Authenticator(SALT, ADMIN_SALT)
+metrics.CounterFunc("auth_checks_total", "Request token checks", lambda: authenticator.checks)
+metrics.CounterFunc("auth_hashes_total", "Token digests computed by token checks", lambda: authenticator.hashes)
+metrics.CounterFunc("auth_hashes_saved_total", "Token checks answered without computing a digest",
+                    lambda: authenticator.checks - authenticator.hashes)
+metrics.Gauge("auth_cached_digests", "Verified user digests kept in memory", lambda: len(authenticator.digests))
+# set by make_server when profiling is on
+profiler = None
+
+
 def check_auth(request):
-    if request.is_admin:
-        digest = hashlib.sha512((datetime.datetime.now().strftime("%Y%m%d%H") + ADMIN_SALT).encode("utf8")).hexdigest()
-    else:
-        digest = hashlib.sha512((request.account + request.login + SALT).encode("utf8")).hexdigest()
-    if digest == request.token:
-        return True
-    return False
+    return authenticator.check(request)
 
 
-def process_method_request(request, ctx, store):
-    methods_cls = {
-        "clients_interests": ClientsInterestsRequest,
-        "online_score": OnlineScoreRequest
-    }
+METHOD_REQUESTS = {
+    "clients_interests": ClientsInterestsRequest,
+    "online_score": OnlineScoreRequest
+}
+
+
+def get_method_request(request):
+    """return sub request for request.method and its validation result"""
+    method = request.method
+    if method not in METHOD_REQUESTS:
+        raise NotImplementedError(f"Method {method} not implemented")
+
+    sub_request = METHOD_REQUESTS[method].from_request(request.arguments, request)
+    return sub_request, sub_request.validate()
 
+
+def process_method_request(request, ctx, store):
     methods_process = {
         "clients_interests": process_clients_interests_request,
         "online_score": process_online_score_interests_request
     }
 
-    method = request.method
-    if method not in methods_cls:
-        raise NotImplementedError(f"Method {method} not implemented")
-
-    sub_cls = methods_cls[method]
-    sub_request = sub_cls.from_request(request.arguments, request)
-    sub_process = methods_process[method]
-    validation = sub_request.validate()
+    sub_request, validation = get_method_request(request)
     if not validation.is_valid:
         return validation.reason, INVALID_REQUEST
-    return sub_process(sub_request, ctx, store)
+    return methods_process[request.method](sub_request, ctx, store)
 
 
 def process_clients_interests_request(request, ctx, store):
-    res = {}
-    for id in request.client_ids:
-        res[id] = get_interests(store, id)
+    res = get_interests_many(store, request.client_ids)
 
     ctx["nclients"] = len(request.client_ids)
     return res, OK
@@ -374,7 +456,19 @@ def process_online_score_interests_request(request, ctx, store):
 
 
 def method_handler(request, ctx, store):
+    start = time.perf_counter()
     method_request = MethodRequest.from_request(request["body"])
+    response, code = handle_method_request(method_request, request["headers"], ctx, store)
+    # method is user input, keep label values bounded
+    method = method_request.method
+    if not isinstance(method, str) or method not in METHOD_REQUESTS:
+        method = "unknown"
+    metrics.METHOD_LATENCY.observe(time.perf_counter() - start, method)
+    metrics.METHOD_REQUESTS.inc(method, code)
+    return response, code
+
+
+def handle_method_request(method_request, headers, ctx, store):
     validation = method_request.validate()
     if not validation.is_valid:
         return validation.reason, INVALID_REQUEST
@@ -382,31 +476,145 @@ def method_handler(request, ctx, store):
     if not check_auth(method_request):
         return ERRORS[FORBIDDEN], FORBIDDEN
 
+    if profiler is not None and profiler.wanted(method_request, headers):
+        return profiler.run(ctx.get("request_id"), method_request.method, process_method_request, method_request,
+                            ctx, store)
     return process_method_request(method_request, ctx, store)
 
 
+def make_response(response, code):
+    """return response body for handler result"""
+    if code not in ERRORS:
+        return {"response": response, "code": code}
+    return {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
+
+
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_THREADS, thread_name_prefix="batch")
+
+
+def process_batch_item(item, headers, store):
+    ctx = {}
+    if not isinstance(item, dict):
+        return make_response("method request must be an object", INVALID_REQUEST)
+    try:
+        response, code = method_handler({"body": item, "headers": headers}, ctx, store)
+    except Exception as e:
+        logging.exception("Unexpected error: %s" % e)
+        response, code = None, INTERNAL_ERROR
+    return make_response(response, code)
+
+
+def batch_handler(request, ctx, store):
+    """
+    Process list of method requests, each one validated and authorized as by method_handler
+    Items are processed concurrently and share store lookups
+    """
+
+    items = request["body"]
+    if not isinstance(items, list):
+        return "batch must be a list of method requests", INVALID_REQUEST
+    if len(items) > MAX_BATCH_SIZE:
+        return f"batch must have at most {MAX_BATCH_SIZE} method requests", INVALID_REQUEST
+
+    batch_store = BatchStore(store)
+    results = batch_executor.map(lambda item: process_batch_item(item, request["headers"], batch_store), items)
+    ctx["nitems"] = len(items)
+    return list(results), OK
+
+
 class MainHTTPHandler(BaseHTTPRequestHandler):
+    """
+    HTTP/1.1 handler, connections are kept alive for server.keepalive_timeout seconds
+    and at most server.max_keepalive_requests requests. Pipelined requests are answered in order.
+    If the server parks idle connections, a connection waiting for its next request is handed
+    back to the server instead of holding the serving thread
+    """
+
+    protocol_version = "HTTP/1.1"
+    # buffer response, it is flushed after each request with one write
+    wbufsize = -1
     router = {
-        "method": method_handler
+        "method": method_handler,
+        "batch": batch_handler,
+    }
+    get_router = {
+        "metrics": metrics.REGISTRY.render,
     }
-    store = Store()
+
+    @property
+    def store(self):
+        return self.server.store
+
+    def setup(self):
+        self.timeout = self.server.keepalive_timeout or None
+        super().setup()
+        self.requests_served = 0
+        self.parked = False
+
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            if self.server.park_idle_connections and not self.has_pending_data():
+                self.parked = True
+                return
+            self.handle_one_request()
+
+    def resume(self):
+        """handle requests of parked connection which has data to read"""
+        self.parked = False
+        try:
+            self.handle()
+        finally:
+            self.finish()
+
+    def finish(self):
+        if not self.parked:
+            super().finish()
+
+    def has_pending_data(self):
+        """return True if next request is already received, without waiting for it"""
+        self.connection.settimeout(0)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            # let handle_one_request see the error
+            return True
+        finally:
+            self.connection.settimeout(self.timeout)
 
     def get_request_id(self, headers):
         return headers.get('HTTP_X_REQUEST_ID', uuid.uuid4().hex)
 
+    def keep_alive(self):
+        """return True if connection may serve one more request"""
+        self.requests_served += 1
+        return (bool(self.server.keepalive_timeout) and not self.close_connection and
+                self.requests_served < self.server.max_keepalive_requests)
+
     def do_POST(self):
+        start = time.monotonic()
         response, code = {}, OK
         context = {"request_id": self.get_request_id(self.headers)}
         request = None
+        data_string = b""
         try:
-            data_string = self.rfile.read(int(self.headers['Content-Length']))
-            request = json.loads(data_string)
-        except:
+            length = int(self.headers['Content-Length'])
+        except (TypeError, ValueError):
+            length = -1
+        if length < 0:
+            # next request can't be found without body length
+            self.close_connection = True
             code = BAD_REQUEST
+        else:
+            try:
+                data_string = self.rfile.read(length)
+                request = codec.loads(data_string)
+            except:
+                code = BAD_REQUEST
 
         if request:
             path = self.path.strip("/")
-            logging.info("%s: %s %s" % (self.path, data_string, context["request_id"]))
             if path in self.router:
                 try:
                     response, code = self.router[path]({"body": request, "headers": self.headers}, context, self.store)
@@ -416,31 +624,538 @@ class MainHTTPHandler(BaseHTTPRequestHandler):
             else:
                 code = NOT_FOUND
 
+        r = make_response(response, code)
+        context.update(r)
+        body = codec.dumps(r)
+        method = request.get("method") if isinstance(request, dict) else None
+        self.server.request_logger.log(self.path, method, data_string, context, len(body), time.monotonic() - start)
+        self.send_body(code, body, "application/json")
+
+    def do_GET(self):
+        path = self.path.strip("/")
+        if path in self.get_router:
+            code, body, content_type = OK, self.get_router[path]().encode("utf8"), metrics.CONTENT_TYPE
+        else:
+            code, body, content_type = NOT_FOUND, codec.dumps(make_response(None, NOT_FOUND)), "application/json"
+        self.send_body(code, body, content_type)
+
+    def log_message(self, format, *args):
+        # through logging instead of writing to stderr, so --log-async keeps it off the request path
+        logging.info("%s - %s", self.address_string(), format % args)
+
+    def send_body(self, code, body, content_type):
+        metrics.HTTP_RESPONSES.inc(code)
         self.send_response(code)
-        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Connection", "keep-alive" if self.keep_alive() else "close")
         self.end_headers()
-        if code not in ERRORS:
-            r = {"response": response, "code": code}
-        else:
-            r = {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
-        context.update(r)
-        logging.info(context)
-        self.wfile.write(json.dumps(r).encode("utf8"))
-        return
+        self.wfile.write(body)
 
 
-if __name__ == "__main__":
-    op = OptionParser()
-    op.add_option("-p", "--port", action="store", type=int, default=8080)
-    op.add_option("-l", "--log", action="store", default=None)
-    (opts, args) = op.parse_args()
-    logging.basicConfig(filename=opts.log, level=logging.INFO,
-                        format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
-    server = HTTPServer(("localhost", opts.port), MainHTTPHandler)
-    logging.info("Starting server at %s" % opts.port)
+class ScoringHTTPServer(HTTPServer):
+    """
+    HTTP server which gives each serving thread its own Store connection
+    """
+
+    def __init__(self, server_address, handler_cls, store_factory=Store, reuse_port=False, keepalive_timeout=0,
+                 max_keepalive_requests=100):
+        self.store_factory = store_factory
+        self.reuse_port = reuse_port
+        self.keepalive_timeout = keepalive_timeout
+        self.max_keepalive_requests = max_keepalive_requests
+        self.request_logger = RequestLogger()
+        self.local = threading.local()
+        super().__init__(server_address, handler_cls)
+
+    # serving threads hand idle keep-alive connections back to the server
+    park_idle_connections = False
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    @property
+    def store(self):
+        """store of the current thread, created on first use"""
+        store = getattr(self.local, "store", None)
+        if store is None:
+            store = self.local.store = self.store_factory()
+        return store
+
+
+class ThreadPoolMixIn:
+    """
+    Handle requests in a fixed pool of threads
+    Thread count is bounded, so is the number of Store connections.
+    Idle keep-alive connections do not hold a thread: they are parked in a selector watched
+    by one thread and go back to the pool when the next request arrives,
+    connections idle longer than keepalive_timeout are closed
+    """
+
+    park_idle_connections = True
+
+    def __init__(self, *args, threads=4, **kwargs):
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.selector = selectors.DefaultSelector()
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ)
+        self.park_lock = threading.Lock()
+        # handlers to be parked by the keep-alive thread
+        self.parking = []
+        self.parking_closed = False
+        # handler -> time to close idle connection
+        self.parked = {}
+        super().__init__(*args, **kwargs)
+        self.keepalive_thread = threading.Thread(target=self.run_keepalive, name="keepalive", daemon=True)
+        self.keepalive_thread.start()
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def finish_request(self, request, client_address):
+        return self.RequestHandlerClass(request, client_address, self)
+
+    def process_request_thread(self, request, client_address):
+        handler = None
+        try:
+            handler = self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        self.park_or_shutdown(handler, request)
+
+    def resume_request_thread(self, handler):
+        try:
+            handler.resume()
+        except Exception:
+            handler.parked = False
+            self.handle_error(handler.request, handler.client_address)
+        self.park_or_shutdown(handler, handler.request)
+
+    def park_or_shutdown(self, handler, request):
+        if getattr(handler, "parked", False):
+            with self.park_lock:
+                if not self.parking_closed:
+                    self.parking.append(handler)
+                    self.wakeup_w.send(b"\0")
+                    return
+            self.close_parked(handler)
+            return
+        self.shutdown_request(request)
+
+    def close_parked(self, handler):
+        handler.parked = False
+        handler.finish()
+        self.shutdown_request(handler.request)
+
+    def run_keepalive(self):
+        while True:
+            deadline = min(self.parked.values(), default=None)
+            events = self.selector.select(None if deadline is None else max(0, deadline - time.monotonic()))
+            for key, _ in events:
+                if key.fileobj is self.wakeup_r:
+                    try:
+                        self.wakeup_r.recv(4096)
+                    except BlockingIOError:
+                        pass
+                    continue
+                handler = key.data
+                self.selector.unregister(key.fileobj)
+                del self.parked[handler]
+                self.executor.submit(self.resume_request_thread, handler)
+            with self.park_lock:
+                parking, self.parking = self.parking, []
+                closed = self.parking_closed
+            if closed:
+                for handler in list(self.parked) + parking:
+                    self.close_parked(handler)
+                return
+            now = time.monotonic()
+            for handler in parking:
+                self.selector.register(handler.connection, selectors.EVENT_READ, handler)
+                self.parked[handler] = now + self.keepalive_timeout
+            for handler, close_at in list(self.parked.items()):
+                if close_at <= now:
+                    self.selector.unregister(handler.connection)
+                    del self.parked[handler]
+                    self.close_parked(handler)
+
+    def server_close(self):
+        super().server_close()
+        with self.park_lock:
+            self.parking_closed = True
+            self.wakeup_w.send(b"\0")
+        self.keepalive_thread.join()
+        self.executor.shutdown(wait=True)
+        self.selector.close()
+        self.wakeup_r.close()
+        self.wakeup_w.close()
+
+
+class ThreadPoolHTTPServer(ThreadPoolMixIn, ScoringHTTPServer):
+    pass
 
+
+class StoreFactory:
+    """
+    Creates the store of one serving thread from command line options
+    Layers shared by all threads of a worker (in-process cache, connection pool, write queue)
+    are created on the first call, so in pre-forked mode each worker process gets its own
+    """
+
+    def __init__(self, opts, store_cls=Store):
+        self.opts = opts
+        self.store_cls = store_cls
+        self.lock = threading.Lock()
+        self.initialized = False
+        self.l1_cache = None
+        self.write_queue = None
+        self.pool = None
+        self.shared_store = None
+        self.memory_store = None
+        self.interests_store = None
+        self.breaker = None
+
+    def init_shared(self):
+        opts = self.opts
+        if opts.store == "tarantool" and opts.breaker_threshold > 0 and self.store_cls is Store:
+            self.breaker = CircuitBreaker(probe_store, opts.breaker_threshold, opts.breaker_backoff,
+                                          opts.breaker_max_backoff)
+            self.store_cls = partial(Store, breaker=self.breaker)
+        if opts.interests_db:
+            self.interests_store = SQLiteStore(opts.interests_db)
+        if opts.store == "memory":
+            self.memory_store = MemoryStore(opts.memory_max_entries, opts.memory_sweep_interval)
+            self.store_cls = lambda: self.memory_store
+        if opts.l1_size > 0:
+            self.l1_cache = LRUCache(opts.l1_size)
+        if opts.pool_max > 0:
+            self.pool = StorePool(opts.pool_min, opts.pool_max, opts.pool_timeout, store_factory=self.store_cls)
+        if opts.write_behind:
+            self.write_queue = CacheWriteQueue(self.pool or self.store_cls(), opts.write_queue_size, opts.write_batch_size,
+                                               opts.write_flush_interval)
+        if self.pool is not None:
+            self.shared_store = self.with_layers(self.pool)
+
+    def with_layers(self, store):
+        if self.write_queue is not None:
+            store = WriteBehindStore(store, self.write_queue)
+        if self.l1_cache is not None:
+            store = L1CachedStore(store, self.l1_cache, self.opts.l1_ttl)
+        if self.interests_store is not None:
+            store = PrefixRouterStore(store, {"i:": self.interests_store})
+        return store
+
+    def __call__(self):
+        with self.lock:
+            if not self.initialized:
+                self.init_shared()
+                self.initialized = True
+        if self.shared_store is not None:
+            return self.shared_store
+        return self.with_layers(self.store_cls())
+
+    def close(self):
+        """flush pending writes and close shared connections"""
+        if self.write_queue is not None:
+            self.write_queue.close()
+        if self.pool is not None:
+            self.pool.close()
+        if self.memory_store is not None:
+            self.memory_store.close()
+        if self.interests_store is not None:
+            self.interests_store.close()
+        if self.breaker is not None:
+            self.breaker.close()
+
+
+# StoreFactory of the running server, set by make_server, stats of its shared layers are exported as metrics
+serving_store_factory = None
+
+
+def get_layer_stat(layer, name):
+    """return function reading stats()[name] of a shared layer of the serving store factory, 0 if it is off"""
+
+    def func():
+        component = getattr(serving_store_factory, layer, None)
+        return component.stats()[name] if component is not None else 0
+
+    return func
+
+
+metrics.Gauge("cache_write_queue_pending", "Cache writes waiting to be flushed",
+              get_layer_stat("write_queue", "pending"))
+metrics.CounterFunc("cache_writes_queued_total", "Cache writes queued for flush",
+                    get_layer_stat("write_queue", "queued"))
+metrics.CounterFunc("cache_writes_coalesced_total", "Cache writes replaced by a later write of the same key",
+                    get_layer_stat("write_queue", "coalesced"))
+metrics.CounterFunc("cache_writes_dropped_total", "Cache writes dropped because the write queue was full",
+                    get_layer_stat("write_queue", "dropped"))
+metrics.CounterFunc("cache_writes_flushed_total", "Cache writes saved to the store",
+                    get_layer_stat("write_queue", "flushed"))
+metrics.CounterFunc("cache_writes_failed_total", "Cache writes the store failed to save",
+                    get_layer_stat("write_queue", "failed"))
+metrics.Gauge("l1_cache_size", "Entries of in-process scoring cache", get_layer_stat("l1_cache", "size"))
+metrics.CounterFunc("l1_cache_hits_total", "In-process scoring cache lookups served from memory",
+                    get_layer_stat("l1_cache", "hits"))
+metrics.CounterFunc("l1_cache_misses_total", "In-process scoring cache lookups passed to the store",
+                    get_layer_stat("l1_cache", "misses"))
+metrics.CounterFunc("l1_cache_expired_total", "In-process scoring cache entries removed on expiry",
+                    get_layer_stat("l1_cache", "expired"))
+metrics.CounterFunc("l1_cache_evicted_total", "In-process scoring cache entries evicted when full",
+                    get_layer_stat("l1_cache", "evicted"))
+metrics.Gauge("store_pool_size", "Open store connections of the pool", get_layer_stat("pool", "size"))
+metrics.Gauge("store_pool_in_use", "Store connections checked out of the pool", get_layer_stat("pool", "in_use"))
+metrics.CounterFunc("store_pool_checkouts_total", "Store connection checkouts",
+                    get_layer_stat("pool", "checkouts"))
+metrics.CounterFunc("store_pool_waits_total", "Store connection checkouts which waited for a free connection",
+                    get_layer_stat("pool", "waits"))
+metrics.CounterFunc("store_pool_timeouts_total", "Store connection checkouts which timed out",
+                    get_layer_stat("pool", "timeouts"))
+metrics.CounterFunc("store_pool_health_check_failures_total", "Idle store connections which failed a ping",
+                    get_layer_stat("pool", "health_check_failures"))
+
+
+
+def get_breaker_state():
+    breaker = getattr(serving_store_factory, "breaker", None)
+    return STATE_VALUES[breaker.state] if breaker is not None else 0
+
+
+metrics.Gauge("store_breaker_state", "Store circuit breaker state, 0 - closed, 1 - half open, 2 - open",
+              get_breaker_state)
+metrics.Gauge("store_breaker_failures", "Consecutive store call failures counted by the circuit breaker",
+              get_layer_stat("breaker", "failures"))
+metrics.CounterFunc("store_breaker_rejected_total", "Store calls failed fast by the open circuit breaker",
+                    get_layer_stat("breaker", "rejected"))
+metrics.CounterFunc("store_breaker_probes_total", "Store probes made while the circuit breaker is open",
+                    get_layer_stat("breaker", "probes"))
+
+
+def parse_rates(values, key_type=str):
+    """parse list of 'key=rate' options"""
+    rates = {}
+    for value in values or []:
+        key, _, rate = value.partition("=")
+        rates[key_type(key)] = float(rate)
+    return rates
+
+
+def make_server(opts, store_factory):
+    """return server configured by command line options"""
+    address = ("localhost", opts.port)
+    reuse_port = opts.workers > 1
+    keepalive_timeout = opts.keepalive_timeout
+    if keepalive_timeout is None:
+        # an idle connection would block single threaded server
+        keepalive_timeout = KEEPALIVE_TIMEOUT if opts.threads > 0 else 0
+    args = (address, MainHTTPHandler, store_factory, reuse_port, keepalive_timeout, opts.max_keepalive_requests)
+    if opts.threads > 0:
+        server = ThreadPoolHTTPServer(*args, threads=opts.threads)
+    else:
+        server = ScoringHTTPServer(*args)
+    server.request_logger = RequestLogger(opts.log_async, opts.log_sample, parse_rates(opts.log_sample_method),
+                                          parse_rates(opts.log_sample_code, int), opts.log_max_bytes,
+                                          [f for f in opts.log_redact.split(",") if f])
+    global profiler, serving_store_factory
+    serving_store_factory = store_factory
+    if opts.workers > 1:
+        # every worker serves metrics of its own process
+        metrics.REGISTRY.const_labels = (("pid", os.getpid()),)
+    profiler = Profiler(opts.profile_dir, opts.profile_sample) if opts.profile_dir else None
+    score_flight.timeout = opts.score_wait_timeout
+    if opts.score_stale_grace > 0:
+        scoring.revalidator = Revalidator(store_factory, opts.score_stale_grace, opts.score_refresh_threads,
+                                          opts.score_refresh_queue)
+    return server
+
+
+def serve(server):
     try:
         server.serve_forever()
     except KeyboardInterrupt:
         pass
     server.server_close()
+
+
+def get_expiry_sweeper(opts):
+    """return sweeper of expired scoring cache tuples or None if it is off"""
+    if opts.store != "tarantool" or opts.expiry_sweep_interval <= 0:
+        return None
+    return ExpirySweeper(Store(), opts.expiry_sweep_interval, opts.expiry_sweep_batch, grace=opts.score_stale_grace)
+
+
+def run(opts, store_factory, sweeper=None):
+    """serve in the current process until interrupted"""
+    # cleanup steps run in reverse order, each one even if a previous one fails
+    with ExitStack() as cleanup:
+        if opts.log_async:
+            background_logging = BackgroundLogging(opts.log_queue_size)
+            background_logging.start()
+            cleanup.callback(background_logging.stop)
+        cleanup.callback(store_factory.close)
+        cleanup.callback(close_revalidator)
+        if sweeper is not None:
+            sweeper.start()
+            cleanup.callback(sweeper.close)
+        serve(make_server(opts, store_factory))
+
+
+def close_revalidator():
+    if scoring.revalidator is not None:
+        scoring.revalidator.close()
+
+
+def serve_workers(opts, store_factory, sweeper=None):
+    """
+    Run opts.workers pre-forked processes
+    Each worker binds the same port with SO_REUSEPORT, so the kernel balances connections between them.
+    Sweeper runs once in the parent process, it is started after fork
+    return number of workers exited with an error
+    """
+
+    children = []
+    for _ in range(opts.workers):
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                run(opts, store_factory)
+                status = 0
+            except Exception:
+                logging.exception(f"worker {os.getpid()} failed")
+            finally:
+                os._exit(status)
+        children.append(pid)
+
+    if sweeper is not None:
+        sweeper.start()
+    failed = 0
+    try:
+        while children:
+            failed += wait_worker(children[0])
+            children.pop(0)
+    except KeyboardInterrupt:
+        # process group may be signalled again, e.g. by timeout(1), let children finish
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+        for pid in children:
+            failed += wait_worker(pid)
+    finally:
+        if sweeper is not None:
+            sweeper.close()
+    return failed
+
+
+def wait_worker(pid):
+    """wait for worker process to exit, return 1 if it failed, 0 otherwise"""
+    _, status = os.waitpid(pid, 0)
+    code = os.waitstatus_to_exitcode(status)
+    if code == 0:
+        return 0
+    logging.error(f"worker {pid} exited with status {code}")
+    return 1
+
+
+def get_option_parser():
+    op = OptionParser()
+    op.add_option("-p", "--port", action="store", type=int, default=8080)
+    op.add_option("-l", "--log", action="store", default=None)
+    op.add_option("--log-async", action="store_true", default=False,
+                  help="log compact structured records from a background thread")
+    op.add_option("--log-queue-size", action="store", type=int, default=10000,
+                  help="max log records waiting for the background thread, records over it are dropped")
+    op.add_option("--log-sample", action="store", type=float, default=1.0,
+                  help="share of successful requests logged, errors are always logged")
+    op.add_option("--log-sample-method", action="append", metavar="METHOD=RATE",
+                  help="share of successful requests logged for method, may be repeated")
+    op.add_option("--log-sample-code", action="append", metavar="CODE=RATE",
+                  help="share of requests logged for status code, may be repeated")
+    op.add_option("--log-max-bytes", action="store", type=int, default=0,
+                  help="cut logged request bodies and responses to this size, 0 - no limit")
+    op.add_option("--log-redact", action="store", default="token",
+                  help="comma separated request fields hidden in log")
+    op.add_option("--store", action="store", type="choice", choices=["tarantool", "memory"], default="tarantool",
+                  help="store backend, memory - in-process store of each worker")
+    op.add_option("--memory-max-entries", action="store", type=int, default=100000,
+                  help="max entries of memory store")
+    op.add_option("--memory-sweep-interval", action="store", type=float, default=1.0,
+                  help="seconds between removals of expired entries of memory store")
+    op.add_option("--breaker-threshold", action="store", type=int, default=5,
+                  help="store failures in a row that make requests fail fast until the store is back, "
+                       "0 - retry every call instead")
+    op.add_option("--breaker-backoff", action="store", type=float, default=0.5,
+                  help="seconds before the first reconnection attempt, doubled after each failed one")
+    op.add_option("--breaker-max-backoff", action="store", type=float, default=30,
+                  help="max seconds between reconnection attempts")
+    op.add_option("--expiry-sweep-interval", action="store", type=float, default=60,
+                  help="seconds between deletions of expired scoring cache tuples from tarantool, 0 - never")
+    op.add_option("--expiry-sweep-batch", action="store", type=int, default=1000,
+                  help="tuples walked per round trip of expired tuples deletion")
+    op.add_option("--interests-db", action="store", default=None,
+                  help="serve i: keys from this SQLite file, see sqlitestore.py to import it")
+    op.add_option("-w", "--workers", action="store", type=int, default=1,
+                  help="number of pre-forked worker processes, /metrics shows the worker serving it, "
+                       "labelled with its pid")
+    op.add_option("-t", "--threads", action="store", type=int, default=0,
+                  help="number of serving threads per worker, 0 - serve in the main thread")
+    op.add_option("--l1-size", action="store", type=int, default=0,
+                  help="max entries of in-process scoring cache, 0 - disabled")
+    op.add_option("--l1-ttl", action="store", type=float, default=None,
+                  help="max seconds to serve in-process cached value without asking the store")
+    op.add_option("--pool-max", action="store", type=int, default=0,
+                  help="max store connections shared by serving threads of a worker, 0 - connection per thread")
+    op.add_option("--pool-min", action="store", type=int, default=1,
+                  help="store connections opened at start")
+    op.add_option("--pool-timeout", action="store", type=float, default=5,
+                  help="seconds to wait for a free store connection")
+    op.add_option("--keepalive-timeout", action="store", type=float, default=None,
+                  help=f"seconds to keep idle connection open, 0 - close after each response, "
+                       f"default {KEEPALIVE_TIMEOUT} with --threads, 0 without")
+    op.add_option("--max-keepalive-requests", action="store", type=int, default=100,
+                  help="max requests served by one connection")
+    op.add_option("--write-behind", action="store_true", default=False,
+                  help="queue scoring cache writes and flush them in background")
+    op.add_option("--write-queue-size", action="store", type=int, default=10000,
+                  help="max pending cache writes, writes over it are dropped")
+    op.add_option("--write-batch-size", action="store", type=int, default=100)
+    op.add_option("--write-flush-interval", action="store", type=float, default=0.1,
+                  help="seconds to collect cache writes before flush")
+    op.add_option("--score-wait-timeout", action="store", type=float, default=1.0,
+                  help="seconds to wait for a concurrent computation of the same score before computing it again")
+    op.add_option("--score-stale-grace", action="store", type=float, default=0,
+                  help="seconds after expiry a cached score is still served while it is refreshed in background, "
+                       "0 - expired scores are computed on request")
+    op.add_option("--score-refresh-threads", action="store", type=int, default=2,
+                  help="threads refreshing expired scores in background")
+    op.add_option("--score-refresh-queue", action="store", type=int, default=1000,
+                  help="max scores waiting for background refresh, refreshes over it are skipped")
+    op.add_option("--profile-dir", action="store", default=None,
+                  help="write cProfile stats of profiled requests to this directory, profiling is off if not set")
+    op.add_option("--profile-sample", action="store", type=int, default=0,
+                  help="profile one in N requests at random, 0 - only admin requests with X-Profile header")
+    return op
+
+
+if __name__ == "__main__":
+    op = get_option_parser()
+    (opts, args) = op.parse_args()
+    logging.basicConfig(filename=opts.log, level=logging.INFO,
+                        format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
+    logging.info("Starting server at %s, workers: %s, threads: %s" % (opts.port, opts.workers, opts.threads))
+
+    # stop gracefully on SIGTERM, flushing pending cache writes
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    store_factory = StoreFactory(opts)
+    sweeper = get_expiry_sweeper(opts)
+    if opts.workers > 1:
+        failed = serve_workers(opts, store_factory, sweeper)
+        if failed:
+            logging.error(f"{failed} of {opts.workers} workers failed")
+            raise SystemExit(1)
+    else:
+        run(opts, store_factory, sweeper)
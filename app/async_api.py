@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import logging
+import uuid
+from http import HTTPStatus
+from optparse import OptionParser
+from api import (OK, BAD_REQUEST, FORBIDDEN, NOT_FOUND, INVALID_REQUEST, INTERNAL_ERROR, ERRORS, BirthDayField,
+                 MethodRequest, check_auth, get_method_request, make_response)
+import codec
+from scoring import get_interests_many_async, get_score_async
+from async_store import AsyncStore
+
+MAX_HEADERS = 100
+IDLE_TIMEOUT = 60
+
+
+async def process_method_request(request, ctx, store):
+    methods_process = {
+        "clients_interests": process_clients_interests_request,
+        "online_score": process_online_score_interests_request
+    }
+
+    sub_request, validation = get_method_request(request)
+    if not validation.is_valid:
+        return validation.reason, INVALID_REQUEST
+    return await methods_process[request.method](sub_request, ctx, store)
+
+
+async def process_clients_interests_request(request, ctx, store):
+    res = await get_interests_many_async(store, request.client_ids)
+
+    ctx["nclients"] = len(request.client_ids)
+    return res, OK
+
+
+async def process_online_score_interests_request(request, ctx, store):
+    ctx["has"] = request.filled_fields()
+
+    if request.request.is_admin:
+        return {"score": 42}, OK
+    return {"score": await get_score_async(store, request.phone, request.email,
+                                           BirthDayField.get_date(request.birthday),
+                                           request.gender, request.first_name,
+                                           request.last_name)
+            }, OK
+
+
+async def method_handler(request, ctx, store):
+    method_request = MethodRequest.from_request(request["body"])
+    validation = method_request.validate()
+    if not validation.is_valid:
+        return validation.reason, INVALID_REQUEST
+
+    if not check_auth(method_request):
+        return ERRORS[FORBIDDEN], FORBIDDEN
+
+    return await process_method_request(method_request, ctx, store)
+
+
+class HTTPRequestError(Exception):
+    pass
+
+
+class AsyncHTTPServer:
+    """
+    asyncio HTTP/1.1 front end with the same /method contract as MainHTTPHandler
+    All connections are served on one event loop
+    """
+
+    router = {
+        "method": method_handler
+    }
+
+    def __init__(self, store, idle_timeout=IDLE_TIMEOUT):
+        self.store = store
+        self.idle_timeout = idle_timeout
+
+    @staticmethod
+    def get_request_id(headers):
+        return headers.get("x-request-id", uuid.uuid4().hex)
+
+    async def read_request(self, reader):
+        """return (method, path, version, headers, body) or None if connection closed"""
+        line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+        if not line:
+            return None
+        try:
+            method, path, version = line.decode("latin-1").split()
+        except ValueError:
+            raise HTTPRequestError(f"bad request line {line!r}")
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            if len(headers) >= MAX_HEADERS:
+                raise HTTPRequestError("too many headers")
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        try:
+            length = int(headers.get("content-length", 0))
+        except ValueError:
+            raise HTTPRequestError("bad Content-Length")
+        body = await reader.readexactly(length) if length > 0 else b""
+        return method, path, version, headers, body
+
+    async def handle_request(self, path, headers, body):
+        response, code = {}, OK
+        context = {"request_id": self.get_request_id(headers)}
+        request = None
+        try:
+            request = codec.loads(body)
+        except:
+            code = BAD_REQUEST
+
+        if request:
+            route = path.strip("/")
+            logging.info("%s: %s %s" % (path, body, context["request_id"]))
+            if route in self.router:
+                try:
+                    response, code = await self.router[route]({"body": request, "headers": headers}, context,
+                                                              self.store)
+                except Exception as e:
+                    logging.exception("Unexpected error: %s" % e)
+                    code = INTERNAL_ERROR
+            else:
+                code = NOT_FOUND
+
+        r = make_response(response, code)
+        context.update(r)
+        logging.info(context)
+        return code, codec.dumps(r)
+
+    @staticmethod
+    def write_response(writer, code, body, keep_alive):
+        head = (f"HTTP/1.1 {code} {HTTPStatus(code).phrase}\r\n"
+                f"Content-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+        writer.write(head.encode("latin-1") + body)
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await self.read_request(reader)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except HTTPRequestError as e:
+                    logging.info(f"bad request - {e}")
+                    self.write_response(writer, BAD_REQUEST, b"", False)
+                    break
+                if request is None:
+                    break
+
+                method, path, version, headers, body = request
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                if method == "POST":
+                    code, body = await self.handle_request(path, headers, body)
+                else:
+                    code, body = HTTPStatus.METHOD_NOT_ALLOWED, b""
+                self.write_response(writer, code, body, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-p", "--port", action="store", type=int, default=8080)
+    op.add_option("-l", "--log", action="store", default=None)
+    op.add_option("-c", "--store-connections", action="store", type=int, default=4,
+                  help="number of store connections")
+    (opts, args) = op.parse_args()
+    logging.basicConfig(filename=opts.log, level=logging.INFO,
+                        format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
+    store = AsyncStore(connections=opts.store_connections)
+    logging.info("Starting async server at %s" % opts.port)
+
+    try:
+        asyncio.run(AsyncHTTPServer(store).serve("localhost", opts.port))
+    except KeyboardInterrupt:
+        pass
+    store.close()
@@ -0,0 +1,89 @@
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import tarantool
+from store import Store
+from metrics import STORE_RECONNECTS
+
+
+class AsyncStore:
+    """
+    asyncio counterpart of Store
+    tarantool client has no asyncio API, so network calls run in a small thread pool,
+    each thread with its own connection. The event loop never blocks on the store:
+    a failed call is retried in its executor thread, which reconnects its own connection
+    """
+
+    def __init__(self, host="localhost", port=3301, user=None, password=None, reconnect_n=10, reconnect_delay=1,
+                 timeout=5, connections=4, log=None):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.reconnect_n = reconnect_n
+        self.reconnect_delay = reconnect_delay
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=connections, thread_name_prefix="store")
+        self.local = threading.local()
+        self.log = log or logging
+
+    def get_store(self):
+        """store of the current executor thread"""
+        store = getattr(self.local, "store", None)
+        if store is None:
+            store = self.local.store = Store(self.host, self.port, self.user, self.password,
+                                             reconnect_n=1, reconnect_delay=0, timeout=self.timeout, log=self.log)
+        return store
+
+    async def run(self, method, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, lambda: getattr(self.get_store(), method)(*args))
+
+    async def run_with_retries(self, method, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.call_with_retries, method, *args)
+
+    def call_with_retries(self, method, *args):
+        """
+        call store method in the current executor thread, on network errors reconnect
+        the store of this thread, the one whose call failed, and retry
+        """
+
+        store = self.get_store()
+        attempt = 0
+        while True:
+            try:
+                return getattr(store, method)(*args)
+            except tarantool.error.NetworkError as e:
+                attempt += 1
+                if attempt >= self.reconnect_n:
+                    raise ConnectionError(f"Unable connect to the store - {e}") from e
+                self.reconnect_after_error(store, e, attempt)
+
+    async def get(self, key):
+        return await self.run_with_retries("try_get", key)
+
+    async def get_many(self, keys):
+        return await self.run_with_retries("try_get_many", keys)
+
+    async def cache_get(self, key):
+        return await self.run("cache_get", key)
+
+    async def cache_set(self, key, value, minutes):
+        try:
+            return await self.run_with_retries("try_cache_set", key, value, minutes)
+        except ConnectionError as e:
+            self.log.warning(f"Error saving data to cache - {e}")
+            return None
+
+    def reconnect_after_error(self, store, e, attempt):
+        STORE_RECONNECTS.inc()
+        self.log.info(f"connection error - {e}, reconnecting after {self.reconnect_delay} seconds, "
+                      f"attempt {attempt} of {self.reconnect_n}")
+        time.sleep(self.reconnect_delay)
+        store.connect()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,62 @@
+import datetime
+import hashlib
+import hmac
+import time
+from cache import LRUCache
+
+
+class Authenticator:
+    """
+    Checks request tokens without hashing on every request
+    Admin digest depends only on the current hour, it is computed once per hour.
+    User digests depend only on (account, login), verified ones are kept in a bounded LRU cache.
+    Tokens are compared in constant time
+    """
+
+    def __init__(self, salt, admin_salt, cache_size=10000, timer=time.time):
+        self.salt = salt
+        self.admin_salt = admin_salt
+        self.timer = timer
+        self.digests = LRUCache(cache_size)
+        # (hour start, next hour start, digest)
+        self.admin = (0, 0, b"")
+        self.checks = 0
+        self.hashes = 0
+
+    def get_admin_digest(self):
+        now = self.timer()
+        start, end, digest = self.admin
+        if start <= now < end:
+            return digest
+        hour = datetime.datetime.fromtimestamp(now).replace(minute=0, second=0, microsecond=0)
+        digest = self.hash(hour.strftime("%Y%m%d%H") + self.admin_salt)
+        self.admin = (hour.timestamp(), (hour + datetime.timedelta(hours=1)).timestamp(), digest)
+        return digest
+
+    def hash(self, msg):
+        self.hashes += 1
+        return hashlib.sha512(msg.encode("utf8")).hexdigest().encode("ascii")
+
+    def check(self, request):
+        self.checks += 1
+        token = request.token.encode("utf8")
+        if request.is_admin:
+            return hmac.compare_digest(self.get_admin_digest(), token)
+
+        key = (request.account, request.login)
+        digest = self.digests.get(key)
+        if digest is not None:
+            return hmac.compare_digest(digest, token)
+        digest = self.hash(request.account + request.login + self.salt)
+        if hmac.compare_digest(digest, token):
+            self.digests.set(key, digest)
+            return True
+        return False
+
+    def stats(self):
+        return {
+            "checks": self.checks,
+            "hashes": self.hashes,
+            "hashes_saved": self.checks - self.hashes,
+            "cached_digests": len(self.digests),
+        }
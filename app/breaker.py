@@ -0,0 +1,129 @@
+import logging
+import random
+import threading
+from collections import deque
+from metrics import Counter
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+# state as a metric value
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+BREAKER_TRANSITIONS = Counter("store_breaker_transitions_total", "Store circuit breaker transitions by new state",
+                              ("state",))
+
+
+class CircuitOpenError(ConnectionError):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker shared by the store connections of a worker
+    closed - calls go to the store, failure_threshold consecutive failures open the circuit;
+    open - calls fail fast, one background thread probes the store with exponential backoff and jitter;
+    half_open - probe succeeded, half_open_calls trial calls go to the store,
+    a successful one closes the circuit, a failed one opens it again
+    """
+
+    def __init__(self, probe, failure_threshold=5, backoff=0.5, max_backoff=30, half_open_calls=1,
+                 random=random.random, max_transitions=100, log=None):
+        self.probe = probe
+        self.failure_threshold = failure_threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.half_open_calls = half_open_calls
+        self.random = random
+        self.log = log or logging
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.state = CLOSED
+        self.failures = 0
+        self.trials = 0
+        self.rejected = 0
+        self.probes = 0
+        self.reconnector = None
+        self.transition_count = 0
+        # (old state, new state) of the last max_transitions transitions
+        self.transitions = deque(maxlen=max_transitions)
+
+    def allow(self):
+        """return True if a call may go to the store"""
+        state = self.state
+        if state == CLOSED:
+            return True
+        if state == HALF_OPEN:
+            with self.lock:
+                if self.state == HALF_OPEN and self.trials < self.half_open_calls:
+                    self.trials += 1
+                    return True
+        self.rejected += 1
+        return False
+
+    def record_success(self):
+        if self.state == CLOSED and not self.failures:
+            return
+        with self.lock:
+            self.failures = 0
+            if self.state == HALF_OPEN:
+                self.transition(CLOSED)
+
+    def record_failure(self, error=None):
+        with self.lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                self.log.warning(f"store circuit opened after {self.failures} failures - {error}")
+                self.transition(OPEN)
+                self.start_reconnector()
+
+    def release(self):
+        """trial call ended without telling whether the store works"""
+        with self.lock:
+            if self.state == HALF_OPEN and self.trials:
+                self.trials -= 1
+
+    def transition(self, state):
+        self.transitions.append((self.state, state))
+        self.transition_count += 1
+        self.state = state
+        self.trials = 0
+        BREAKER_TRANSITIONS.inc(state)
+        if state != OPEN:
+            self.log.info(f"store circuit {state}")
+
+    def get_delay(self, attempt):
+        """exponential backoff with jitter, between half and whole of the backoff"""
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return delay / 2 + self.random() * delay / 2
+
+    def start_reconnector(self):
+        self.reconnector = threading.Thread(target=self.reconnect, name="store-reconnect", daemon=True)
+        self.reconnector.start()
+
+    def reconnect(self):
+        attempt = 0
+        while not self.stopped.wait(self.get_delay(attempt)):
+            self.probes += 1
+            try:
+                available = self.probe()
+            except Exception as e:
+                self.log.info(f"store probe error - {e}")
+                available = False
+            if available:
+                with self.lock:
+                    self.transition(HALF_OPEN)
+                return
+            attempt += 1
+
+    def close(self):
+        self.stopped.set()
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "rejected": self.rejected,
+            "probes": self.probes,
+            "transitions": self.transition_count,
+        }
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+"""
+Offline scoring of exported users with online_score validation and scores
+Every input row is the arguments of an online_score request, one JSON object per line
+or a CSV row with a header of field names. One JSON line is written per input row, in input order:
+{"line": 1, "score": 3.0} or {"line": 2, "error": "..."}, with the row id when it has one.
+Rows are validated by OnlineScoreRequest and scored in batches by a pool of processes
+
+python app/bulk.py -o scores.jsonl users.jsonl
+python app/bulk.py --format csv -j 4 --seed-cache users.csv > scores.jsonl
+"""
+
+import csv
+import itertools
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from optparse import OptionParser
+import codec
+from api import BirthDayField, OnlineScoreRequest
+from scoring import SCORE_CACHE_MINUTES, calculate_score, get_score_key
+from store import Store
+
+# calculate_score arguments, bit i of a presence mask is set when field i has a value
+SCORE_FIELDS = ("phone", "email", "birthday", "gender", "first_name", "last_name")
+# score depends only on which fields have a value, so it is looked up by presence mask
+SCORE_BY_MASK = tuple(calculate_score(*((mask >> i) & 1 for i in range(len(SCORE_FIELDS))))
+                      for mask in range(1 << len(SCORE_FIELDS)))
+# CSV cells are strings, these fields are converted
+CSV_TYPES = {"gender": int}
+
+# store of a worker process seeding the scoring cache
+seed_store = None
+
+
+def get_mask(row):
+    """return presence mask of score fields of row"""
+    mask = 0
+    for i, name in enumerate(SCORE_FIELDS):
+        if row.get(name):
+            mask |= 1 << i
+    return mask
+
+
+def read_jsonl(f):
+    """yield (line number, line) of non empty lines, lines are parsed by workers"""
+    for n, line in enumerate(f, 1):
+        if line.strip():
+            yield n, line
+
+
+def read_csv(f):
+    """yield (row number, arguments) of CSV rows, empty cells are missing fields"""
+    for n, row in enumerate(csv.DictReader(f), 1):
+        arguments = {}
+        for name, value in row.items():
+            if value is None or value == "":
+                continue
+            convert = CSV_TYPES.get(name)
+            if convert is not None:
+                try:
+                    value = convert(value)
+                except ValueError:
+                    pass
+            arguments[name] = value
+        yield n, arguments
+
+
+def parse(item):
+    """return row arguments dict and error"""
+    if isinstance(item, dict):
+        return item, None
+    try:
+        row = codec.loads(item)
+    except ValueError:
+        return None, "Invalid JSON"
+    if not isinstance(row, dict):
+        return None, "Row must be an object"
+    return row, None
+
+
+def score_batch(batch):
+    """return output records of (number, row) batch"""
+    records = []
+    valid = []
+    for n, item in batch:
+        row, error = parse(item)
+        record = {"line": n}
+        if row is not None:
+            if "id" in row:
+                record["id"] = row["id"]
+            validation = OnlineScoreRequest.from_request(row).validate()
+            if validation.is_valid:
+                valid.append((record, row))
+            else:
+                error = validation.reason
+        if error is not None:
+            record["error"] = error
+        records.append(record)
+
+    masks = [get_mask(row) for _, row in valid]
+    scores = [SCORE_BY_MASK[mask] for mask in masks]
+    for (record, _), score in zip(valid, scores):
+        record["score"] = score
+    if seed_store is not None and valid:
+        seed_cache([row for _, row in valid], scores)
+    return records
+
+
+def seed_cache(rows, scores):
+    items = []
+    for row, score in zip(rows, scores):
+        key = get_score_key(row.get("phone"), BirthDayField.get_date(row.get("birthday")), row.get("first_name"),
+                            row.get("last_name"))
+        items.append((key, score, SCORE_CACHE_MINUTES))
+    seed_store.cache_set_many(items)
+
+
+def init_worker(store_kwargs):
+    global seed_store
+    if store_kwargs is not None:
+        seed_store = Store(**store_kwargs)
+
+
+def close_worker():
+    global seed_store
+    if seed_store is not None:
+        seed_store.close()
+        seed_store = None
+
+
+def batches(items, size):
+    items = iter(items)
+    while True:
+        batch = list(itertools.islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+
+def run(items, out, jobs=1, batch_size=1000, store_kwargs=None, report_interval=10, log=None):
+    """
+    score (number, row) items and write output lines to out in input order,
+    log progress every report_interval seconds
+    return (rows, invalid rows, seconds)
+    """
+
+    log = log or logging
+    start = last_report = time.perf_counter()
+    rows = invalid = 0
+    pool = None
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs, init_worker, (store_kwargs,))
+        results = pool.imap(score_batch, batches(items, batch_size))
+    else:
+        init_worker(store_kwargs)
+        results = map(score_batch, batches(items, batch_size))
+    try:
+        for records in results:
+            for record in records:
+                out.write(codec.dumps(record).decode("utf8"))
+                out.write("\n")
+                invalid += "error" in record
+            rows += len(records)
+            now = time.perf_counter()
+            if report_interval and now - last_report >= report_interval:
+                last_report = now
+                log.info(f"{rows} rows scored, {rows / (now - start):.0f} rows/s")
+    except BaseException:
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        close_worker()
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return rows, invalid, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    op = OptionParser(usage="%prog [options] [FILE]")
+    op.add_option("-f", "--format", action="store", type="choice", choices=["jsonl", "csv"], default=None,
+                  help="input format, by file extension if not set, jsonl for stdin")
+    op.add_option("-o", "--output", action="store", default=None,
+                  help="output file, stdout if not set")
+    op.add_option("-j", "--jobs", action="store", type=int, default=os.cpu_count(),
+                  help="scoring processes, 1 - score in the current process")
+    op.add_option("-b", "--batch-size", action="store", type=int, default=1000,
+                  help="rows scored by a process at once")
+    op.add_option("--seed-cache", action="store_true", default=False,
+                  help="write scores to the scoring cache in the store")
+    op.add_option("--report-interval", action="store", type=float, default=10,
+                  help="seconds between progress reports, 0 - report only when done")
+    op.add_option("--store-host", action="store", default="localhost")
+    op.add_option("--store-port", action="store", type=int, default=3301)
+    (opts, args) = op.parse_args()
+    logging.basicConfig(level=logging.INFO,
+                        format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
+    fmt = opts.format or ("csv" if args and args[0].endswith(".csv") else "jsonl")
+    store_kwargs = {"host": opts.store_host, "port": opts.store_port} if opts.seed_cache else None
+    with (open(args[0], newline="") if args else sys.stdin) as f, \
+            (open(opts.output, "w") if opts.output else sys.stdout) as out:
+        items = read_csv(f) if fmt == "csv" else read_jsonl(f)
+        rows, invalid, seconds = run(items, out, opts.jobs, opts.batch_size, store_kwargs, opts.report_interval)
+    logging.info(f"{rows} rows scored, {invalid} invalid, {seconds:.2f} seconds, "
+                 f"{rows / seconds if seconds else 0:.0f} rows/s")
@@ -0,0 +1,484 @@
+import datetime
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from store import Store, StoreProxy
+
+MISSING = object()
+
+
+class LRUCache:
+    """
+    Bounded in-process cache with LRU eviction and per-entry expiry
+    Thread safe, counts hits, misses, expirations and evictions
+    """
+
+    def __init__(self, maxsize=10000, timer=time.monotonic):
+        self.maxsize = maxsize
+        self.timer = timer
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            value, expires = item
+            if expires is not None and expires <= self.timer():
+                del self.data[key]
+                self.expired += 1
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        """set value for ttl seconds, forever if ttl is None"""
+        expires = self.timer() + ttl if ttl is not None else None
+        with self.lock:
+            self.data[key] = (value, expires)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+                self.evicted += 1
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "evicted": self.evicted,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class L1CachedStore(StoreProxy):
+    """
+    In-process cache in front of store cache_get/cache_set
+    Entries expire together with valid_thru written to the store, max_ttl (seconds) caps
+    how long a value may be served without asking the store again
+    """
+
+    def __init__(self, store, cache, max_ttl=None):
+        super().__init__(store)
+        self.cache = cache
+        self.max_ttl = max_ttl
+
+    def get_ttl(self, ttl):
+        if self.max_ttl is not None:
+            return min(ttl, self.max_ttl)
+        return ttl
+
+    def cache_get(self, key):
+        entry = self.cache_get_entry(key)
+        if entry is None:
+            return None
+        value, valid_thru = entry
+        if valid_thru < datetime.datetime.today():
+            return None
+        return value
+
+    def cache_get_entry(self, key):
+        # (value, valid_thru) entries are kept, so expired ones are never cached
+        entry = self.cache.get(key, MISSING)
+        if entry is not MISSING:
+            return entry
+        entry = self.store.cache_get_entry(key)
+        if entry is None:
+            return None
+        ttl = (entry[1] - datetime.datetime.today()).total_seconds()
+        if ttl > 0:
+            self.cache.set(key, entry, self.get_ttl(ttl))
+        return entry
+
+    def cache_set(self, key, value, minutes):
+        valid_thru = datetime.datetime.today() + datetime.timedelta(minutes=minutes)
+        self.cache.set(key, (Store.cache_value(value), valid_thru), self.get_ttl(minutes * 60))
+        return self.store.cache_set(key, value, minutes)
+
+
+class CacheWriteQueue:
+    """
+    Bounded queue of cache writes flushed by a background thread
+    Writes of the same key are coalesced, the last value wins. Pending writes are flushed
+    with store.cache_set_many in batches every flush_interval seconds or as soon as a batch is full,
+    close() flushes everything left. Writes over max_pending are dropped and counted
+    """
+
+    def __init__(self, store, max_pending=10000, batch_size=100, flush_interval=0.1, log=None):
+        self.store = store
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.log = log or logging
+        self.condition = threading.Condition()
+        # key -> (value, minutes)
+        self.pending = OrderedDict()
+        self.in_flight = {}
+        self.closed = False
+        self.queued = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.flushed = 0
+        self.failed = 0
+        self.thread = threading.Thread(target=self.run, name="cache-writer", daemon=True)
+        self.thread.start()
+
+    def put(self, key, value, minutes):
+        """queue write, return False if it was dropped"""
+        with self.condition:
+            if key in self.pending:
+                self.coalesced += 1
+            elif len(self.pending) >= self.max_pending or self.closed:
+                self.dropped += 1
+                return False
+            else:
+                self.queued += 1
+            self.pending[key] = (value, minutes)
+            if len(self.pending) >= self.batch_size:
+                self.condition.notify()
+        return True
+
+    def get(self, key, default=None):
+        """return value of not yet flushed write"""
+        item = self.get_item(key)
+        if item is None:
+            return default
+        return item[0]
+
+    def get_item(self, key):
+        """return (value, minutes) of not yet flushed write or None"""
+        with self.condition:
+            return self.pending.get(key) or self.in_flight.get(key)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if not self.closed and len(self.pending) < self.batch_size:
+                    self.condition.wait(self.flush_interval)
+                if not self.pending:
+                    return
+                self.in_flight, self.pending = self.pending, OrderedDict()
+                batch = [(key, value, minutes) for key, (value, minutes) in self.in_flight.items()]
+            for start in range(0, len(batch), self.batch_size):
+                self.write(batch[start:start + self.batch_size])
+            with self.condition:
+                self.in_flight = {}
+
+    def write(self, items):
+        try:
+            res = self.store.cache_set_many(items)
+        except Exception as e:
+            self.log.warning(f"Error saving data to cache - {e}")
+            res = None
+        if res:
+            self.flushed += len(items)
+        else:
+            self.failed += len(items)
+
+    def close(self):
+        """stop accepting writes and flush pending ones"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+
+    def stats(self):
+        with self.condition:
+            return {
+                "pending": len(self.pending),
+                "max_pending": self.max_pending,
+                "queued": self.queued,
+                "coalesced": self.coalesced,
+                "dropped": self.dropped,
+                "flushed": self.flushed,
+                "failed": self.failed,
+            }
+
+
+class WriteBehindStore(StoreProxy):
+    """
+    Store which queues cache_set writes instead of waiting for the store
+    Reads see own writes before they are flushed
+    """
+
+    def __init__(self, store, queue):
+        super().__init__(store)
+        self.queue = queue
+
+    def cache_get(self, key):
+        value = self.queue.get(key, MISSING)
+        if value is not MISSING:
+            return Store.cache_value(value)
+        return self.store.cache_get(key)
+
+    def cache_get_entry(self, key):
+        item = self.queue.get_item(key)
+        if item is not None:
+            value, minutes = item
+            return Store.cache_value(value), datetime.datetime.today() + datetime.timedelta(minutes=minutes)
+        return self.store.cache_get_entry(key)
+
+    def cache_set(self, key, value, minutes):
+        if self.queue.put(key, value, minutes):
+            return True
+        return None
+
+
+class BatchStore(StoreProxy):
+    """
+    Store shared by concurrently processed items of one batch request
+    Each key is looked up once per batch, concurrent lookups of the same key wait for the first one.
+    Calls to a store which is not thread safe are serialized
+    """
+
+    def __init__(self, store):
+        super().__init__(store)
+        self.lock = None if getattr(store, "thread_safe", False) else threading.Lock()
+        self.results_lock = threading.Lock()
+        # (operation, key) -> Future
+        self.results = {}
+
+    def call(self, func, *args):
+        if self.lock is None:
+            return func(*args)
+        with self.lock:
+            return func(*args)
+
+    def claim(self, operation, keys):
+        """return futures of keys results and keys to be fetched by the caller"""
+        futures = {}
+        claimed = []
+        with self.results_lock:
+            for key in keys:
+                future = self.results.get((operation, key))
+                if future is None:
+                    future = self.results[(operation, key)] = Future()
+                    claimed.append(key)
+                futures[key] = future
+        return futures, claimed
+
+    def once(self, operation, key, *args):
+        futures, claimed = self.claim(operation, [key])
+        if claimed:
+            try:
+                futures[key].set_result(self.call(getattr(self.store, operation), key, *args))
+            except Exception as e:
+                futures[key].set_exception(e)
+        return futures[key].result()
+
+    def get(self, key):
+        return self.once("get", key)
+
+    def get_many(self, keys):
+        futures, claimed = self.claim("get", keys)
+        if claimed:
+            try:
+                values = self.call(self.store.get_many, claimed)
+            except Exception as e:
+                for key in claimed:
+                    futures[key].set_exception(e)
+            else:
+                for key in claimed:
+                    futures[key].set_result(values.get(key))
+        return {key: future.result() for key, future in futures.items()}
+
+    def cache_get(self, key):
+        return self.once("cache_get", key)
+
+    def cache_get_entry(self, key):
+        return self.once("cache_get_entry", key)
+
+    def cache_set(self, key, value, minutes):
+        return self.once("cache_set", key, value, minutes)
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key, only the first caller runs the function
+    and the others wait for its result. A caller waiting longer than timeout seconds
+    runs the function itself.
+    A caller may take a mark() before its own lookup, finished_since tells whether a call with the key
+    finished after it, i.e. whether the lookup has to be repeated
+    """
+
+    def __init__(self, timeout=1.0, counter=None, max_finished=1024):
+        self.timeout = timeout
+        self.counter = counter
+        self.max_finished = max_finished
+        self.lock = threading.Lock()
+        # key -> Future of the call in flight
+        self.calls = {}
+        # sequence number of the last finished leader call,
+        # key -> sequence number of its last finished call for the max_finished most recent keys
+        self.finished_seq = 0
+        self.finished = OrderedDict()
+        # sequence number of the last call forgotten from finished
+        self.forgotten_seq = 0
+        # callers waiting for a leader now
+        self.waiting = 0
+        self.leaders = 0
+        self.coalesced = 0
+        self.timeouts = 0
+
+    def count(self, result):
+        if self.counter is not None:
+            self.counter.inc(result)
+
+    def do(self, key, func, *args):
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = self.calls[key] = Future()
+            else:
+                self.waiting += 1
+        if leader:
+            self.leaders += 1
+            self.count("leader")
+            try:
+                future.set_result(func(*args))
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                    self.finish(key)
+            return future.result()
+
+        try:
+            res = future.result(self.timeout)
+        except TimeoutError:
+            res = MISSING
+        finally:
+            with self.lock:
+                self.waiting -= 1
+        if res is MISSING:
+            self.timeouts += 1
+            self.count("timeout")
+            return func(*args)
+        self.coalesced += 1
+        self.count("coalesced")
+        return res
+
+    def finish(self, key):
+        self.finished_seq += 1
+        self.finished[key] = self.finished_seq
+        self.finished.move_to_end(key)
+        if len(self.finished) > self.max_finished:
+            _, self.forgotten_seq = self.finished.popitem(last=False)
+
+    def mark(self):
+        """return mark of calls finished so far"""
+        return self.finished_seq
+
+    def finished_since(self, key, mark):
+        """return True if a call with key may have finished after mark was taken"""
+        with self.lock:
+            return self.finished.get(key, 0) > mark or self.forgotten_seq > mark
+
+    def stats(self):
+        return {
+            "in_flight": len(self.calls),
+            "waiting": self.waiting,
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "timeouts": self.timeouts,
+        }
+
+
+class Revalidator:
+    """
+    Refreshes stale cache entries in background for stale-while-revalidate reads
+    Entries expired less than grace seconds ago may be served while a refresh is scheduled.
+    Refreshes run in a pool of threads, each with its own store from store_factory,
+    a key is refreshed once at a time and at most max_pending refreshes wait
+    """
+
+    def __init__(self, store_factory, grace, threads=2, max_pending=1000, log=None):
+        self.store_factory = store_factory
+        self.grace = datetime.timedelta(seconds=grace)
+        self.max_pending = max_pending
+        self.log = log or logging
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="revalidate")
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.scheduled = 0
+        self.dropped = 0
+        self.failed = 0
+
+    @property
+    def store(self):
+        store = getattr(self.local, "store", None)
+        if store is None:
+            store = self.local.store = self.store_factory()
+        return store
+
+    def is_servable(self, valid_thru, now):
+        """return True if entry expired at valid_thru may still be served at now"""
+        return now - valid_thru <= self.grace
+
+    def schedule(self, key, func, *args):
+        """
+        schedule func(store, *args) refreshing key, return False if it is already scheduled
+        or too many refreshes wait
+        """
+
+        with self.lock:
+            if key in self.pending:
+                return False
+            if len(self.pending) >= self.max_pending:
+                self.dropped += 1
+                return False
+            self.pending.add(key)
+            self.scheduled += 1
+        self.executor.submit(self.refresh, key, func, args)
+        return True
+
+    def refresh(self, key, func, args):
+        try:
+            func(self.store, *args)
+        except Exception as e:
+            self.failed += 1
+            self.log.warning(f"Error refreshing cache entry {key} - {e}")
+        finally:
+            with self.lock:
+                self.pending.discard(key)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "pending": len(self.pending),
+                "scheduled": self.scheduled,
+                "dropped": self.dropped,
+                "failed": self.failed,
+            }
@@ -0,0 +1,69 @@
+"""
+JSON codec for request bodies and responses
+Uses orjson or ujson when one is installed, stdlib json otherwise.
+dumps returns utf8 encoded bytes ready to be written to the socket
+"""
+
+import json
+import re
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+def json_loads(data):
+    return json.loads(data)
+
+
+def json_dumps(obj):
+    return json.dumps(obj).encode("utf8")
+
+
+if orjson is not None:
+    NAME = "orjson"
+    # orjson reads integers over 64 bit as float, json keeps them int
+    LONG_NUMBER = re.compile(rb"\d{19}")
+
+    def loads(data):
+        if isinstance(data, str):
+            data = data.encode("utf8")
+        if LONG_NUMBER.search(data):
+            return json_loads(data)
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # let json decide, it accepts a few things orjson does not, e.g. NaN
+            return json_loads(data)
+
+    def dumps(obj):
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+        except orjson.JSONEncodeError:
+            return json_dumps(obj)
+
+elif ujson is not None:
+    NAME = "ujson"
+
+    def loads(data):
+        try:
+            return ujson.loads(data)
+        except ValueError:
+            return json_loads(data)
+
+    def dumps(obj):
+        try:
+            return ujson.dumps(obj, ensure_ascii=False).encode("utf8")
+        except (TypeError, OverflowError):
+            return json_dumps(obj)
+
+else:
+    NAME = "json"
+    loads = json_loads
+    dumps = json_dumps
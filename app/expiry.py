@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+"""
+Expiry of the scoring cache kept in tarantool
+Cached tuples are (id, value, valid_thru) with valid_thru in epoch seconds. Expired tuples are deleted
+by a background sweeper walking the primary index in bounded batches, so one batch never blocks
+the store for long. Tuples written by older versions keep ISO-8601 valid_thru strings until migrated,
+reads accept both
+
+python app/expiry.py migrate   # convert ISO valid_thru strings to epoch seconds
+python app/expiry.py sweep     # delete expired tuples once
+"""
+
+import logging
+import threading
+import time
+from optparse import OptionParser
+from metrics import Counter
+from store import Store
+
+# delete expired tuples among at most limit tuples after the after key,
+# return number of deleted tuples and the key to continue from, null when the space is walked through
+EXPIRE_LUA = """
+local space, after, limit, now = ...
+local expired = {}
+local last = box.NULL
+local n = 0
+local iterator = after == nil and "ALL" or "GT"
+for _, t in box.space[space].index[0]:pairs(after, {iterator = iterator}) do
+    n = n + 1
+    last = t[1]
+    if type(t[3]) == "number" and t[3] < now then
+        table.insert(expired, t[1])
+    end
+    if n >= limit then
+        break
+    end
+end
+for _, id in ipairs(expired) do
+    box.space[space]:delete(id)
+end
+if n < limit then
+    last = box.NULL
+end
+return {#expired, last}
+"""
+
+# return {id, valid_thru} of tuples with string valid_thru among at most limit tuples after the after key
+# and the key to continue from, null when the space is walked through
+SCAN_ISO_LUA = """
+local space, after, limit = ...
+local rows = {}
+local last = box.NULL
+local n = 0
+local iterator = after == nil and "ALL" or "GT"
+for _, t in box.space[space].index[0]:pairs(after, {iterator = iterator}) do
+    n = n + 1
+    last = t[1]
+    if type(t[3]) == "string" then
+        table.insert(rows, {t[1], t[3]})
+    end
+    if n >= limit then
+        break
+    end
+end
+if n < limit then
+    last = box.NULL
+end
+return {rows, last}
+"""
+
+# set valid_thru of {id, old valid_thru, new valid_thru} rows, tuples rewritten since the scan are kept
+UPDATE_TTL_LUA = """
+local space, rows = ...
+local n = 0
+for _, row in ipairs(rows) do
+    local t = box.space[space]:get(row[1])
+    if t ~= nil and t[3] == row[2] then
+        box.space[space]:update(row[1], {{"=", 3, row[3]}})
+        n = n + 1
+    end
+end
+return n
+"""
+
+EXPIRED_DELETED = Counter("store_expired_deleted_total", "Expired scoring cache tuples deleted by the sweeper")
+
+
+def expire(store, space="scoring", batch_size=1000, pause=0.0, now=None, stopped=None):
+    """
+    delete tuples of space expired before now, batch_size tuples are walked per round trip
+    sleep pause seconds between batches, stop early when stopped event is set
+    return number of deleted tuples
+    """
+
+    now = time.time() if now is None else now
+    stopped = stopped or threading.Event()
+    deleted = 0
+    after = None
+    while True:
+        response = store.connection.eval(EXPIRE_LUA, space, after, batch_size, now)
+        count, after = response.data[0]
+        deleted += count
+        EXPIRED_DELETED.inc(amount=count)
+        if after is None:
+            return deleted
+        if stopped.wait(pause):
+            return deleted
+
+
+def migrate(store, space="scoring", batch_size=1000):
+    """convert ISO-8601 valid_thru of space tuples to epoch seconds, return number of converted tuples"""
+    converted = 0
+    after = None
+    while True:
+        response = store.connection.eval(SCAN_ISO_LUA, space, after, batch_size)
+        rows, after = response.data[0]
+        if rows:
+            rows = [(id, valid_thru, int(Store.get_expiry(valid_thru))) for id, valid_thru in rows]
+            converted += store.connection.eval(UPDATE_TTL_LUA, space, rows).data[0]
+        if after is None:
+            return converted
+
+
+class ExpirySweeper:
+    """
+    Background thread deleting expired tuples of the scoring space every interval seconds
+    Every round trip walks at most batch_size tuples, pause seconds are slept between them.
+    Tuples expired less than grace seconds ago are kept, so stale scores can still be served
+    """
+
+    def __init__(self, store, interval=60, batch_size=1000, pause=0.01, grace=0, space="scoring", log=None):
+        self.store = store
+        self.interval = interval
+        self.grace = grace
+        self.batch_size = batch_size
+        self.pause = pause
+        self.space = space
+        self.log = log or logging
+        self.stopped = threading.Event()
+        self.thread = None
+        self.sweeps = 0
+        self.deleted = 0
+        self.failed = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="expiry-sweeper", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sweep()
+
+    def sweep(self):
+        try:
+            deleted = expire(self.store, self.space, self.batch_size, self.pause, time.time() - self.grace,
+                             self.stopped)
+        except Exception as e:
+            self.failed += 1
+            self.log.warning(f"Error deleting expired cache entries - {e}")
+            # reconnect on next sweep
+            self.store.close()
+            return
+        self.sweeps += 1
+        self.deleted += deleted
+        if deleted:
+            self.log.info(f"{deleted} expired cache entries deleted")
+
+    def close(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.store.close()
+
+    def stats(self):
+        return {
+            "sweeps": self.sweeps,
+            "deleted": self.deleted,
+            "failed": self.failed,
+        }
+
+
+if __name__ == "__main__":
+    op = OptionParser(usage="%prog [options] migrate|sweep")
+    op.add_option("--host", action="store", default="localhost")
+    op.add_option("--port", action="store", type=int, default=3301)
+    op.add_option("--space", action="store", default="scoring")
+    op.add_option("--batch-size", action="store", type=int, default=1000,
+                  help="tuples walked per round trip")
+    op.add_option("--pause", action="store", type=float, default=0.01,
+                  help="seconds between round trips of a sweep")
+    (opts, args) = op.parse_args()
+    if len(args) != 1 or args[0] not in ("migrate", "sweep"):
+        op.error("command must be migrate or sweep")
+    logging.basicConfig(level=logging.INFO,
+                        format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
+    store = Store(opts.host, opts.port)
+    if not store.connect():
+        raise SystemExit(1)
+    try:
+        if args[0] == "migrate":
+            logging.info(f"{migrate(store, opts.space, opts.batch_size)} tuples migrated to epoch valid_thru")
+        else:
+            logging.info(f"{expire(store, opts.space, opts.batch_size, opts.pause)} expired tuples deleted")
+    finally:
+        store.close()
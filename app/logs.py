@@ -0,0 +1,163 @@
+import json
+import logging
+import queue
+import random
+import re
+from logging.handlers import QueueHandler, QueueListener
+from metrics import Counter
+
+LOG_RECORDS_DROPPED = Counter("log_records_dropped_total", "Log records dropped because the log queue was full")
+
+
+class Fields(dict):
+    """
+    Structured log record payload
+    Encoded to compact JSON only when the record is formatted
+    """
+
+    def __str__(self):
+        return json.dumps(self, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Puts records to a bounded queue without blocking, records over the queue size are dropped and counted
+    Records are not formatted here, formatting is left to the writer thread
+    """
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            LOG_RECORDS_DROPPED.inc()
+
+
+class BlockingStopQueueListener(QueueListener):
+    def enqueue_sentinel(self):
+        # wait for a free slot, full queue must not prevent stop
+        self.queue.put(self._sentinel)
+
+
+class BackgroundLogging:
+    """
+    Moves root logger handlers to a background writer thread while active,
+    so file I/O is off the request path. stop() writes records left in the queue
+    """
+
+    def __init__(self, queue_size=10000):
+        self.queue_size = queue_size
+        self.handler = None
+        self.listener = None
+        self.handlers = []
+
+    @property
+    def dropped(self):
+        return self.handler.dropped if self.handler is not None else 0
+
+    def start(self):
+        root = logging.getLogger()
+        self.handlers = root.handlers[:]
+        self.handler = DroppingQueueHandler(queue.Queue(self.queue_size))
+        self.listener = BlockingStopQueueListener(self.handler.queue, *self.handlers, respect_handler_level=True)
+        for handler in self.handlers:
+            root.removeHandler(handler)
+        root.addHandler(self.handler)
+        self.listener.start()
+
+    def stop(self):
+        root = logging.getLogger()
+        root.removeHandler(self.handler)
+        for handler in self.handlers:
+            root.addHandler(handler)
+        self.listener.stop()
+        if self.dropped:
+            logging.warning(f"{self.dropped} log records dropped")
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class Truncated:
+    """
+    Log message argument cut to max_bytes of utf8 text
+    Cut only when the record is formatted
+    """
+
+    def __init__(self, value, max_bytes):
+        self.value = value
+        self.max_bytes = max_bytes
+
+    def __str__(self):
+        text = self.value.decode("utf8", "replace") if isinstance(self.value, bytes) else str(self.value)
+        data = text.encode("utf8")
+        if len(data) <= self.max_bytes:
+            return text
+        return data[:self.max_bytes].decode("utf8", "ignore") + f"...({len(data)} bytes)"
+
+
+class RequestLogger:
+    """
+    Logs requests served by MainHTTPHandler
+    Text mode logs request body and whole response context,
+    structured mode logs one compact record per request.
+    Successful requests are sampled with the rate of their status code, else of their method,
+    else sample_rate. Errors are always logged. Bodies and responses are cut to max_bytes,
+    values of redact fields are hidden
+    """
+
+    def __init__(self, structured=False, sample_rate=1.0, method_rates=None, code_rates=None, max_bytes=0,
+                 redact=("token",), random=random.random):
+        self.structured = structured
+        self.sample_rate = sample_rate
+        self.method_rates = method_rates or {}
+        self.code_rates = code_rates or {}
+        self.max_bytes = max_bytes
+        self.redact_pattern = re.compile(
+            rb'("(?:' + b"|".join(re.escape(f.encode("utf8")) for f in redact) + rb')"\s*:\s*)"(?:[^"\\]|\\.)*"'
+        ) if redact else None
+        self.random = random
+        self.logged = 0
+        self.skipped = 0
+
+    def sampled(self, method, code):
+        if code >= 400:
+            return True
+        if code in self.code_rates:
+            rate = self.code_rates[code]
+        else:
+            rate = self.method_rates.get(method, self.sample_rate)
+        return rate >= 1 or self.random() < rate
+
+    def cut(self, value):
+        return Truncated(value, self.max_bytes) if self.max_bytes else value
+
+    def redacted(self, body):
+        if self.redact_pattern is None:
+            return body
+        return self.redact_pattern.sub(rb'\1"***"', body)
+
+    def log(self, path, method, body, context, bytes_out, elapsed):
+        if not self.sampled(method, context["code"]):
+            self.skipped += 1
+            return
+        self.logged += 1
+        if self.structured:
+            fields = Fields((k, v) for k, v in context.items() if k != "response")
+            fields.update(path=path, bytes_in=len(body), bytes_out=bytes_out, ms=round(elapsed * 1000, 3))
+            logging.info(fields)
+            return
+        if body:
+            logging.info("%s: %s %s", path, self.cut(self.redacted(body)), context["request_id"])
+        logging.info("%s", self.cut(context))
@@ -0,0 +1,168 @@
+import datetime
+import heapq
+import logging
+import threading
+import time
+from store import Store
+
+
+class MemoryStore:
+    """
+    In-process store with the Store interface and key semantics, for single node deployments and benchmarks
+    Cached entries are removed when they expire: a heap ordered by expiry time is swept on every write
+    and every sweep_interval seconds. At most max_entries are kept, entries closest to expiry are evicted first,
+    then the oldest persistent ones
+    """
+
+    thread_safe = True
+
+    def __init__(self, max_entries=100000, sweep_interval=1.0, timer=time.time, log=None):
+        self.max_entries = max_entries
+        self.sweep_interval = sweep_interval
+        self.timer = timer
+        self.log = log or logging
+        self.lock = threading.Lock()
+        # (space, id) -> [value, expiry time or None]
+        self.entries = {}
+        # (expiry time, (space, id)), entries overwritten or deleted since push are stale
+        self.heap = []
+        self.expired = 0
+        self.evicted = 0
+        self.stopped = threading.Event()
+        self.sweeper = None
+        if sweep_interval:
+            self.sweeper = threading.Thread(target=self.run_sweeper, name="memstore-sweeper", daemon=True)
+            self.sweeper.start()
+
+    @staticmethod
+    def get_entry_key(key):
+        id = Store.get_id(key)
+        if id is None:
+            raise ValueError("Invalid key")
+        return Store.get_space_name(key), id
+
+    def get(self, key):
+        entry_key = self.get_entry_key(key)
+        with self.lock:
+            entry = self.entries.get(entry_key)
+        if entry is None:
+            return [""]
+        return entry[0]
+
+    def get_many(self, keys):
+        entry_keys = {key: self.get_entry_key(key) for key in keys}
+        with self.lock:
+            entries = {key: self.entries.get(entry_key) for key, entry_key in entry_keys.items()}
+        return {key: [""] if entry is None else entry[0] for key, entry in entries.items()}
+
+    def cache_get(self, key):
+        entry = self.cache_get_entry(key)
+        if entry is None:
+            return None
+        value, valid_thru = entry
+        if valid_thru < datetime.datetime.today():
+            return None
+        return value
+
+    def cache_get_entry(self, key):
+        try:
+            entry_key = self.get_entry_key(key)
+        except ValueError as e:
+            self.log.warning(f"Error getting data from cache - {e}")
+            return None
+        with self.lock:
+            entry = self.entries.get(entry_key)
+        if entry is None or entry[1] is None:
+            return None
+        value, expires = entry
+        return Store.cache_value(value), datetime.datetime.fromtimestamp(expires)
+
+    def cache_set(self, key, value, minutes):
+        return self.cache_set_many([(key, value, minutes)])
+
+    def cache_set_many(self, items):
+        try:
+            rows = [(self.get_entry_key(key), value, minutes) for key, value, minutes in items]
+        except ValueError as e:
+            self.log.warning(f"Error saving data to cache - {e}")
+            return None
+        now = self.timer()
+        with self.lock:
+            self.expire(now)
+            for entry_key, value, minutes in rows:
+                expires = now + minutes * 60
+                self.put(entry_key, [value, expires])
+                heapq.heappush(self.heap, (expires, entry_key))
+            self.compact()
+        return True
+
+    def set(self, key, value):
+        """save value which never expires, as rows of the interests space"""
+        entry_key = self.get_entry_key(key)
+        with self.lock:
+            self.put(entry_key, [value, None])
+
+    def put(self, entry_key, entry):
+        if entry_key not in self.entries and len(self.entries) >= self.max_entries:
+            self.evict()
+        self.entries[entry_key] = entry
+
+    def is_current(self, expires, entry_key):
+        entry = self.entries.get(entry_key)
+        return entry is not None and entry[1] == expires
+
+    def expire(self, now):
+        """remove entries expired by now"""
+        heap = self.heap
+        while heap and heap[0][0] <= now:
+            expires, entry_key = heapq.heappop(heap)
+            if self.is_current(expires, entry_key):
+                del self.entries[entry_key]
+                self.expired += 1
+
+    def evict(self):
+        while self.heap:
+            expires, entry_key = heapq.heappop(self.heap)
+            if self.is_current(expires, entry_key):
+                del self.entries[entry_key]
+                self.evicted += 1
+                return
+        # only persistent entries left, drop the oldest one
+        del self.entries[next(iter(self.entries))]
+        self.evicted += 1
+
+    def compact(self):
+        """drop stale heap items once they outnumber entries"""
+        if len(self.heap) > 2 * len(self.entries) + 64:
+            self.heap = [(expires, entry_key) for expires, entry_key in self.heap
+                         if self.is_current(expires, entry_key)]
+            heapq.heapify(self.heap)
+
+    def sweep(self):
+        with self.lock:
+            self.expire(self.timer())
+
+    def run_sweeper(self):
+        while not self.stopped.wait(self.sweep_interval):
+            self.sweep()
+
+    def connect(self):
+        return True
+
+    def ping(self):
+        return True
+
+    def close(self):
+        self.stopped.set()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "expired": self.expired,
+                "evicted": self.evicted,
+            }
@@ -0,0 +1,247 @@
+"""
+Process metrics in Prometheus text exposition format
+Every thread counts to its own shard, so updates take no lock.
+Shards are summed when metrics are collected, shards of finished threads are folded into one.
+Metrics are kept per process, with pre-forked workers every worker serves its own ones,
+told apart by the pid label added to every sample
+"""
+
+import functools
+import threading
+import time
+from bisect import bisect_left
+
+# seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    labels = ",".join(f'{name}="{value}"' for name, value in zip(names, values))
+    return "{" + labels + "}"
+
+
+def add_labels(sample, names, values):
+    """return sample line with labels added"""
+    series, value = sample.rsplit(" ", 1)
+    labels = format_labels(names, values)
+    if series.endswith("}"):
+        series = series[:-1] + "," + labels[1:]
+    else:
+        series += labels
+    return f"{series} {value}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        # (name, value) labels added to every sample, e.g. pid of a pre-forked worker
+        self.const_labels = ()
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        names = tuple(name for name, _ in self.const_labels)
+        values = tuple(value for _, value in self.const_labels)
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            if names:
+                lines.extend(add_labels(sample, names, values) for sample in metric.render())
+            else:
+                lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class Metric:
+    """
+    Base class for metrics with per thread shards
+    Shard is a dict label values -> value of the child class
+    """
+
+    type = ""
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # (thread, shard)
+        self.shards = []
+        self.retired = {}
+        if registry is not None:
+            registry.register(self)
+
+    def shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = {}
+            with self.lock:
+                self.shards.append((threading.current_thread(), shard))
+            return shard
+
+    def new_value(self):
+        raise NotImplementedError
+
+    def add_value(self, total, value):
+        raise NotImplementedError
+
+    def collect(self):
+        """return dict label values -> value summed over all threads"""
+        with self.lock:
+            alive = []
+            for thread, shard in self.shards:
+                if thread.is_alive():
+                    alive.append((thread, shard))
+                else:
+                    self.merge(self.retired, shard)
+            self.shards = alive
+            res = {}
+            self.merge(res, self.retired)
+            for _, shard in alive:
+                self.merge(res, shard)
+        return res
+
+    def merge(self, total, shard):
+        for labels, value in list(shard.items()):
+            total[labels] = self.add_value(total.get(labels, self.new_value()), value)
+
+    def render(self):
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labels, amount=1):
+        shard = self.shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self.collect().get(labels, 0)
+
+    def new_value(self):
+        return 0
+
+    def add_value(self, total, value):
+        return total + value
+
+    def render(self):
+        return [f"{self.name}{format_labels(self.labelnames, labels)} {format_value(value)}"
+                for labels, value in sorted(self.collect().items())]
+
+
+class Histogram(Metric):
+    """
+    Value is a list of counts per bucket, last bucket is +Inf, followed by sum of observed values
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(buckets)
+        super().__init__(name, help, labelnames, registry)
+
+    def observe(self, value, *labels):
+        shard = self.shard()
+        row = shard.get(labels)
+        if row is None:
+            row = shard[labels] = self.new_value()
+        row[bisect_left(self.buckets, value)] += 1
+        row[-1] += value
+
+    def time(self, *labels):
+        """decorator observing duration of the call"""
+
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - start, *labels)
+
+            return wrapper
+
+        return decorator
+
+    def count(self, *labels):
+        row = self.collect().get(labels)
+        return sum(row[:-1]) if row else 0
+
+    def new_value(self):
+        return [0] * (len(self.buckets) + 1) + [0.0]
+
+    def add_value(self, total, value):
+        return [a + b for a, b in zip(total, value)]
+
+    def render(self):
+        lines = []
+        names = self.labelnames + ("le",)
+        for labels, row in sorted(self.collect().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), row):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(names, labels + (format_value(bound),))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, labels)} {format_value(row[-1])}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class Gauge:
+    """Value computed by func when metrics are collected"""
+
+    type = "gauge"
+
+    def __init__(self, name, help, func, registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.func = func
+        if registry is not None:
+            registry.register(self)
+
+    def render(self):
+        return [f"{self.name} {format_value(self.func())}"]
+
+
+class CounterFunc(Gauge):
+    """Counter kept by a component, e.g. in its stats, read when metrics are collected"""
+
+    type = "counter"
+
+
+def hit_ratio(counter):
+    """share of "hit" in all results counted"""
+    values = counter.collect()
+    total = sum(values.values())
+    return values.get(("hit",), 0) / total if total else 0.0
+
+
+METHOD_REQUESTS = Counter("method_requests_total", "Method requests by method and status code",
+                          ("method", "code"))
+METHOD_LATENCY = Histogram("method_latency_seconds", "method_handler latency by method", ("method",))
+HTTP_RESPONSES = Counter("http_responses_total", "HTTP responses by status code", ("code",))
+STORE_LATENCY = Histogram("store_latency_seconds", "Store round trip latency by operation", ("op",))
+STORE_RECONNECTS = Counter("store_reconnects_total", "Store reconnect attempts")
+SCORE_CACHE = Counter("score_cache_total", "get_score cache lookups by result: hit, stale or miss", ("result",))
+SCORE_FLIGHT = Counter("score_singleflight_total", "get_score calls by single-flight role: leader computed, "
+                       "coalesced waited for a leader, timeout gave up waiting", ("result",))
+SCORE_CACHE_HIT_RATIO = Gauge("score_cache_hit_ratio", "Share of get_score cache lookups that found a fresh score",
+                              lambda: hit_ratio(SCORE_CACHE))
@@ -0,0 +1,54 @@
+import cProfile
+import logging
+import os
+import random
+import re
+import threading
+import time
+import uuid
+
+PROFILE_HEADER = "X-Profile"
+
+
+class Profiler:
+    """
+    Runs chosen requests under cProfile and writes stats to directory, one file per request
+    A request is profiled when an admin sends PROFILE_HEADER, or at random one in sample_every requests.
+    Only one request is profiled at a time, others run as usual
+    """
+
+    def __init__(self, directory, sample_every=0, random=random.random, log=None):
+        self.directory = directory
+        self.sample_every = sample_every
+        self.random = random
+        self.log = log or logging
+        self.lock = threading.Lock()
+        self.profiled = 0
+        self.busy = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def wanted(self, request, headers):
+        if request.is_admin and headers.get(PROFILE_HEADER):
+            return True
+        return self.sample_every > 0 and self.random() * self.sample_every < 1
+
+    def get_path(self, request_id, method):
+        name = re.sub(r"[^\w.-]", "_", f"{request_id or uuid.uuid4().hex}-{method}")[:100]
+        return os.path.join(self.directory, f"{time.strftime('%Y%m%d%H%M%S')}-{name}.prof")
+
+    def run(self, request_id, method, func, *args):
+        """return func(*args), profiled if no other request is profiled now"""
+        if not self.lock.acquire(blocking=False):
+            self.busy += 1
+            return func(*args)
+        try:
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(func, *args)
+            finally:
+                path = self.get_path(request_id, method)
+                profile.dump_stats(path)
+                self.profiled += 1
+                self.log.info(f"request profile saved to {path}")
+        finally:
+            self.lock.release()
@@ -18,23 +18,33 @@
 #     interests = ["cars", "pets", "travel", "hi-tech", "sport", "music", "books", "tv", "cinema", "geek", "otus"]
 #     return random.sample(interests, 2)
 
+import datetime
 import hashlib
-import json
+from cache import SingleFlight
+from metrics import SCORE_CACHE, SCORE_FLIGHT, Gauge
 
+# concurrent get_score calls for the same key wait for one computation
+score_flight = SingleFlight(counter=SCORE_FLIGHT)
+Gauge("score_singleflight_waiting", "get_score calls waiting for a concurrent computation of the same score",
+      lambda: score_flight.waiting)
+# minutes a computed score is cached, in-process L1 copies are served without the store for as long
+SCORE_CACHE_MINUTES = 60
+# cache.Revalidator set by make_server in stale-while-revalidate mode
+revalidator = None
 
-def get_score(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+
+def get_score_key(phone, birthday=None, first_name=None, last_name=None):
     key_parts = [
         first_name or "",
         last_name or "",
         str(phone) or "",
         birthday.strftime("%Y%m%d") if birthday is not None else "",
     ]
-    key = "uid:" + hashlib.md5(("".join(key_parts)).encode("utf8")).hexdigest()
-    # try get from cache,
-    # fallback to heavy calculation in case of cache miss
-    score = store.cache_get(key) or 0
-    if score:
-        return score
+    return "uid:" + hashlib.md5(("".join(key_parts)).encode("utf8")).hexdigest()
+
+
+def calculate_score(phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+    score = 0
     if phone:
         score += 1.5
     if email:
@@ -43,11 +53,102 @@ def get_score(store, phone, email, birthday=None, gender=None, first_name=None,
         score += 1.5
     if first_name and last_name:
         score += 0.5
-    # cache for 60 minutes
-    store.cache_set(key, score, 60 * 60)
     return score
 
 
+def get_score(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+    key = get_score_key(phone, birthday, first_name, last_name)
+    mark = score_flight.mark()
+    # cached scores do not need single-flight, only computations are coalesced
+    if revalidator is None:
+        score = store.cache_get(key)
+        if score:
+            SCORE_CACHE.inc("hit")
+            return score
+    else:
+        score = get_cached_score(store, key, (phone, email, birthday, gender, first_name, last_name))
+        if score:
+            return score
+    return score_flight.do(key, load_score, store, key, mark, phone, email, birthday, gender, first_name, last_name)
+
+
+def load_score(store, key, mark, phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+    args = (phone, email, birthday, gender, first_name, last_name)
+    # check cache again only if the score may have been computed by a leader since the caller's lookup,
+    # fallback to heavy calculation in case of cache miss
+    if score_flight.finished_since(key, mark):
+        score = get_cached_score(store, key, args)
+        if score:
+            return score
+    SCORE_CACHE.inc("miss")
+    return refresh_score(store, key, *args)
+
+
+def get_cached_score(store, key, args):
+    """
+    return cached score, 0 if it has to be computed
+    in stale-while-revalidate mode a score expired less than revalidator.grace ago is served
+    and refreshed in background
+    """
+
+    if revalidator is None:
+        score = store.cache_get(key) or 0
+        if score:
+            SCORE_CACHE.inc("hit")
+        return score
+    entry = store.cache_get_entry(key)
+    if entry is None or not entry[0]:
+        return 0
+    score, valid_thru = entry
+    now = datetime.datetime.today()
+    if valid_thru >= now:
+        SCORE_CACHE.inc("hit")
+        return score
+    if revalidator.is_servable(valid_thru, now):
+        SCORE_CACHE.inc("stale")
+        revalidator.schedule(key, refresh_score, key, *args)
+        return score
+    return 0
+
+
+def refresh_score(store, key, phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+    score = calculate_score(phone, email, birthday, gender, first_name, last_name)
+    store.cache_set(key, score, SCORE_CACHE_MINUTES)
+    return score
+
+
+async def get_score_async(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+    key = get_score_key(phone, birthday, first_name, last_name)
+    score = await store.cache_get(key) or 0
+    if score:
+        SCORE_CACHE.inc("hit")
+        return score
+    SCORE_CACHE.inc("miss")
+    score = calculate_score(phone, email, birthday, gender, first_name, last_name)
+    await store.cache_set(key, score, SCORE_CACHE_MINUTES)
+    return score
+
+
+def interests_from_value(r):
+    return r if r else []
+
+
 def get_interests(store, cid):
     r = store.get("i:%s" % cid)
-    return json.loads(r) if r else []
+    return interests_from_value(r)
+
+
+async def get_interests_async(store, cid):
+    r = await store.get("i:%s" % cid)
+    return interests_from_value(r)
+
+
+def get_interests_many(store, cids):
+    """return dict client id -> interests, fetched with one batched store lookup"""
+    values = store.get_many(["i:%s" % cid for cid in cids])
+    return {cid: interests_from_value(values.get("i:%s" % cid)) for cid in cids}
+
+
+async def get_interests_many_async(store, cids):
+    values = await store.get_many(["i:%s" % cid for cid in cids])
+    return {cid: interests_from_value(values.get("i:%s" % cid)) for cid in cids}
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+"""
+Local SQLite copy of the interests space
+Readers use WAL mode and memory-mapped I/O, so lookups do not block on a refresh and
+hot pages are read without syscalls. A refresh replaces all rows in one transaction,
+readers see either the old or the new data
+
+python app/sqlitestore.py -d interests.db interests.jsonl            # add or update rows
+python app/sqlitestore.py -d interests.db --replace interests.jsonl  # replace all rows
+Every input line is {"id": <client id>, "interests": [...]}
+"""
+
+import json
+import logging
+import sqlite3
+import sys
+import threading
+from optparse import OptionParser
+from metrics import STORE_LATENCY
+
+MMAP_SIZE = 256 * 1024 * 1024
+# SQLite default max number of host parameters is 999
+MAX_PARAMS = 900
+SCHEMA = "CREATE TABLE IF NOT EXISTS interests (id INTEGER PRIMARY KEY, value TEXT NOT NULL)"
+
+
+def connect(path, readonly=False):
+    connection = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+    if readonly:
+        connection.execute("PRAGMA query_only=ON")
+    return connection
+
+
+class SQLiteStore:
+    """
+    Read-only store of i: keys kept in a local SQLite file
+    Thread safe, each thread reads with its own connection
+    """
+
+    thread_safe = True
+
+    def __init__(self, path, log=None):
+        self.path = path
+        self.log = log or logging
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = []
+        connection = connect(path)
+        connection.execute(SCHEMA)
+        connection.close()
+
+    @property
+    def connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = self.local.connection = connect(self.path, readonly=True)
+            with self.lock:
+                self.connections.append(connection)
+        return connection
+
+    @staticmethod
+    def get_id(key):
+        if not key.startswith("i:"):
+            raise ValueError("Invalid key")
+        return int(key[2:])
+
+    @STORE_LATENCY.time("local_get")
+    def get(self, key):
+        row = self.connection.execute("SELECT value FROM interests WHERE id = ?", (self.get_id(key),)).fetchone()
+        if row is None:
+            return [""]
+        return json.loads(row[0])
+
+    @STORE_LATENCY.time("local_get_many")
+    def get_many(self, keys):
+        ids = {key: self.get_id(key) for key in keys}
+        values = {}
+        unique = list(set(ids.values()))
+        for start in range(0, len(unique), MAX_PARAMS):
+            batch = unique[start:start + MAX_PARAMS]
+            query = f"SELECT id, value FROM interests WHERE id IN ({','.join('?' * len(batch))})"
+            values.update(self.connection.execute(query, batch).fetchall())
+        return {key: json.loads(values[id]) if id in values else [""] for key, id in ids.items()}
+
+    def ping(self):
+        try:
+            self.connection.execute("SELECT 1")
+        except sqlite3.Error as e:
+            self.log.warning(f"ping error - {e}")
+            return False
+        return True
+
+    def close(self):
+        with self.lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections = []
+
+
+def import_interests(path, rows, replace=False):
+    """
+    write (client id, interests) rows, return number of rows written
+    with replace rows not in input are deleted, all in one transaction
+    """
+
+    connection = connect(path)
+    try:
+        connection.execute(SCHEMA)
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            if replace:
+                connection.execute("DELETE FROM interests")
+            cursor = connection.executemany("INSERT OR REPLACE INTO interests (id, value) VALUES (?, ?)",
+                                            ((int(id), json.dumps(interests)) for id, interests in rows))
+            count = cursor.rowcount
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+    finally:
+        connection.close()
+    return count
+
+
+def read_jsonl(lines):
+    for line in lines:
+        if line.strip():
+            item = json.loads(line)
+            yield item["id"], item["interests"]
+
+
+if __name__ == "__main__":
+    op = OptionParser(usage="%prog -d DB [--replace] [FILE]")
+    op.add_option("-d", "--db", action="store", help="SQLite file of the interests space")
+    op.add_option("--replace", action="store_true", default=False,
+                  help="delete rows missing in input")
+    (opts, args) = op.parse_args()
+    if not opts.db:
+        op.error("--db is required")
+    logging.basicConfig(level=logging.INFO,
+                        format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
+    with (open(args[0]) if args else sys.stdin) as f:
+        count = import_interests(opts.db, read_jsonl(f), opts.replace)
+    logging.info(f"{count} rows written to {opts.db}")
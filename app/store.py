@@ -1,17 +1,52 @@
 import tarantool
 import logging
 import datetime
-import json
+import threading
 import time
+from collections import deque
+from contextlib import contextmanager
+from metrics import STORE_LATENCY, STORE_RECONNECTS
+from breaker import CircuitOpenError
+
+# select tuples by a list of primary keys in one round trip,
+# missing keys are returned as nulls to keep the result aligned with ids
+GET_MANY_LUA = """
+local space, ids = ...
+local res = {}
+for i, id in ipairs(ids) do
+    local t = box.space[space]:get(id)
+    local value = box.NULL
+    if t ~= nil and t[2] ~= nil then
+        value = t[2]
+    end
+    res[i] = value
+end
+return res
+"""
+
+# insert or overwrite (id, value, valid_thru) rows in one round trip
+UPSERT_MANY_LUA = """
+local space, rows = ...
+for _, row in ipairs(rows) do
+    box.space[space]:upsert(row, {{"=", 2, row[2]}, {"=", 3, row[3]}})
+end
+return #rows
+"""
 
 
 class Store:
+    # one tarantool connection, must not be shared between threads
+    thread_safe = False
+
     def __init__(self, host="localhost", port=3301, user=None, password=None, reconnect_n=10, reconnect_delay=1,
-                 timeout=5, log=None):
+                 timeout=5, batch_size=100, breaker=None, log=None):
         self.host = host
         self.port = port
         self.reconnect_n = reconnect_n
         self.reconnect_delay = reconnect_delay
+        self.batch_size = batch_size
+        # with a circuit breaker calls are not retried, the breaker reconnects in background
+        self.breaker = breaker
         self.connection = tarantool.Connection(host, port,
                                                user=user,
                                                password=password,
@@ -28,60 +63,145 @@ class Store:
         else:
             return None
 
-    def get_space(self, key):
+    @staticmethod
+    def get_space_name(key):
         if key.startswith("uid:"):
-            return self.connection.space('scoring')
+            return "scoring"
         elif key.startswith("i:"):
-            return self.connection.space('interests')
+            return "interests"
         else:
             return None
 
+    def get_space(self, key):
+        name = self.get_space_name(key)
+        if name is None:
+            return None
+        return self.connection.space(name)
+
     def get(self, key):
-        attempt = 0
-        while attempt < self.reconnect_n:
-            try:
-                return self.try_get(key)
-            except tarantool.error.NetworkError as e:
-                attempt += 1
-                self.reconnect_after_error(e, attempt)
+        return self.call_with_retries(self.try_get, key)
 
-        raise ConnectionError("Unable connect to the store")
+    def get_many(self, keys):
+        """
+        return dict key -> value for all keys
+        keys are fetched in batches of batch_size, one round trip per batch
+        """
+
+        return self.call_with_retries(self.try_get_many, keys)
 
     def cache_get(self, key):
-        id = self.get_id(key)
+        row = self.read_cache(key)
+        if row is None:
+            return None
+        value, expires = row
+        if expires < time.time():
+            return None
+        return self.cache_value(value)
+
+    def cache_get_entry(self, key):
+        """
+        return (value, valid_thru) of cached entry, expired entries included
+        return None if entry not found or store not available
+        """
+
+        row = self.read_cache(key)
+        if row is None:
+            return None
+        value, expires = row
+        return self.cache_value(value), datetime.datetime.fromtimestamp(expires)
+
+    def read_cache(self, key):
+        """return (value, expiry epoch seconds) of cached entry or None"""
         try:
-            space = self.get_space(key)
-            response = space.select(id)
-            if not response.data:
-                return None
-            if len(response.data[0]) < 2:
-                return None
-            value = response.data[0][1]
-            valid_thru = response.data[0][2]
-            if not valid_thru:
-                return None
-            valid_thru = datetime.datetime.fromisoformat(valid_thru)
-            if valid_thru < datetime.datetime.today():
-                return None
-            if isinstance(value, list):
-                return str(value)
-            return value
+            if self.breaker is not None:
+                return self.call_guarded(self.try_cache_get_row, key)
+            return self.try_cache_get_row(key)
+        except CircuitOpenError:
+            return None
         except Exception as e:
             self.log.warning(f"Error getting data from cache - {e}")
             return None
 
+    @staticmethod
+    def get_expiry(valid_thru):
+        """
+        return valid_thru as epoch seconds
+        it is stored as epoch seconds, rows written by older versions have ISO strings until migrated
+        """
+
+        if isinstance(valid_thru, str):
+            return datetime.datetime.fromisoformat(valid_thru).timestamp()
+        return valid_thru
+
+    @staticmethod
+    def cache_value(value):
+        """value as returned by cache_get"""
+        if isinstance(value, list):
+            return str(value)
+        return value
+
     def cache_set(self, key, value, minutes):
+        return self.cache_write(self.try_cache_set, key, value, minutes)
+
+    def cache_set_many(self, items):
+        """
+        save list of (key, value, minutes) to cache
+        items are written with upsert in batches of batch_size, one round trip per batch
+        """
+
+        return self.cache_write(self.try_cache_set_many, items)
+
+    def call_with_retries(self, func, *args):
+        """
+        return func(*args), raise ConnectionError if the store is not available
+        with a circuit breaker the call is made once, see call_guarded,
+        otherwise it is retried reconnect_n times, reconnecting after each network error
+        """
+
+        if self.breaker is not None:
+            return self.call_guarded(func, *args)
         attempt = 0
+        error = None
         while attempt < self.reconnect_n:
             try:
-                return self.try_cache_set(key, value, minutes)
+                return func(*args)
             except tarantool.error.NetworkError as e:
                 attempt += 1
                 self.reconnect_after_error(e, attempt)
-                error = str(e)
+                error = e
+
+        raise ConnectionError(f"Unable connect to the store - {error}")
+
+    def call_guarded(self, func, *args):
+        """
+        return func(*args) if the circuit breaker lets the call go to the store
+        raise CircuitOpenError if it does not, ConnectionError if the call fails
+        """
+
+        if not self.breaker.allow():
+            raise CircuitOpenError("Store circuit is open")
+        try:
+            res = func(*args)
+        except tarantool.error.NetworkError as e:
+            # reconnect on next call
+            self.close()
+            self.breaker.record_failure(e)
+            raise ConnectionError(f"Unable connect to the store - {e}") from e
+        except BaseException:
+            self.breaker.release()
+            raise
+        self.breaker.record_success()
+        return res
 
-        self.log.warning(f"Error saving data to cache - {error}")
-        return None
+    def cache_write(self, func, *args):
+        """return result of cache write, None if the store is not available"""
+        try:
+            return self.call_with_retries(func, *args)
+        except CircuitOpenError:
+            return None
+        except ConnectionError as e:
+            self.log.warning(f"Error saving data to cache - {e}")
+            return None
 
     def connect(self):
         try:
@@ -93,12 +213,28 @@ class Store:
         self.log.info("connected")
         return True
 
+    def ping(self):
+        """return True if store answers"""
+        try:
+            self.connection.ping(notime=True)
+        except Exception as e:
+            self.log.warning(f"ping error - {e}")
+            return False
+        return True
+
+    def close(self):
+        """close the connection, does nothing if it is not connected"""
+        if self.connection._socket is not None:
+            self.connection.close()
+
     def reconnect_after_error(self, e, attempt):
+        STORE_RECONNECTS.inc()
         self.log.info(f"connection error - {e}, reconnecting after {self.reconnect_delay} seconds, "
                       f"attempt {attempt} of {self.reconnect_n}")
         time.sleep(self.reconnect_delay)
         self.connect()
 
+    @STORE_LATENCY.time("get")
     def try_get(self, key):
         id = self.get_id(key)
         if id is None:
@@ -106,22 +242,290 @@ class Store:
         space = self.get_space(key)
         response = space.select(id)
         if not response.data:
-            return json.dumps([""])
+            return [""]
+        return response.data[0][1]
+
+    @STORE_LATENCY.time("cache_get")
+    def try_cache_get_row(self, key):
+        id = self.get_id(key)
+        space = self.get_space(key)
+        response = space.select(id)
+        if not response.data:
+            return None
+        if len(response.data[0]) < 3:
+            return None
         value = response.data[0][1]
-        return json.dumps(value)
+        valid_thru = response.data[0][2]
+        if not valid_thru:
+            return None
+        return value, self.get_expiry(valid_thru)
+
+    @STORE_LATENCY.time("get_many")
+    def try_get_many(self, keys):
+        spaces = {}
+        for key in dict.fromkeys(keys):
+            id = self.get_id(key)
+            if id is None:
+                raise ValueError("Invalid key")
+            spaces.setdefault(self.get_space_name(key), []).append((key, id))
 
+        res = {}
+        for space, items in spaces.items():
+            for start in range(0, len(items), self.batch_size):
+                batch = items[start:start + self.batch_size]
+                response = self.connection.eval(GET_MANY_LUA, space, [id for _, id in batch])
+                values = response.data[0] if response.data else []
+                for i, (key, _) in enumerate(batch):
+                    value = values[i] if i < len(values) else None
+                    res[key] = [""] if value is None else value
+        return res
+
+    @STORE_LATENCY.time("cache_set")
     def try_cache_set(self, key, value, minutes):
         id = self.get_id(key)
         if id is None:
             raise ValueError("Invalid key")
         space = self.get_space(key)
-        response = space.select(id)
-        valid_thru = datetime.datetime.today() + datetime.timedelta(minutes=minutes)
-        valid_thru = valid_thru.isoformat()
+        expires = int(time.time() + minutes * 60)
+        space.upsert((id, value, expires), [("=", 1, value), ("=", 2, expires)])
+        return True
 
-        if not response.data:
-            space.insert((id, value, valid_thru))
-        else:
-            space.update(id, [("=", 1, value), ("=", 2, valid_thru)])
+    @STORE_LATENCY.time("cache_set_many")
+    def try_cache_set_many(self, items):
+        spaces = {}
+        now = time.time()
+        for key, value, minutes in items:
+            id = self.get_id(key)
+            if id is None:
+                raise ValueError("Invalid key")
+            spaces.setdefault(self.get_space_name(key), []).append((id, value, int(now + minutes * 60)))
+
+        for space, rows in spaces.items():
+            for start in range(0, len(rows), self.batch_size):
+                self.connection.eval(UPSERT_MANY_LUA, space, rows[start:start + self.batch_size])
         return True
 
+
+def probe_store(**store_kwargs):
+    """return True if a new connection to the store answers"""
+    store = Store(reconnect_n=1, **store_kwargs)
+    try:
+        return store.connect() and store.ping()
+    finally:
+        store.close()
+
+
+class PoolTimeoutError(ConnectionError):
+    pass
+
+
+class StorePool:
+    """
+    Thread safe pool of Store connections
+    Has the Store interface, every operation checks out a connection for its duration.
+    Connections idle longer than health_check_interval seconds are pinged on checkout
+    """
+
+    thread_safe = True
+
+    def __init__(self, min_size=1, max_size=10, checkout_timeout=5, health_check_interval=30, store_factory=None,
+                 log=None, **store_kwargs):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.checkout_timeout = checkout_timeout
+        self.health_check_interval = health_check_interval
+        self.store_factory = store_factory or (lambda: Store(log=log, **store_kwargs))
+        self.log = log or logging
+        self.condition = threading.Condition()
+        # (store, checkin time), most recently used at the right
+        self.idle = deque()
+        self.size = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.health_check_failures = 0
+        for _ in range(min_size):
+            self.idle.append((self.store_factory(), time.monotonic()))
+            self.size += 1
+
+    def checkout(self):
+        deadline = time.monotonic() + self.checkout_timeout
+        with self.condition:
+            while not self.idle and self.size >= self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise PoolTimeoutError(f"No free store connection in {self.checkout_timeout} seconds")
+                self.waits += 1
+                self.condition.wait(remaining)
+            self.checkouts += 1
+            if self.idle:
+                store, checkin_time = self.idle.pop()
+            else:
+                self.size += 1
+                store, checkin_time = None, None
+
+        # the slot is released if no working connection is returned
+        try:
+            if store is not None and time.monotonic() - checkin_time >= self.health_check_interval \
+                    and not store.ping():
+                self.health_check_failures += 1
+                store.close()
+                # replaced by a new connection in the same slot
+                store = None
+            if store is None:
+                store = self.store_factory()
+        except BaseException:
+            self.discard()
+            raise
+        return store
+
+    def checkin(self, store):
+        with self.condition:
+            self.idle.append((store, time.monotonic()))
+            self.condition.notify()
+
+    def discard(self):
+        """forget checked out connection"""
+        with self.condition:
+            self.size -= 1
+            self.condition.notify()
+
+    @contextmanager
+    def connection(self):
+        store = self.checkout()
+        try:
+            yield store
+        finally:
+            self.checkin(store)
+
+    def get(self, key):
+        with self.connection() as store:
+            return store.get(key)
+
+    def get_many(self, keys):
+        with self.connection() as store:
+            return store.get_many(keys)
+
+    def cache_get(self, key):
+        try:
+            with self.connection() as store:
+                return store.cache_get(key)
+        except PoolTimeoutError as e:
+            self.log.warning(f"Error getting data from cache - {e}")
+            return None
+
+    def cache_get_entry(self, key):
+        try:
+            with self.connection() as store:
+                return store.cache_get_entry(key)
+        except PoolTimeoutError as e:
+            self.log.warning(f"Error getting data from cache - {e}")
+            return None
+
+    def cache_set(self, key, value, minutes):
+        try:
+            with self.connection() as store:
+                return store.cache_set(key, value, minutes)
+        except PoolTimeoutError as e:
+            self.log.warning(f"Error saving data to cache - {e}")
+            return None
+
+    def cache_set_many(self, items):
+        try:
+            with self.connection() as store:
+                return store.cache_set_many(items)
+        except PoolTimeoutError as e:
+            self.log.warning(f"Error saving data to cache - {e}")
+            return None
+
+    def close(self):
+        with self.condition:
+            while self.idle:
+                store, _ = self.idle.pop()
+                store.close()
+                self.size -= 1
+
+    def stats(self):
+        with self.condition:
+            return {
+                "size": self.size,
+                "idle": len(self.idle),
+                "in_use": self.size - len(self.idle),
+                "max_size": self.max_size,
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "timeouts": self.timeouts,
+                "health_check_failures": self.health_check_failures,
+            }
+
+
+class StoreProxy:
+    """
+    Base class for layers in front of a store
+    Delegates store operations to the wrapped store, child overrides the ones it serves itself
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def __getattr__(self, name):
+        if name == "store":
+            raise AttributeError(name)
+        return getattr(self.store, name)
+
+    def get(self, key):
+        return self.store.get(key)
+
+    def get_many(self, keys):
+        return self.store.get_many(keys)
+
+    def cache_get(self, key):
+        return self.store.cache_get(key)
+
+    def cache_get_entry(self, key):
+        return self.store.cache_get_entry(key)
+
+    def cache_set(self, key, value, minutes):
+        return self.store.cache_set(key, value, minutes)
+
+    def cache_set_many(self, items):
+        return self.store.cache_set_many(items)
+
+
+class PrefixRouterStore(StoreProxy):
+    """
+    Serves keys starting with a routed prefix from its store, other keys from the default store
+    e.g. {"i:": SQLiteStore(...)} keeps interests local while scoring cache stays shared
+    """
+
+    def __init__(self, store, routes):
+        super().__init__(store)
+        self.routes = routes
+
+    def route(self, key):
+        for prefix, store in self.routes.items():
+            if key.startswith(prefix):
+                return store
+        return self.store
+
+    def get(self, key):
+        return self.route(key).get(key)
+
+    def get_many(self, keys):
+        groups = {}
+        for key in keys:
+            groups.setdefault(self.route(key), []).append(key)
+        res = {}
+        for store, group in groups.items():
+            res.update(store.get_many(group))
+        return res
+
+    def cache_get(self, key):
+        return self.route(key).cache_get(key)
+
+    def cache_get_entry(self, key):
+        return self.route(key).cache_get_entry(key)
+
+    def cache_set(self, key, value, minutes):
+        return self.route(key).cache_set(key, value, minutes)
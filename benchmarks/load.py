@@ -0,0 +1,249 @@
+"""
+Load benchmark of the scoring API
+Starts the server from app/api.py with an in-memory store stand-in, drives a mix of
+online_score, admin online_score and clients_interests requests at each concurrency level
+and prints requests per second and latency percentiles as JSON.
+Arguments after -- are passed to the server as api.py command line options,
+with "-- --store memory" the server uses its own in-memory store instead of the stand-in
+
+python benchmarks/load.py -c 1,8,32 -d 5 --mix online_score=6,admin=1,clients_interests=3 -- -t 8
+"""
+
+from optparse import OptionParser
+from os.path import dirname, join
+import datetime
+import hashlib
+import http.client
+import json
+import logging
+import multiprocessing
+import random
+import signal
+import socket
+import sys
+import threading
+import time
+
+sys.path.append(join(dirname(dirname(__file__)), "app"))
+import api
+
+MIX = "online_score=6,admin=1,clients_interests=3"
+
+
+class StubStore:
+    """
+    Thread safe in-memory Store stand-in, every call waits latency seconds as a network round trip
+    """
+
+    thread_safe = True
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.cache = {}
+
+    def wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get(self, key):
+        self.wait()
+        return ["cars", "pets", "travel", "music"][:int(key[2:]) % 4 + 1]
+
+    def get_many(self, keys):
+        self.wait()
+        return {key: ["cars", "pets", "travel", "music"][:int(key[2:]) % 4 + 1] for key in keys}
+
+    def cache_get(self, key):
+        self.wait()
+        return self.cache.get(key)
+
+    def cache_get_entry(self, key):
+        value = self.cache_get(key)
+        return None if value is None else (value, datetime.datetime.max)
+
+    def cache_set(self, key, value, minutes):
+        self.wait()
+        self.cache[key] = value
+        return True
+
+    def cache_set_many(self, items):
+        self.wait()
+        for key, value, minutes in items:
+            self.cache[key] = value
+        return True
+
+    def ping(self):
+        return True
+
+    def close(self):
+        pass
+
+
+def serve(server_args, port, latency):
+    op = api.get_option_parser()
+    (opts, args) = op.parse_args(server_args + ["--port", str(port)])
+    if opts.log:
+        logging.basicConfig(filename=opts.log, level=logging.INFO,
+                            format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    if opts.store == "memory":
+        store_factory = api.StoreFactory(opts)
+    else:
+        store = StubStore(latency)
+        store_factory = api.StoreFactory(opts, lambda: store)
+    if opts.workers > 1:
+        api.serve_workers(opts, store_factory)
+    else:
+        api.run(opts, store_factory)
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("localhost", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"server did not start on port {port} in {timeout} seconds")
+
+
+def make_body(kind, rnd):
+    if kind == "admin":
+        login = api.ADMIN_LOGIN
+        token = hashlib.sha512((datetime.datetime.now().strftime("%Y%m%d%H") + api.ADMIN_SALT).encode("utf8"))
+    else:
+        login = "h&f"
+        token = hashlib.sha512(("horns&hoofs" + login + api.SALT).encode("utf8"))
+    if kind == "clients_interests":
+        method = "clients_interests"
+        arguments = {"client_ids": rnd.sample(range(1000), rnd.randint(1, 10)), "date": "20.07.2017"}
+    else:
+        method = "online_score"
+        arguments = {"phone": f"7917{rnd.randrange(10 ** 7):07d}", "email": "stupnikov@otus.ru",
+                     "first_name": "a", "last_name": "b"}
+    return json.dumps({"account": "horns&hoofs", "login": login, "method": method, "token": token.hexdigest(),
+                       "arguments": arguments}).encode("utf8")
+
+
+def make_bodies(mix, seed, n=1000):
+    """return n request bodies, kinds chosen with mix weights"""
+    rnd = random.Random(seed)
+    kinds = rnd.choices(list(mix), list(mix.values()), k=n)
+    return [make_body(kind, rnd) for kind in kinds]
+
+
+def drive(port, bodies, deadline, latencies, errors):
+    connection = http.client.HTTPConnection("localhost", port, timeout=30)
+    i = 0
+    while time.monotonic() < deadline:
+        body = bodies[i % len(bodies)]
+        i += 1
+        start = time.perf_counter()
+        try:
+            connection.request("POST", "/method", body, {"Content-Type": "application/json"})
+            response = connection.getresponse()
+            response.read()
+            if response.status != api.OK:
+                errors.append(response.status)
+        except (OSError, http.client.HTTPException):
+            errors.append(0)
+            connection.close()
+            continue
+        latencies.append(time.perf_counter() - start)
+    connection.close()
+
+
+def run_client(port, threads, duration, mix, seed):
+    """run threads connections in this process, return (latencies, errors)"""
+    bodies = make_bodies(mix, seed)
+    latencies, errors = [], []
+    deadline = time.monotonic() + duration
+    workers = [threading.Thread(target=drive, args=(port, bodies, deadline, latencies, errors))
+               for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return latencies, errors
+
+
+def percentile(values, p):
+    """nearest rank percentile of sorted values"""
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))]
+
+
+def measure(pool, processes, port, concurrency, duration, mix):
+    """run concurrency connections split between client processes, return result record"""
+    shares = [concurrency // processes + (i < concurrency % processes) for i in range(processes)]
+    start = time.monotonic()
+    results = pool.starmap(run_client, [(port, threads, duration, mix, i) for i, threads in enumerate(shares)
+                                        if threads])
+    elapsed = time.monotonic() - start
+    latencies = sorted(latency for res, _ in results for latency in res)
+    errors = sum(len(errs) for _, errs in results)
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3) if latencies else None,
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3) if latencies else None,
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3) if latencies else None,
+    }
+
+
+def main(opts, server_args):
+    mix = {kind: float(weight) for kind, _, weight in (item.partition("=") for item in opts.mix.split(","))}
+    port = opts.port or get_free_port()
+    ctx = multiprocessing.get_context("fork")
+    server = ctx.Process(target=serve, args=(server_args, port, opts.store_latency / 1000), daemon=True)
+    server.start()
+    try:
+        wait_for_port(port)
+        results = []
+        with ctx.Pool(opts.client_processes) as pool:
+            if opts.warmup:
+                measure(pool, opts.client_processes, port, 1, opts.warmup, mix)
+            for concurrency in (int(c) for c in opts.concurrency.split(",")):
+                results.append(measure(pool, opts.client_processes, port, concurrency, opts.duration, mix))
+    finally:
+        server.terminate()
+        server.join()
+    report = {"server_args": server_args, "mix": mix, "duration": opts.duration,
+              "store_latency_ms": opts.store_latency, "results": results}
+    output = json.dumps(report, indent=2)
+    if opts.output:
+        with open(opts.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    op = OptionParser(usage="%prog [options] [-- server options]")
+    op.add_option("-c", "--concurrency", action="store", default="1,8,32",
+                  help="comma separated numbers of concurrent connections")
+    op.add_option("-d", "--duration", action="store", type=float, default=5,
+                  help="seconds to drive load at each concurrency level")
+    op.add_option("--warmup", action="store", type=float, default=1,
+                  help="seconds of single connection load before measuring")
+    op.add_option("-m", "--mix", action="store", default=MIX,
+                  help="comma separated request kind=weight, kinds: online_score, admin, clients_interests")
+    op.add_option("--store-latency", action="store", type=float, default=0,
+                  help="milliseconds added to every store call")
+    op.add_option("--client-processes", action="store", type=int, default=max(1, multiprocessing.cpu_count() // 2),
+                  help="processes generating load")
+    op.add_option("-p", "--port", action="store", type=int, default=0,
+                  help="server port, free one if 0")
+    op.add_option("-o", "--output", action="store", default=None,
+                  help="also write JSON report to this file")
+    (opts, args) = op.parse_args()
+    main(opts, args)
@@ -0,0 +1,215 @@
+"""
+Micro-benchmarks of per-request hot paths: field validation, request validation, auth and scoring
+Results are compared with the baseline file, exit code is 1 if any case is slower
+than its baseline by more than the threshold.
+Case times are compared relative to a calibration loop timed in the same process, so a baseline
+recorded on a faster or slower machine still applies. Every case is timed once per round in each
+of several fresh processes, a process takes the best of its rounds and the median of the processes
+is compared, so neither a slow period of a noisy machine nor a slow process skews one case.
+The default 35% threshold is above the run to run spread measured on a shared 1 vCPU VM,
+under 20% on an unchanged tree, raise it on noisier machines.
+Relative costs of cases still differ between CPUs and Python versions: the machine a baseline
+was recorded on is saved with it and a warning is printed when it differs, re-save the baseline then
+
+python benchmarks/micro.py                 # compare with benchmarks/baseline.json
+python benchmarks/micro.py --save          # record new baseline, after changing machine or Python too
+python benchmarks/micro.py -k auth -t 0.1  # only cases with "auth" in name, 10% threshold
+"""
+
+from optparse import OptionParser
+from os.path import dirname, join
+import datetime
+import hashlib
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import timeit
+
+sys.path.append(join(dirname(dirname(__file__)), "app"))
+import api
+import scoring
+from validation import CASES
+
+BASELINE = join(dirname(__file__), "baseline.json")
+CALIBRATION = "calibration"
+USER_TOKEN = hashlib.sha512(("horns&hoofs" + "h&f" + api.SALT).encode("utf8")).hexdigest()
+
+
+class DictStore:
+    def __init__(self):
+        self.cache = {}
+
+    def cache_get(self, key):
+        return self.cache.get(key)
+
+    def cache_set(self, key, value, minutes):
+        self.cache[key] = value
+
+
+def calibration():
+    """fixed interpreter workload case times are measured in"""
+    values = {}
+    for i in range(100):
+        values[str(i)] = i * 2
+    return sum(values.values())
+
+
+def get_machine():
+    return {
+        "python": platform.python_implementation() + " " + platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+    }
+
+
+def field_case(field_cls, value):
+    field = field_cls(required=True)
+    return lambda: field.validate(value)
+
+
+def request_case(cls, arguments):
+    return lambda: cls.from_request(arguments).validate()
+
+
+def get_cases():
+    """return dict case name -> function without arguments"""
+    cases = {
+        "field_char": field_case(api.CharField, "horns&hoofs"),
+        "field_email": field_case(api.EmailField, "stupnikov@otus.ru"),
+        "field_phone": field_case(api.PhoneField, "79175002040"),
+        "field_date": field_case(api.DateField, "20.07.2017"),
+        "field_birthday": field_case(api.BirthDayField, "01.01.1990"),
+        "field_birthday_invalid": field_case(api.BirthDayField, "01.01.1890"),
+        "field_gender": field_case(api.GenderField, 1),
+        "field_client_ids": field_case(api.ClientIDsField, list(range(100))),
+    }
+    for name, (cls, arguments) in CASES.items():
+        cases[f"request_{name}"] = request_case(cls, arguments)
+
+    user = api.MethodRequest.from_request({"account": "horns&hoofs", "login": "h&f", "token": USER_TOKEN})
+    admin_token = hashlib.sha512((datetime.datetime.now().strftime("%Y%m%d%H") + api.ADMIN_SALT).encode("utf8"))
+    admin = api.MethodRequest.from_request({"login": api.ADMIN_LOGIN, "token": admin_token.hexdigest()})
+    bad = api.MethodRequest.from_request({"account": "horns&hoofs", "login": "h&f", "token": "bad"})
+    cases["auth_user"] = lambda: api.check_auth(user)
+    cases["auth_admin"] = lambda: api.check_auth(admin)
+    cases["auth_bad_token"] = lambda: api.check_auth(bad)
+
+    birthday = datetime.datetime(1990, 1, 1)
+    store = DictStore()
+    cases["score_key"] = lambda: scoring.get_score_key("79175002040", birthday, "a", "b")
+    cases["calculate_score"] = lambda: scoring.calculate_score("79175002040", "a@b.c", birthday, 1, "a", "b")
+    cases["get_score_cached"] = lambda: scoring.get_score(store, "79175002040", "a@b.c", birthday, 1, "a", "b")
+    return cases
+
+
+def compare(results, baseline, threshold):
+    """return list of (name, relative time, baseline relative time) slower than baseline by more than threshold"""
+    return [(name, rel, baseline[name]) for name, rel in results.items()
+            if name in baseline and rel > baseline[name] * (1 + threshold)]
+
+
+def load_baseline(path):
+    """return baseline dict with calibration, machine and cases, cases are times relative to calibration"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"cases": {}}
+
+
+def bench_rounds(funcs, number, rounds):
+    """
+    return dict name -> best time of one call in microseconds
+    every round times each function once, so a slow period of the machine
+    affects one round of all functions instead of every measurement of one
+    """
+
+    times = {}
+    for _ in range(rounds):
+        for name, func in funcs.items():
+            us = timeit.timeit(func, number=number) / number * 1e6
+            times[name] = min(times.get(name, us), us)
+    return times
+
+
+def measure(opts):
+    """return dict name -> best time of one call in microseconds in this process, calibration included"""
+    funcs = {name: func for name, func in get_cases().items() if not opts.keyword or opts.keyword in name}
+    return bench_rounds({CALIBRATION: calibration, **funcs}, opts.number, opts.rounds)
+
+
+def measure_processes(opts):
+    """
+    return (median calibration time in microseconds, dict case name -> median time relative to calibration)
+    over opts.processes fresh processes, speed of a case also depends on the process, e.g. on memory layout,
+    and on how busy the machine was while the process ran, a few slow processes are outvoted
+    """
+
+    args = [sys.executable, __file__, "--raw", "-n", str(opts.number), "-r", str(opts.rounds)]
+    if opts.keyword:
+        args += ["-k", opts.keyword]
+    runs = []
+    for _ in range(opts.processes):
+        runs.append(json.loads(subprocess.run(args, check=True, capture_output=True, text=True).stdout))
+    names = [name for name in runs[0] if name != CALIBRATION]
+    results = {name: round(statistics.median(run[name] / run[CALIBRATION] for run in runs), 4) for name in names}
+    return statistics.median(run[CALIBRATION] for run in runs), results
+
+
+def main(opts):
+    if opts.raw:
+        print(json.dumps(measure(opts)))
+        return 0
+    calibration_us, results = measure_processes(opts)
+    times = {name: rel * calibration_us for name, rel in results.items()}
+
+    baseline = load_baseline(opts.baseline)
+    cases = baseline["cases"]
+    machine = get_machine()
+    if cases and baseline.get("machine") != machine:
+        print(f"WARNING baseline recorded on {baseline.get('machine')}, this is {machine}, "
+              f"relative times may differ, re-save the baseline with --save")
+
+    print(f"calibration {calibration_us:.3f} us, case times are relative to it")
+    print(f"{'case':<32}{'us':>10}{'relative':>10}{'baseline':>10}{'change':>10}")
+    for name, rel in results.items():
+        base = cases.get(name)
+        change = f"{(rel / base - 1) * 100:+.1f}%" if base else "-"
+        print(f"{name:<32}{times[name]:>10.3f}{rel:>10.4f}{base or '-':>10}{change:>10}")
+
+    if opts.save:
+        cases.update(results)
+        baseline.update({"calibration_us": round(calibration_us, 3), "machine": machine, "cases": cases})
+        with open(opts.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"baseline saved to {opts.baseline}")
+        return 0
+
+    regressions = compare(results, cases, opts.threshold)
+    for name, rel, base in regressions:
+        print(f"REGRESSION {name}: {rel:.4f}, baseline {base:.4f} calibration loops, threshold {opts.threshold:.0%}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-n", "--number", action="store", type=int, default=5000,
+                  help="calls per measurement")
+    op.add_option("-r", "--rounds", action="store", type=int, default=3,
+                  help="measurements of every case in a process, the best one is used")
+    op.add_option("-p", "--processes", action="store", type=int, default=10,
+                  help="processes measuring every case, the median of them is used")
+    op.add_option("--raw", action="store_true", default=False,
+                  help="print times of this process as JSON, used by the measuring processes")
+    op.add_option("-k", "--keyword", action="store", default=None,
+                  help="run only cases with this substring in name")
+    op.add_option("-b", "--baseline", action="store", default=BASELINE)
+    op.add_option("-t", "--threshold", action="store", type=float, default=0.35,
+                  help="allowed slowdown relative to baseline, 0.35 - 35%")
+    op.add_option("--save", action="store_true", default=False,
+                  help="write results to the baseline file instead of comparing")
+    (opts, args) = op.parse_args()
+    sys.exit(main(opts))
@@ -0,0 +1,55 @@
+"""
+Micro-benchmark of request validation
+Compares validate_fields generated by MetaRequest with the generic Field.validate loop
+
+python benchmarks/validation.py -n 100000
+"""
+
+from optparse import OptionParser
+from os.path import dirname, join
+import sys
+import timeit
+
+sys.path.append(join(dirname(dirname(__file__)), "app"))
+import api
+
+CASES = {
+    "method": (api.MethodRequest, {
+        "account": "horns&hoofs", "login": "h&f", "method": "online_score",
+        "token": "55cc9ce545bcd144300fe9efc28e65d415b923ebb6be1e19d2750a2c03e80dd2",
+        "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"},
+    }),
+    "online_score": (api.OnlineScoreRequest, {
+        "phone": "79175002040", "email": "stupnikov@otus.ru", "first_name": "a", "last_name": "b",
+        "birthday": "01.01.1990", "gender": 1,
+    }),
+    "online_score_invalid": (api.OnlineScoreRequest, {
+        "phone": "89175002040", "email": "stupnikovotus.ru", "birthday": "01.01.1890", "gender": 3,
+    }),
+    "clients_interests": (api.ClientsInterestsRequest, {
+        "client_ids": list(range(100)), "date": "20.07.2017",
+    }),
+}
+
+
+def bench(func, number):
+    """return best time of one call in microseconds"""
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e6
+
+
+def main(number):
+    print(f"{'case':<24}{'generic, us':>14}{'compiled, us':>14}{'speedup':>10}")
+    for name, (cls, arguments) in CASES.items():
+        request = cls.from_request(arguments)
+        assert request.validate_fields() == request.validate_fields_generic()
+        generic = bench(request.validate_fields_generic, number)
+        compiled = bench(request.validate_fields, number)
+        print(f"{name:<24}{generic:>14.2f}{compiled:>14.2f}{generic / compiled:>9.2f}x")
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-n", "--number", action="store", type=int, default=20000,
+                  help="calls per measurement")
+    (opts, args) = op.parse_args()
+    main(opts.number)
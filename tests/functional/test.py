@@ -2,6 +2,7 @@ import unittest
 import requests
 import tests.helpers.import_app
 from app import api, store
+import socket
 import subprocess
 from os.path import dirname
 import os
@@ -233,3 +234,16 @@ class TestFunctional(unittest.TestCase):
 
 if __name__ == "__main__":
     unittest.main()
+
+
+class TestWorkers(unittest.TestCase):
+    def test_failed_workers_reported(self):
+        api_dir = os.path.join(dirname(dirname(dirname(__file__))), "app")
+        with socket.socket() as taken:
+            taken.bind(("", 0))
+            taken.listen()
+            p = subprocess.run(["python", "api.py", "-p", str(taken.getsockname()[1]), "-w", "2",
+                                "--store", "memory"], cwd=api_dir, capture_output=True, text=True, timeout=30)
+        self.assertEqual(p.returncode, 1)
+        self.assertEqual(p.stderr.count("Traceback"), 2)
+        self.assertIn("2 of 2 workers failed", p.stderr)
@@ -15,7 +15,14 @@ class TestStoreIntegration(unittest.TestCase):
     def test_available_store_get(self):
         store = self.store
         res = store.get("uid:bd9cece8db70c1d3af3661bf013ff5c6")
-        self.assertEqual(res, "0.5")
+        self.assertEqual(res, 0.5)
+
+    @unittest.skipIf(get_tarantool_address() is None, "Store not available")
+    def test_available_store_get_many(self):
+        store = self.store
+        res = store.get_many(["i:1", "uid:bd9cece8db70c1d3af3661bf013ff5c6"])
+        self.assertEqual(res["i:1"], store.get("i:1"))
+        self.assertEqual(res["uid:bd9cece8db70c1d3af3661bf013ff5c6"], 0.5)
 
     @unittest.skipIf(get_tarantool_address() is None, "Store not available")
     def test_available_cache_get(self):
@@ -33,6 +40,11 @@ class TestStoreIntegration(unittest.TestCase):
         store = self.store_na
         self.assertRaises(ConnectionError, store.get, "uid:bd9cece8db70c1d3af3661bf013ff5c6")
 
+    def test_not_available_store_get_many(self):
+        store = self.store_na
+        store.reconnect_delay = 0
+        self.assertRaises(ConnectionError, store.get_many, ["i:1", "i:2"])
+
     def test_not_available_cache_get(self):
         store = self.store_na
         store.cache_set("i:42", ["42"], 1)
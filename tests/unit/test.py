@@ -2,8 +2,30 @@ import tests.helpers.import_app
 
 from tests.helpers.cases import cases as cases
 import unittest
-from app import api, scoring
+from app import api, async_api, async_store, auth, bulk, cache, codec, expiry, logs, memstore, metrics, profiling, scoring, sqlitestore, \
+    store
+import asyncio
+import datetime
+import hashlib
+import http.client
+import io
 import json
+import logging
+import os
+import queue
+import socket
+import tempfile
+import threading
+import time
+
+
+def unused_port():
+    """return a local port nothing listens on"""
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
 
 
 def init_field(field_cls, required=False, nullable=False):
@@ -409,12 +431,71 @@ class TestClientIdsField(unittest.TestCase):
         self.assertTrue(res.is_valid)
 
 
+class TestCompiledValidator(unittest.TestCase):
+    @cases([
+        (api.MethodRequest, {}),
+        (api.MethodRequest, {"account": "horns&hoofs", "login": "h&f", "method": "", "token": "", "arguments": {}}),
+        (api.MethodRequest, {"account": 1, "login": [], "method": "online_score", "token": 2, "arguments": "x"}),
+        (api.OnlineScoreRequest, {}),
+        (api.OnlineScoreRequest, {"phone": "79175002040", "email": "stupnikov@otus.ru", "gender": 1,
+                                  "birthday": "01.01.2000", "first_name": "a", "last_name": "b"}),
+        (api.OnlineScoreRequest, {"phone": "89175002040", "email": "stupnikovotus.ru", "gender": -1,
+                                  "birthday": "01.01.1890", "first_name": 1, "last_name": 2}),
+        (api.OnlineScoreRequest, {"phone": "", "email": "", "birthday": "XXX", "gender": "1"}),
+        (api.ClientsInterestsRequest, {"client_ids": [1, 2], "date": "20.07.2017"}),
+        (api.ClientsInterestsRequest, {"client_ids": [], "date": ""}),
+        (api.ClientsInterestsRequest, {"client_ids": ["1", "2"], "date": "XXX"}),
+    ])
+    def test_same_result_as_generic(self, request_cls, arguments):
+        request = request_cls.from_request(arguments)
+        self.assertEqual(request.validate_fields(), request.validate_fields_generic())
+
+
+class TestRequestSlots(unittest.TestCase):
+    def test_no_instance_dict(self):
+        request = api.OnlineScoreRequest.from_request({"phone": "79175002040", "unknown": 1})
+        self.assertFalse(hasattr(request, "__dict__"))
+        self.assertRaises(AttributeError, setattr, request, "unknown", 1)
+
+    def test_fields_values(self):
+        method_request = api.MethodRequest.from_request({"login": "admin"})
+        request = api.OnlineScoreRequest.from_request({"phone": "79175002040"}, method_request)
+        self.assertEqual(request.phone, "79175002040")
+        self.assertIsNone(request.email)
+        self.assertIs(request.request, method_request)
+        self.assertTrue(request.request.is_admin)
+
+
+class TestCodec(unittest.TestCase):
+    @cases([
+        {"response": {1: ["sport", "music"], 2: [""]}, "code": 200},
+        {"response": {"score": 5.0}, "code": 200},
+        {"error": "Invalid fields: field 'phone', invalid value: Привет", "code": 422},
+    ])
+    def test_same_as_json(self, obj):
+        self.assertEqual(json.loads(codec.dumps(obj)), json.loads(json.dumps(obj)))
+
+    @cases([
+        b'{"account": "horns&hoofs", "arguments": {"client_ids": [1, 2]}}',
+        '{"first_name": "Стансилав"}'.encode("utf8"),
+        b'{"client_ids": [100000000000000000000000]}',
+    ])
+    def test_loads(self, data):
+        self.assertEqual(codec.loads(data), json.loads(data))
+
+    def test_loads_invalid(self):
+        self.assertRaises(ValueError, codec.loads, b"{bad")
+
+
 class MockAvailableStore:
     def __init__(self, cached_value=None):
         self.cached_value = cached_value
 
     def get(self, key):
-        return json.dumps(["sport", "music"])
+        return ["sport", "music"]
+
+    def get_many(self, keys):
+        return {key: self.get(key) for key in keys}
 
     def cache_get(self, key):
         return self.cached_value
@@ -428,6 +509,9 @@ class MockNotAvailableStore:
     def get(self, key):
         raise ConnectionError("Store not available")
 
+    def get_many(self, keys):
+        raise ConnectionError("Store not available")
+
     def cache_get(self, key):
         return None
 
@@ -467,6 +551,1581 @@ class TestGetInterestsScoreSuite(unittest.TestCase):
         store = MockNotAvailableStore()
         self.assertRaises(ConnectionError, scoring.get_interests, store, 1)
 
+    def test_get_interests_many(self):
+        store = MockAvailableStore()
+        res = scoring.get_interests_many(store, [1, 2, 2])
+        self.assertEqual(res, {1: ["sport", "music"], 2: ["sport", "music"]})
+
+    def test_get_interests_many_not_available_store(self):
+        store = MockNotAvailableStore()
+        self.assertRaises(ConnectionError, scoring.get_interests_many, store, [1, 2])
+
+
+class MockEvalConnection:
+    def __init__(self, data):
+        self.data = data
+        self.calls = []
+
+    def eval(self, expr, space, args):
+        self.calls.append((space, args))
+        if expr == store.GET_MANY_LUA:
+            return MockResponse([[self.data.get(id) for id in args]])
+        return MockResponse([len(args)])
+
+
+class MockResponse:
+    def __init__(self, data):
+        self.data = data
+
+
+class TestStoreGetMany(unittest.TestCase):
+    def setUp(self):
+        self.store = store.Store(batch_size=2)
+        self.store.connection = MockEvalConnection({1: ["cars"], 2: ["pets"], 3: ["tv"]})
+
+    def test_one_round_trip_per_batch(self):
+        res = self.store.get_many(["i:1", "i:2", "i:3", "i:4", "i:1"])
+        self.assertEqual(self.store.connection.calls, [("interests", [1, 2]), ("interests", [3, 4])])
+        self.assertEqual(res["i:3"], ["tv"])
+        self.assertEqual(res["i:4"], [""])
+        self.assertEqual(len(res), 4)
+
+    def test_invalid_key(self):
+        self.assertRaises(ValueError, self.store.get_many, ["i:1", "x:2"])
+
+    def test_cache_set_many(self):
+        self.assertTrue(self.store.cache_set_many([("uid:a", 1.5, 60), ("uid:b", 3.0, 60), ("i:1", ["tv"], 60)]))
+        calls = [(space, [row[:2] for row in rows]) for space, rows in self.store.connection.calls]
+        self.assertEqual(calls, [("scoring", [("a", 1.5), ("b", 3.0)]), ("interests", [(1, ["tv"])])])
+
+
+class MockAsyncStore:
+    def __init__(self, cached_value=None):
+        self.store = MockAvailableStore(cached_value)
+
+    async def get(self, key):
+        return self.store.get(key)
+
+    async def get_many(self, keys):
+        return self.store.get_many(keys)
+
+    async def cache_get(self, key):
+        return self.store.cache_get(key)
+
+    async def cache_set(self, key, value, minutes):
+        return self.store.cache_set(key, value, minutes)
+
+
+class MockReconnectingStore:
+    """fails every call until connect is called from the thread of the failed call"""
+
+    def __init__(self):
+        self.connected = set()
+        self.connects = []
+
+    def try_get(self, key):
+        if threading.get_ident() not in self.connected:
+            raise store.tarantool.error.NetworkError(ConnectionRefusedError(111, "refused"))
+        return ["tv"]
+
+    def try_cache_set(self, key, value, minutes):
+        self.try_get(key)
+        return True
+
+    def connect(self):
+        self.connects.append(threading.get_ident())
+        self.connected.add(threading.get_ident())
+        return True
+
+
+class TestAsyncStoreReconnect(unittest.TestCase):
+    def setUp(self):
+        self.store = async_store.AsyncStore(reconnect_n=3, reconnect_delay=0, connections=4)
+        self.backend = MockReconnectingStore()
+        self.store.get_store = lambda: self.backend
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_failed_thread_reconnects(self):
+        self.assertEqual(asyncio.run(self.store.get("i:1")), ["tv"])
+        self.assertEqual(len(self.backend.connects), 1)
+
+    def test_gives_up(self):
+        self.backend.connect = lambda: True
+        self.assertRaises(ConnectionError, asyncio.run, self.store.get("i:1"))
+        self.assertIsNone(asyncio.run(self.store.cache_set("uid:1", 1.0, 60)))
+
+
+class TestAsyncScoringSuite(unittest.TestCase):
+    def test_get_score(self):
+        store = MockAsyncStore()
+        res = asyncio.run(scoring.get_score_async(store, "79991234567", "q@q.q"))
+        self.assertEqual(res, scoring.get_score(MockAvailableStore(), "79991234567", "q@q.q"))
+        self.assertEqual(res, store.store.cached_value)
+
+    def test_get_score_from_cache(self):
+        store = MockAsyncStore(cached_value=42)
+        res = asyncio.run(scoring.get_score_async(store, "79991234567", "q@q.q"))
+        self.assertEqual(res, 42)
+
+    def test_get_interests(self):
+        res = asyncio.run(scoring.get_interests_async(MockAsyncStore(), 1))
+        self.assertEqual(res, scoring.get_interests(MockAvailableStore(), 1))
+
+
+class TestAsyncMethodHandler(unittest.TestCase):
+    def get_response(self, request, context):
+        request["token"] = hashlib.sha512((request["account"] + request["login"] + api.SALT).encode("utf8")).hexdigest()
+        return asyncio.run(async_api.method_handler({"body": request, "headers": {}}, context, MockAsyncStore()))
+
+    def test_ok_interests_request(self):
+        context = {}
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+                   "arguments": {"client_ids": [1, 2]}}
+        response, code = self.get_response(request, context)
+        self.assertEqual(code, api.OK)
+        self.assertEqual(response, {1: ["sport", "music"], 2: ["sport", "music"]})
+        self.assertEqual(context["nclients"], 2)
+
+    def test_invalid_score_request(self):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+                   "arguments": {"phone": "79175002040"}}
+        _, code = self.get_response(request, {})
+        self.assertEqual(code, api.INVALID_REQUEST)
+
+    def test_bad_auth(self):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score", "token": "",
+                   "arguments": {}}
+        _, code = asyncio.run(async_api.method_handler({"body": request, "headers": {}}, {}, MockAsyncStore()))
+        self.assertEqual(code, api.FORBIDDEN)
+
+
+class MockTimer:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestLRUCache(unittest.TestCase):
+    def setUp(self):
+        self.timer = MockTimer()
+        self.cache = cache.LRUCache(maxsize=2, timer=self.timer)
+
+    def test_get_set(self):
+        self.cache.set("a", 1)
+        self.assertEqual(self.cache.get("a"), 1)
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_lru_eviction(self):
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        self.cache.get("a")
+        self.cache.set("c", 3)
+        self.assertEqual(self.cache.get("a"), 1)
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual(self.cache.evicted, 1)
+        self.assertEqual(len(self.cache), 2)
+
+    def test_expiry(self):
+        self.cache.set("a", 1, ttl=10)
+        self.timer.now = 9
+        self.assertEqual(self.cache.get("a"), 1)
+        self.timer.now = 10
+        self.assertIsNone(self.cache.get("a"))
+        self.assertEqual(self.cache.expired, 1)
+        self.assertEqual(len(self.cache), 0)
+
+
+class MockEntryStore(MockAvailableStore):
+    def __init__(self, cached_value=None, valid_thru=None):
+        super().__init__(cached_value)
+        self.valid_thru = valid_thru
+        self.reads = 0
+
+    def cache_get_entry(self, key):
+        self.reads += 1
+        if self.cached_value is None:
+            return None
+        return self.cached_value, self.valid_thru
+
+
+class TestL1CachedStore(unittest.TestCase):
+    def test_repeat_get_served_in_process(self):
+        valid_thru = datetime.datetime.today() + datetime.timedelta(minutes=60)
+        backend = MockEntryStore(cached_value=3.0, valid_thru=valid_thru)
+        l1 = cache.L1CachedStore(backend, cache.LRUCache())
+        self.assertEqual(l1.cache_get("uid:1"), 3.0)
+        self.assertEqual(l1.cache_get("uid:1"), 3.0)
+        self.assertEqual(backend.reads, 1)
+
+    def test_expired_entry_not_cached(self):
+        valid_thru = datetime.datetime.today() - datetime.timedelta(minutes=1)
+        backend = MockEntryStore(cached_value=3.0, valid_thru=valid_thru)
+        l1 = cache.L1CachedStore(backend, cache.LRUCache())
+        self.assertIsNone(l1.cache_get("uid:1"))
+        self.assertEqual(len(l1.cache), 0)
+
+    def test_score_set_served_in_process(self):
+        backend = MockEntryStore()
+        l1 = cache.L1CachedStore(backend, cache.LRUCache())
+        score = scoring.get_score(l1, "79991234567", "q@q.q")
+        self.assertEqual(scoring.get_score(l1, "79991234567", "q@q.q"), score)
+        # no leader finished since the miss, so it is not checked again
+        self.assertEqual(backend.reads, 1)
+        self.assertEqual(backend.cached_value, score)
+
+    def test_max_ttl(self):
+        timer = MockTimer()
+        l1 = cache.L1CachedStore(MockEntryStore(), cache.LRUCache(timer=timer), max_ttl=5)
+        l1.cache_set("uid:1", 3.0, 60)
+        timer.now = 5
+        self.assertIsNone(l1.cache.get("uid:1"))
+
+
+class MockPoolStore(MockAvailableStore):
+    def __init__(self, alive=True):
+        super().__init__()
+        self.alive = alive
+        self.closed = False
+
+    def ping(self):
+        return self.alive
+
+    def close(self):
+        self.closed = True
+
+
+class TestStorePool(unittest.TestCase):
+    def test_connection_reused(self):
+        pool = store.StorePool(min_size=1, max_size=2, store_factory=MockPoolStore)
+        with pool.connection() as first:
+            pass
+        with pool.connection() as second:
+            self.assertIs(first, second)
+        self.assertEqual(pool.stats()["size"], 1)
+
+    def test_grows_up_to_max_size(self):
+        pool = store.StorePool(min_size=0, max_size=2, checkout_timeout=0.01, store_factory=MockPoolStore)
+        first, second = pool.checkout(), pool.checkout()
+        self.assertIsNot(first, second)
+        self.assertRaises(store.PoolTimeoutError, pool.checkout)
+        stats = pool.stats()
+        self.assertEqual((stats["size"], stats["in_use"], stats["timeouts"]), (2, 2, 1))
+
+    def test_waits_for_checkin(self):
+        pool = store.StorePool(min_size=0, max_size=1, checkout_timeout=5, store_factory=MockPoolStore)
+        first = pool.checkout()
+        timer = threading.Timer(0.05, pool.checkin, (first,))
+        timer.start()
+        self.assertIs(pool.checkout(), first)
+        timer.join()
+
+    def test_timeout_degrades_cache(self):
+        pool = store.StorePool(min_size=0, max_size=1, checkout_timeout=0.01, store_factory=MockPoolStore)
+        pool.checkout()
+        self.assertIsNone(pool.cache_get("uid:1"))
+        self.assertIsNone(pool.cache_set("uid:1", 1, 1))
+        self.assertRaises(ConnectionError, pool.get, "i:1")
+
+    def test_health_check(self):
+        stores = []
+
+        def store_factory():
+            stores.append(MockPoolStore(alive=len(stores) > 0))
+            return stores[-1]
+
+        pool = store.StorePool(min_size=1, max_size=1, health_check_interval=0, store_factory=store_factory)
+        with pool.connection() as conn:
+            self.assertIs(conn, stores[1])
+        self.assertTrue(stores[0].closed)
+        stats = pool.stats()
+        self.assertEqual((stats["size"], stats["in_use"], stats["health_check_failures"]), (1, 0, 1))
+
+    def test_failed_checkout_releases_slot(self):
+        available = [True]
+
+        def store_factory():
+            if not available[0]:
+                raise ConnectionError("refused")
+            return MockPoolStore(alive=False)
+
+        pool = store.StorePool(min_size=1, max_size=1, checkout_timeout=0.01, health_check_interval=0,
+                               store_factory=store_factory)
+        available[0] = False
+        self.assertRaises(ConnectionError, pool.checkout)
+        self.assertEqual(pool.stats()["in_use"], 0)
+        available[0] = True
+        self.assertIsInstance(pool.checkout(), MockPoolStore)
+
+    def test_health_check_not_connected(self):
+        port = unused_port()
+        pool = store.StorePool(min_size=1, max_size=1, checkout_timeout=0.01, health_check_interval=0, port=port,
+                               timeout=0.5, log=logging.getLogger("test"))
+        for _ in range(2):
+            with pool.connection():
+                pass
+        stats = pool.stats()
+        self.assertEqual((stats["in_use"], stats["health_check_failures"]), (0, 2))
+        pool.close()
+
+
+class MockBatchStore(MockAvailableStore):
+    def __init__(self):
+        super().__init__()
+        self.batches = []
+        self.written = threading.Event()
+
+    def cache_set_many(self, items):
+        self.batches.append(items)
+        self.written.set()
+        return True
+
+
+class TestWriteBehind(unittest.TestCase):
+    def test_coalesce_and_flush_on_close(self):
+        backend = MockBatchStore()
+        queue = cache.CacheWriteQueue(backend, batch_size=2, flush_interval=60)
+        queue.put("uid:a", 1, 60)
+        queue.put("uid:a", 2, 60)
+        queue.close()
+        self.assertEqual(backend.batches, [[("uid:a", 2, 60)]])
+        self.assertEqual((queue.queued, queue.coalesced, queue.flushed), (1, 1, 1))
+
+    def test_flush_full_batch(self):
+        backend = MockBatchStore()
+        queue = cache.CacheWriteQueue(backend, batch_size=2, flush_interval=60)
+        queue.put("uid:a", 1, 60)
+        queue.put("uid:b", 2, 60)
+        self.assertTrue(backend.written.wait(5))
+        queue.close()
+        self.assertEqual(backend.batches, [[("uid:a", 1, 60), ("uid:b", 2, 60)]])
+
+    def test_drop_over_max_pending(self):
+        backend = MockBatchStore()
+        queue = cache.CacheWriteQueue(backend, max_pending=1, flush_interval=60)
+        store = cache.WriteBehindStore(backend, queue)
+        self.assertTrue(store.cache_set("uid:a", 1, 60))
+        self.assertIsNone(store.cache_set("uid:b", 2, 60))
+        queue.close()
+        self.assertEqual(queue.dropped, 1)
+
+    def test_read_own_writes(self):
+        backend = MockBatchStore()
+        queue = cache.CacheWriteQueue(backend, flush_interval=60)
+        store = cache.WriteBehindStore(backend, queue)
+        score = scoring.get_score(store, "79991234567", "q@q.q")
+        self.assertIsNone(backend.cached_value)
+        self.assertEqual(store.cache_get(scoring.get_score_key("79991234567")), score)
+        queue.close()
+
+
+class TestAuthenticator(unittest.TestCase):
+    def setUp(self):
+        self.now = datetime.datetime(2019, 5, 1, 10, 30).timestamp()
+        self.auth = auth.Authenticator(api.SALT, api.ADMIN_SALT, timer=lambda: self.now)
+
+    def get_request(self, login, token, account="horns&hoofs"):
+        return api.MethodRequest.from_request({"account": account, "login": login, "token": token})
+
+    def test_user_digest_cached(self):
+        token = hashlib.sha512(("horns&hoofs" + "h&f" + api.SALT).encode("utf8")).hexdigest()
+        for _ in range(3):
+            self.assertTrue(self.auth.check(self.get_request("h&f", token)))
+        self.assertEqual(self.auth.stats()["hashes"], 1)
+        self.assertEqual(self.auth.stats()["hashes_saved"], 2)
+
+    def test_bad_user_token(self):
+        self.assertFalse(self.auth.check(self.get_request("h&f", "")))
+        self.assertFalse(self.auth.check(self.get_request("h&f", "Привет")))
+        self.assertEqual(len(self.auth.digests), 0)
+
+    def test_admin_digest_per_hour(self):
+        token = hashlib.sha512(("2019050110" + api.ADMIN_SALT).encode("utf8")).hexdigest()
+        self.assertTrue(self.auth.check(self.get_request("admin", token)))
+        self.now += 20 * 60
+        self.assertTrue(self.auth.check(self.get_request("admin", token)))
+        self.assertEqual(self.auth.hashes, 1)
+        self.now += 10 * 60
+        self.assertFalse(self.auth.check(self.get_request("admin", token)))
+        self.assertEqual(self.auth.hashes, 2)
+
+
+class MockCountingStore(MockAvailableStore):
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+
+    def get_many(self, keys):
+        self.calls.append(("get_many", sorted(keys)))
+        return super().get_many(keys)
+
+    def cache_get(self, key):
+        self.calls.append(("cache_get", key))
+        return super().cache_get(key)
+
+
+class TestBatchHandler(unittest.TestCase):
+    def get_item(self, method, arguments):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": method, "arguments": arguments}
+        request["token"] = hashlib.sha512((request["account"] + request["login"] + api.SALT).encode("utf8")).hexdigest()
+        return request
+
+    def get_response(self, items, store=None):
+        return api.batch_handler({"body": items, "headers": {}}, {}, store or MockAvailableStore())
+
+    def test_per_item_codes(self):
+        items = [
+            self.get_item("clients_interests", {"client_ids": [1, 2]}),
+            self.get_item("online_score", {"phone": "79175002040"}),
+            dict(self.get_item("online_score", {"phone": "79175002040", "email": "stupnikov@otus.ru"}), token=""),
+            "not a request",
+        ]
+        response, code = self.get_response(items)
+        self.assertEqual(code, api.OK)
+        self.assertEqual([r["code"] for r in response], [api.OK, api.INVALID_REQUEST, api.FORBIDDEN,
+                                                         api.INVALID_REQUEST])
+        self.assertEqual(response[0]["response"], {1: ["sport", "music"], 2: ["sport", "music"]})
+
+    def test_shared_lookups(self):
+        store = MockCountingStore()
+        items = [self.get_item("clients_interests", {"client_ids": [1, 2]}) for _ in range(5)]
+        items += [self.get_item("online_score", {"phone": "79175002040", "email": "stupnikov@otus.ru"})
+                  for _ in range(5)]
+        response, code = self.get_response(items, store)
+        self.assertEqual([r["code"] for r in response], [api.OK] * 10)
+        self.assertEqual(sorted(c[0] for c in store.calls), ["cache_get", "get_many"])
+
+    @cases([
+        {"method": "online_score"},
+        [{}] * (api.MAX_BATCH_SIZE + 1),
+    ])
+    def test_invalid_batch(self, items):
+        _, code = self.get_response(items)
+        self.assertEqual(code, api.INVALID_REQUEST)
+
+
+class TestScoringHTTPServer(unittest.TestCase):
+    def setUp(self):
+        self.server = api.ScoringHTTPServer(("localhost", 0), api.MainHTTPHandler, MockAvailableStore)
+
+    def tearDown(self):
+        self.server.server_close()
+
+    def test_same_store_in_thread(self):
+        self.assertIs(self.server.store, self.server.store)
+
+    def test_own_store_per_thread(self):
+        stores = []
+        thread = threading.Thread(target=lambda: stores.append(self.server.store))
+        thread.start()
+        thread.join()
+        self.assertIsInstance(stores[0], MockAvailableStore)
+        self.assertIsNot(stores[0], self.server.store)
+
+
+class TestMemoryStore(unittest.TestCase):
+    def setUp(self):
+        self.timer = MockTimer()
+        self.timer.now = time.time()
+        self.store = memstore.MemoryStore(max_entries=3, sweep_interval=0, timer=self.timer)
+
+    def test_get(self):
+        self.store.set("i:1", ["sport", "music"])
+        self.assertEqual(self.store.get("i:1"), ["sport", "music"])
+        self.assertEqual(self.store.get("i:2"), [""])
+        self.assertEqual(self.store.get_many(["i:1", "i:2"]), {"i:1": ["sport", "music"], "i:2": [""]})
+        self.assertRaises(ValueError, self.store.get, "x:1")
+
+    def test_cache(self):
+        self.assertIsNone(self.store.cache_get("uid:a"))
+        self.assertTrue(self.store.cache_set("uid:a", 3.0, 60))
+        self.assertEqual(self.store.cache_get("uid:a"), 3.0)
+        value, valid_thru = self.store.cache_get_entry("uid:a")
+        self.assertEqual(value, 3.0)
+        self.assertEqual(valid_thru, datetime.datetime.fromtimestamp(self.timer.now + 3600))
+        self.assertIsNone(self.store.cache_get("x:a"))
+        self.assertIsNone(self.store.cache_set("x:a", 1, 60))
+
+    def test_expired_entries_removed(self):
+        self.store.set("i:1", ["sport"])
+        self.store.cache_set_many([("uid:a", 1.0, 1), ("uid:b", 2.0, 10)])
+        self.timer.now += 5 * 60
+        self.store.sweep()
+        self.assertEqual(len(self.store), 2)
+        self.assertIsNone(self.store.cache_get_entry("uid:a"))
+        self.assertEqual(self.store.cache_get("uid:b"), 2.0)
+        self.assertEqual(self.store.get("i:1"), ["sport"])
+        self.assertEqual(self.store.stats()["expired"], 1)
+
+    def test_overwritten_entry_not_expired_by_old_ttl(self):
+        self.store.cache_set("uid:a", 1.0, 1)
+        self.store.cache_set("uid:a", 2.0, 10)
+        self.timer.now += 5 * 60
+        self.store.sweep()
+        self.assertEqual(self.store.cache_get("uid:a"), 2.0)
+
+    def test_bounded(self):
+        self.store.set("i:1", ["sport"])
+        self.store.cache_set("uid:a", 1.0, 10)
+        self.store.cache_set("uid:b", 2.0, 1)
+        self.store.cache_set("uid:c", 3.0, 5)
+        # closest to expiry is evicted
+        self.assertEqual(len(self.store), 3)
+        self.assertIsNone(self.store.cache_get("uid:b"))
+        self.store.set("i:2", ["music"])
+        self.store.set("i:3", ["cars"])
+        self.store.set("i:4", ["pets"])
+        self.assertEqual(len(self.store), 3)
+        self.assertEqual(self.store.get("i:1"), [""])
+        self.assertEqual(self.store.stats()["evicted"], 4)
+
+    def test_stale_heap_compacted(self):
+        for i in range(200):
+            self.store.cache_set("uid:a", float(i), 10 + i)
+        self.assertLess(len(self.store.heap), 70)
+
+    def test_sweeper_thread(self):
+        store = memstore.MemoryStore(sweep_interval=0.01)
+        store.cache_set("uid:a", 1.0, -1)
+        for _ in range(100):
+            if not len(store):
+                break
+            time.sleep(0.01)
+        store.close()
+        self.assertEqual(len(store), 0)
+
+
+class TestSQLiteStore(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "interests.db")
+        self.store = sqlitestore.SQLiteStore(self.path)
+        sqlitestore.import_interests(self.path, [(1, ["sport", "music"]), (2, ["cars"])])
+
+    def tearDown(self):
+        self.store.close()
+        self.dir.cleanup()
+
+    def test_get(self):
+        self.assertEqual(self.store.get("i:1"), ["sport", "music"])
+        self.assertEqual(self.store.get("i:3"), [""])
+        self.assertRaises(ValueError, self.store.get, "uid:1")
+
+    def test_get_many(self):
+        self.assertEqual(self.store.get_many(["i:1", "i:2", "i:3", "i:1"]),
+                         {"i:1": ["sport", "music"], "i:2": ["cars"], "i:3": [""]})
+        keys = ["i:%s" % i for i in range(2000)]
+        self.assertEqual(len(self.store.get_many(keys)), 2000)
+
+    def test_import(self):
+        lines = ['{"id": 2, "interests": ["pets"]}', "", '{"id": 3, "interests": []}']
+        self.assertEqual(sqlitestore.import_interests(self.path, sqlitestore.read_jsonl(lines)), 2)
+        self.assertEqual(self.store.get_many(["i:1", "i:2", "i:3"]),
+                         {"i:1": ["sport", "music"], "i:2": ["pets"], "i:3": []})
+        sqlitestore.import_interests(self.path, [(4, ["books"])], replace=True)
+        self.assertEqual(self.store.get_many(["i:1", "i:4"]), {"i:1": [""], "i:4": ["books"]})
+
+    def test_failed_import_rolled_back(self):
+        with self.assertRaises(ValueError):
+            sqlitestore.import_interests(self.path, [(5, ["books"]), ("x", [])], replace=True)
+        self.assertEqual(self.store.get("i:1"), ["sport", "music"])
+        self.assertEqual(self.store.get("i:5"), [""])
+
+    def test_readonly(self):
+        self.assertRaises(sqlitestore.sqlite3.OperationalError, self.store.connection.execute,
+                          "DELETE FROM interests")
+
+
+class TestPrefixRouterStore(unittest.TestCase):
+    def setUp(self):
+        self.local = memstore.MemoryStore(sweep_interval=0)
+        self.local.set("i:1", ["local"])
+        self.shared = MockAvailableStore(3.0)
+        self.store = store.PrefixRouterStore(self.shared, {"i:": self.local})
+
+    def test_routes(self):
+        self.assertEqual(self.store.get("i:1"), ["local"])
+        self.assertEqual(self.store.get("uid:1"), ["sport", "music"])
+        self.assertEqual(self.store.get_many(["i:1", "uid:1"]), {"i:1": ["local"], "uid:1": ["sport", "music"]})
+        self.assertEqual(self.store.cache_get("uid:1"), 3.0)
+        self.store.cache_set("uid:1", 4.0, 60)
+        self.assertEqual(self.shared.cached_value, 4.0)
+        self.assertEqual(len(self.local), 1)
+
+    def test_interests_served_locally(self):
+        self.assertEqual(scoring.get_interests_many(self.store, [1]), {1: ["local"]})
+
+
+class MockFailingConnection:
+    def __init__(self):
+        self.available = False
+        self.closed = 0
+        # connected socket, see Store.close
+        self._socket = object()
+
+    def space(self, name):
+        return self
+
+    def select(self, id):
+        if not self.available:
+            raise store.tarantool.error.NetworkError(ConnectionRefusedError(111, "refused"))
+        return MockResponse([])
+
+    def upsert(self, row, ops):
+        self.select(row[0])
+
+    def eval(self, expr, *args):
+        return self.select(None)
+
+    def close(self):
+        self.closed += 1
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def setUp(self):
+        self.available = False
+        self.breaker = api.CircuitBreaker(lambda: self.available, failure_threshold=2, backoff=0.001,
+                                          max_backoff=0.01)
+
+    def tearDown(self):
+        self.breaker.close()
+
+    def wait_reconnector(self):
+        self.breaker.reconnector.join(5)
+        self.assertFalse(self.breaker.reconnector.is_alive())
+
+    def test_opens_after_threshold(self):
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, "closed")
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, "open")
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.rejected, 1)
+
+    def test_recovery(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        time.sleep(0.05)
+        self.assertEqual(self.breaker.state, "open")
+        self.assertGreater(self.breaker.probes, 1)
+        self.available = True
+        self.wait_reconnector()
+        self.assertEqual(self.breaker.state, "half_open")
+        self.assertTrue(self.breaker.allow())
+        # one trial call at a time
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, "closed")
+        self.assertEqual(list(self.breaker.transitions), [("closed", "open"), ("open", "half_open"),
+                                                          ("half_open", "closed")])
+
+    def test_transitions_bounded(self):
+        breaker = api.CircuitBreaker(lambda: False, max_transitions=2)
+        for state in ("open", "half_open", "closed"):
+            breaker.transition(state)
+        self.assertEqual(list(breaker.transitions), [("open", "half_open"), ("half_open", "closed")])
+        self.assertEqual(breaker.stats()["transitions"], 3)
+
+    def test_failed_trial_opens(self):
+        self.available = True
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.wait_reconnector()
+        self.assertTrue(self.breaker.allow())
+        self.breaker.release()
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, "open")
+        self.wait_reconnector()
+
+    @cases([(0, 0, 0.5), (0, 1, 1), (3, 0, 4), (10, 1, 30)])
+    def test_backoff_with_jitter(self, attempt, random, delay):
+        breaker = api.CircuitBreaker(None, backoff=1, max_backoff=30, random=lambda: random)
+        self.assertEqual(breaker.get_delay(attempt), delay)
+
+
+class MockSpaceConnection:
+    """scoring space of (id, value, valid_thru) tuples, Lua scripts are run in Python"""
+
+    def __init__(self, rows=()):
+        self.rows = {row[0]: tuple(row) for row in rows}
+        self.evals = 0
+
+    def space(self, name):
+        return self
+
+    def select(self, id):
+        row = self.rows.get(id)
+        return MockResponse([row] if row else [])
+
+    def upsert(self, row, ops):
+        self.rows[row[0]] = tuple(row)
+
+    def walk(self, after, limit):
+        ids = sorted(id for id in self.rows if after is None or id > after)
+        batch = ids[:limit]
+        return batch, batch[-1] if len(batch) == limit else None
+
+    def eval(self, expr, space, *args):
+        self.evals += 1
+        if expr == expiry.EXPIRE_LUA:
+            after, limit, now = args
+            batch, last = self.walk(after, limit)
+            expired = [id for id in batch if not isinstance(self.rows[id][2], str) and self.rows[id][2] < now]
+            for id in expired:
+                del self.rows[id]
+            return MockResponse([[len(expired), last]])
+        if expr == expiry.SCAN_ISO_LUA:
+            after, limit = args
+            batch, last = self.walk(after, limit)
+            return MockResponse([[[[id, self.rows[id][2]] for id in batch if isinstance(self.rows[id][2], str)], last]])
+        if expr == expiry.UPDATE_TTL_LUA:
+            updated = 0
+            for id, old, new in args[0]:
+                if id in self.rows and self.rows[id][2] == old:
+                    self.rows[id] = self.rows[id][:2] + (new,)
+                    updated += 1
+            return MockResponse([updated])
+        raise ValueError(expr)
+
+    def close(self):
+        pass
+
+
+class TestEpochTTL(unittest.TestCase):
+    def setUp(self):
+        self.store = store.Store()
+        self.store.connection = MockSpaceConnection()
+
+    def test_cache_set_writes_epoch(self):
+        self.assertTrue(self.store.cache_set("uid:a", 1.5, 60))
+        id, value, expires = self.store.connection.rows["a"]
+        self.assertEqual(value, 1.5)
+        self.assertIsInstance(expires, int)
+        self.assertAlmostEqual(expires, time.time() + 3600, delta=2)
+        self.assertEqual(self.store.cache_get("uid:a"), 1.5)
+
+    def test_expired(self):
+        self.store.connection.rows["a"] = ("a", 1.5, int(time.time()) - 1)
+        self.assertIsNone(self.store.cache_get("uid:a"))
+        value, valid_thru = self.store.cache_get_entry("uid:a")
+        self.assertEqual(value, 1.5)
+        self.assertLess(valid_thru, datetime.datetime.today())
+
+    def test_reads_iso_valid_thru(self):
+        valid_thru = datetime.datetime.today() + datetime.timedelta(minutes=10)
+        self.store.connection.rows["a"] = ("a", 1.5, valid_thru.isoformat())
+        self.store.connection.rows["b"] = ("b", 3.0, (valid_thru - datetime.timedelta(hours=1)).isoformat())
+        self.assertEqual(self.store.cache_get("uid:a"), 1.5)
+        self.assertEqual(self.store.cache_get_entry("uid:a"), (1.5, valid_thru))
+        self.assertIsNone(self.store.cache_get("uid:b"))
+
+
+class TestExpiry(unittest.TestCase):
+    def setUp(self):
+        self.now = int(time.time())
+        self.store = store.Store()
+        self.store.connection = MockSpaceConnection([
+            ("a", 1.0, self.now - 100),
+            ("b", 2.0, self.now + 100),
+            ("c", 3.0, self.now - 10),
+            ("d", 4.0, datetime.datetime.fromtimestamp(self.now - 100).isoformat()),
+            ("e", 5.0, self.now - 100),
+        ])
+
+    def test_expire_in_batches(self):
+        self.assertEqual(expiry.expire(self.store, batch_size=2, now=self.now), 3)
+        self.assertEqual(sorted(self.store.connection.rows), ["b", "d"])
+        self.assertEqual(self.store.connection.evals, 3)
+
+    def test_migrate(self):
+        self.assertEqual(expiry.migrate(self.store, batch_size=2), 1)
+        self.assertEqual(self.store.connection.rows["d"][2], self.now - 100)
+        self.assertEqual(expiry.migrate(self.store, batch_size=2), 0)
+        self.assertEqual(expiry.expire(self.store, now=self.now), 4)
+        self.assertEqual(list(self.store.connection.rows), ["b"])
+
+    def test_sweeper_keeps_stale_within_grace(self):
+        sweeper = expiry.ExpirySweeper(self.store, batch_size=2, pause=0, grace=60)
+        sweeper.sweep()
+        self.assertEqual(sorted(self.store.connection.rows), ["b", "c", "d"])
+        self.assertEqual(sweeper.stats(), {"sweeps": 1, "deleted": 2, "failed": 0})
+
+    def test_sweeper_error(self):
+        sweeper = expiry.ExpirySweeper(self.store, log=logging.getLogger("test"))
+        self.store.connection = MockFailingConnection()
+        self.store.connection.eval = lambda *args: self.store.connection.select(None)
+        sweeper.sweep()
+        self.assertEqual(sweeper.stats(), {"sweeps": 0, "deleted": 0, "failed": 1})
+        self.assertEqual(self.store.connection.closed, 1)
+
+    def test_sweeper_not_connected(self):
+        port = unused_port()
+        sweeper = expiry.ExpirySweeper(store.Store(port=port, timeout=0.5), log=logging.getLogger("test"))
+        sweeper.close()
+        sweeper.sweep()
+        sweeper.sweep()
+        self.assertEqual(sweeper.stats(), {"sweeps": 0, "deleted": 0, "failed": 2})
+        sweeper.close()
+
+
+class TestBulkScoring(unittest.TestCase):
+    ROWS = [
+        {"id": 1, "phone": "79175002040", "email": "stupnikov@otus.ru"},
+        {"phone": 79175002040, "email": "stupnikov@otus.ru", "gender": 1, "birthday": "01.01.2000",
+         "first_name": "a", "last_name": "b"},
+        {"gender": 0, "birthday": "01.01.2000"},
+        {"phone": "89175002040", "email": "stupnikov@otus.ru"},
+        {"first_name": "a"},
+    ]
+
+    def tearDown(self):
+        bulk.seed_store = None
+
+    def run_bulk(self, items, **kwargs):
+        out = io.StringIO()
+        rows, invalid, _ = bulk.run(items, out, **kwargs)
+        return [json.loads(line) for line in out.getvalue().splitlines()], rows, invalid
+
+    def test_score_by_mask(self):
+        for row in self.ROWS[:3]:
+            expected = scoring.calculate_score(*(row.get(name) for name in bulk.SCORE_FIELDS))
+            self.assertEqual(bulk.SCORE_BY_MASK[bulk.get_mask(row)], expected)
+
+    def test_jsonl(self):
+        lines = [json.dumps(row) + "\n" for row in self.ROWS] + ["\n", "[1]\n", "{\n"]
+        records, rows, invalid = self.run_bulk(bulk.read_jsonl(lines), batch_size=2)
+        self.assertEqual((rows, invalid), (7, 4))
+        self.assertEqual(records[:3], [{"line": 1, "id": 1, "score": 3.0}, {"line": 2, "score": 5.0},
+                                       {"line": 3, "score": 0}])
+        self.assertIn("phone", records[3]["error"])
+        self.assertIn("value pairs", records[4]["error"])
+        self.assertEqual(records[5:], [{"line": 7, "error": "Row must be an object"},
+                                       {"line": 8, "error": "Invalid JSON"}])
+
+    def test_csv(self):
+        data = "phone,email,gender,birthday\n79175002040,stupnikov@otus.ru,1,01.01.2000\n,,x,\n"
+        records, rows, invalid = self.run_bulk(bulk.read_csv(io.StringIO(data)))
+        self.assertEqual(records[0], {"line": 1, "score": 4.5})
+        self.assertIn("gender", records[1]["error"])
+
+    def test_pool_keeps_order(self):
+        lines = [json.dumps(row) + "\n" for row in self.ROWS] * 4
+        expected, _, _ = self.run_bulk(bulk.read_jsonl(lines), batch_size=3)
+        records, rows, _ = self.run_bulk(bulk.read_jsonl(lines), jobs=2, batch_size=3)
+        self.assertEqual(rows, 20)
+        self.assertEqual(records, expected)
+
+    def test_seed_cache(self):
+        bulk.seed_store = MockBatchStore()
+        bulk.score_batch(list(enumerate(self.ROWS, 1)))
+        key = scoring.get_score_key("79175002040", None, None, None)
+        self.assertEqual(bulk.seed_store.batches, [[(key, 3.0, scoring.SCORE_CACHE_MINUTES),
+                                                    (scoring.get_score_key(79175002040, datetime.date(2000, 1, 1),
+                                                                           "a", "b"), 5.0, scoring.SCORE_CACHE_MINUTES),
+                                                    (scoring.get_score_key(None, datetime.date(2000, 1, 1)), 0,
+                                                     scoring.SCORE_CACHE_MINUTES)]])
+
+
+class TestStoreRetries(unittest.TestCase):
+    def setUp(self):
+        self.store = store.Store(reconnect_n=2, reconnect_delay=0, log=logging.getLogger("test"))
+        self.store.connection = MockFailingConnection()
+
+    def test_retried_then_failed(self):
+        reconnects = store.STORE_RECONNECTS.value()
+        self.assertRaises(ConnectionError, self.store.get, "i:1")
+        self.assertRaises(ConnectionError, self.store.get_many, ["i:1"])
+        self.assertIsNone(self.store.cache_set("uid:1", 1, 60))
+        self.assertEqual(store.STORE_RECONNECTS.value() - reconnects, 6)
+
+    def test_recovered(self):
+        self.store.connect = lambda: setattr(self.store.connection, "available", True)
+        self.assertEqual(self.store.get("i:1"), [""])
+        self.assertTrue(self.store.cache_set("uid:1", 1, 60))
+
+
+class TestStoreBreaker(unittest.TestCase):
+    def setUp(self):
+        self.breaker = api.CircuitBreaker(lambda: False, failure_threshold=2, backoff=60)
+        self.store = store.Store(breaker=self.breaker)
+        self.store.connection = MockFailingConnection()
+
+    def tearDown(self):
+        self.breaker.close()
+
+    def test_fail_fast(self):
+        self.assertRaises(ConnectionError, self.store.get, "i:1")
+        self.assertIsNone(self.store.cache_set("uid:1", 1, 60))
+        self.assertEqual(self.breaker.state, "open")
+        self.assertEqual(self.store.connection.closed, 2)
+        self.assertRaises(store.CircuitOpenError, self.store.get, "i:1")
+        self.assertRaises(store.CircuitOpenError, self.store.get_many, ["i:1"])
+        self.assertIsNone(self.store.cache_get("uid:1"))
+        self.assertIsNone(self.store.cache_set("uid:1", 1, 60))
+        self.assertEqual(self.breaker.rejected, 4)
+
+    def test_not_connected(self):
+        port = unused_port()
+        self.store = store.Store(port=port, timeout=0.5, breaker=self.breaker, log=logging.getLogger("test"))
+        self.store.close()
+        self.assertRaises(ConnectionError, self.store.get, "i:1")
+        self.assertRaises(ConnectionError, self.store.get, "i:1")
+        self.assertEqual(self.breaker.state, "open")
+        self.assertRaises(store.CircuitOpenError, self.store.get, "i:1")
+        self.store.close()
+
+    def test_success_resets_failures(self):
+        self.assertRaises(ConnectionError, self.store.get, "i:1")
+        self.store.connection.available = True
+        self.assertEqual(self.store.get("i:1"), [""])
+        self.assertIsNone(self.store.cache_get("uid:1"))
+        self.assertEqual(self.breaker.failures, 0)
+
+
+class TestSingleFlight(unittest.TestCase):
+    def setUp(self):
+        self.flight = cache.SingleFlight(timeout=5)
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.calls = 0
+
+    def slow(self, value):
+        self.calls += 1
+        self.started.set()
+        self.release.wait(5)
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+    def run_concurrently(self, n, value):
+        results = []
+
+        def call():
+            try:
+                results.append(self.flight.do("uid:1", self.slow, value))
+            except Exception as e:
+                results.append(e)
+
+        threads = [threading.Thread(target=call) for _ in range(n)]
+        threads[0].start()
+        self.started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        while self.flight.waiting < n - 1:
+            time.sleep(0.001)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_one_call_per_key(self):
+        self.assertEqual(self.run_concurrently(5, 3.0), [3.0] * 5)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.flight.stats(), {"in_flight": 0, "waiting": 0, "leaders": 1, "coalesced": 4,
+                                               "timeouts": 0})
+        self.assertEqual(self.flight.do("uid:1", self.slow, 4.0), 4.0)
+        self.assertEqual(self.calls, 2)
+
+    def test_error_shared(self):
+        error = ConnectionError("store not available")
+        self.assertEqual(self.run_concurrently(3, error), [error] * 3)
+        self.assertEqual(self.calls, 1)
+
+    def test_timeout(self):
+        self.flight.timeout = 0.01
+        thread = threading.Thread(target=self.flight.do, args=("uid:1", self.slow, 3.0))
+        thread.start()
+        self.started.wait(5)
+        self.assertEqual(self.flight.do("uid:1", lambda: 4.0), 4.0)
+        self.release.set()
+        thread.join()
+        self.assertEqual(self.flight.timeouts, 1)
+
+    def test_get_score_coalesced(self):
+        store = MockCountingStore()
+        store.cache_set = lambda key, value, minutes: self.slow(value)
+        scoring.score_flight, flight = self.flight, scoring.score_flight
+        try:
+            results = []
+            threads = [threading.Thread(target=lambda: results.append(scoring.get_score(store, "79175002040", "a@b.c")))
+                       for _ in range(4)]
+            threads[0].start()
+            self.started.wait(5)
+            for thread in threads[1:]:
+                thread.start()
+            while self.flight.waiting < 3:
+                time.sleep(0.001)
+            self.release.set()
+            for thread in threads:
+                thread.join()
+        finally:
+            scoring.score_flight = flight
+        self.assertEqual(results, [3.0] * 4)
+        # every caller checks cache before waiting, the leader does not check it again
+        self.assertEqual(store.calls, [("cache_get", scoring.get_score_key("79175002040"))] * 4)
+        self.assertEqual(self.calls, 1)
+
+    def test_get_score_hit_skips_single_flight(self):
+        scoring.score_flight, flight = self.flight, scoring.score_flight
+        try:
+            self.assertEqual(scoring.get_score(MockAvailableStore(2.0), "79175002040", "a@b.c"), 2.0)
+        finally:
+            scoring.score_flight = flight
+        self.assertEqual(self.flight.leaders, 0)
+
+    def test_finished_since(self):
+        self.flight.max_finished = 1
+        mark = self.flight.mark()
+        self.assertFalse(self.flight.finished_since("uid:1", mark))
+        self.flight.do("uid:1", lambda: 1.0)
+        self.assertTrue(self.flight.finished_since("uid:1", mark))
+        self.assertFalse(self.flight.finished_since("uid:2", mark))
+        self.assertFalse(self.flight.finished_since("uid:1", self.flight.mark()))
+        self.flight.do("uid:2", lambda: 2.0)
+        # forgotten calls may have finished after the mark
+        self.assertTrue(self.flight.finished_since("uid:3", mark))
+
+    def test_load_score_rechecks_after_leader(self):
+        key = scoring.get_score_key("79175002040")
+        store = MockAvailableStore(2.0)
+        scoring.score_flight, flight = self.flight, scoring.score_flight
+        try:
+            mark = self.flight.mark()
+            self.assertEqual(scoring.load_score(store, key, mark, "79175002040", "a@b.c"), 3.0)
+            store.cached_value = 2.0
+            self.flight.do(key, lambda: 2.0)
+            self.assertEqual(scoring.load_score(store, key, mark, "79175002040", "a@b.c"), 2.0)
+        finally:
+            scoring.score_flight = flight
+
+
+class TestStaleWhileRevalidate(unittest.TestCase):
+    def setUp(self):
+        self.store = MockEntryStore(3.0)
+        self.revalidator = cache.Revalidator(lambda: self.store, grace=60, threads=1)
+        scoring.revalidator = self.revalidator
+
+    def tearDown(self):
+        scoring.revalidator = None
+        self.revalidator.close()
+
+    def get_score(self):
+        return scoring.get_score(self.store, "79175002040", "a@b.c", first_name="a", last_name="b")
+
+    def expired(self, seconds):
+        return datetime.datetime.today() - datetime.timedelta(seconds=seconds)
+
+    def test_fresh(self):
+        self.store.valid_thru = datetime.datetime.today() + datetime.timedelta(minutes=1)
+        self.assertEqual(self.get_score(), 3.0)
+        self.assertEqual(self.revalidator.scheduled, 0)
+
+    def test_stale_served_and_refreshed(self):
+        self.store.valid_thru = self.expired(10)
+        before = scoring.SCORE_CACHE.value("stale")
+        self.assertEqual(self.get_score(), 3.0)
+        self.revalidator.close()
+        self.assertEqual(self.revalidator.scheduled, 1)
+        self.assertEqual(self.store.cached_value, 3.5)
+        self.assertEqual(scoring.SCORE_CACHE.value("stale") - before, 1)
+
+    def test_expired_past_grace_computed(self):
+        self.store.valid_thru = self.expired(120)
+        self.assertEqual(self.get_score(), 3.5)
+        self.assertEqual(self.revalidator.scheduled, 0)
+
+    def test_missing_computed(self):
+        self.store.cached_value = None
+        self.assertEqual(self.get_score(), 3.5)
+        self.assertEqual(self.store.cached_value, 3.5)
+
+    def test_refresh_scheduled_once(self):
+        started, release = threading.Event(), threading.Event()
+
+        def refresh(store):
+            started.set()
+            release.wait(5)
+
+        self.assertTrue(self.revalidator.schedule("uid:1", refresh))
+        started.wait(5)
+        self.assertFalse(self.revalidator.schedule("uid:1", refresh))
+        self.revalidator.max_pending = 1
+        self.assertFalse(self.revalidator.schedule("uid:2", refresh))
+        release.set()
+        self.revalidator.close()
+        self.assertEqual(self.revalidator.stats(), {"pending": 0, "scheduled": 1, "dropped": 1, "failed": 0})
+
+    def test_refresh_error(self):
+        with self.assertLogs(level="WARNING"):
+            self.revalidator.schedule("uid:1", lambda store: 1 / 0)
+            self.revalidator.close()
+        self.assertEqual(self.revalidator.failed, 1)
+        self.assertEqual(self.revalidator.pending, set())
+
+    def test_l1_keeps_entries(self):
+        valid_thru = datetime.datetime.today() + datetime.timedelta(minutes=1)
+        self.store.valid_thru = valid_thru
+        l1 = cache.L1CachedStore(self.store, cache.LRUCache())
+        self.assertEqual(l1.cache_get_entry("uid:1"), (3.0, valid_thru))
+        self.assertEqual(l1.cache_get_entry("uid:1"), (3.0, valid_thru))
+        self.assertEqual(self.store.reads, 1)
+        self.store.valid_thru = self.expired(10)
+        l1.cache.clear()
+        self.assertEqual(l1.cache_get_entry("uid:1"), (3.0, self.store.valid_thru))
+        self.assertEqual(len(l1.cache), 0)
+
+    def test_write_behind_entry(self):
+        queue = cache.CacheWriteQueue(self.store, flush_interval=60)
+        write_behind = cache.WriteBehindStore(self.store, queue)
+        write_behind.cache_set("uid:1", 4.0, 60)
+        value, valid_thru = write_behind.cache_get_entry("uid:1")
+        self.assertEqual(value, 4.0)
+        self.assertGreater(valid_thru, datetime.datetime.today() + datetime.timedelta(minutes=59))
+        queue.close()
+
+
+class TestStoreFactory(unittest.TestCase):
+    def get_factory(self, *args):
+        (opts, _) = api.get_option_parser().parse_args(list(args))
+        return api.StoreFactory(opts, MockAvailableStore)
+
+    def test_store_per_call(self):
+        store_factory = self.get_factory()
+        self.assertIsInstance(store_factory(), MockAvailableStore)
+        self.assertIsNot(store_factory(), store_factory())
+
+    def test_shared_layers(self):
+        store_factory = self.get_factory("--pool-max", "2", "--l1-size", "10")
+        store = store_factory()
+        self.assertIs(store, store_factory())
+        self.assertIsInstance(store, api.L1CachedStore)
+        self.assertIsInstance(store_factory.pool.checkout(), MockAvailableStore)
+
+    def test_interests_db(self):
+        with tempfile.TemporaryDirectory() as dir:
+            store_factory = self.get_factory("--interests-db", os.path.join(dir, "interests.db"))
+            store = store_factory()
+            self.assertIsInstance(store, api.PrefixRouterStore)
+            self.assertEqual(store.get("i:1"), [""])
+            self.assertEqual(store.get("uid:1"), ["sport", "music"])
+            store_factory.close()
+
+    def metrics_of(self, store_factory):
+        api.serving_store_factory, serving = store_factory, api.serving_store_factory
+        try:
+            return api.metrics.REGISTRY.render()
+        finally:
+            api.serving_store_factory = serving
+
+    def test_write_queue_exported(self):
+        (opts, _) = api.get_option_parser().parse_args(["--write-behind", "--write-queue-size", "1"])
+        store_factory = api.StoreFactory(opts, MockBatchStore)
+        store = store_factory()
+        store.cache_set("uid:1", 1.0, 60)
+        store.cache_set("uid:1", 2.0, 60)
+        store.cache_set("uid:2", 1.0, 60)
+        store_factory.close()
+        text = self.metrics_of(store_factory)
+        self.assertIn("cache_writes_queued_total 1\n", text)
+        self.assertIn("cache_writes_coalesced_total 1\n", text)
+        self.assertIn("cache_writes_dropped_total 1\n", text)
+        self.assertIn("cache_writes_flushed_total 1\n", text)
+        self.assertIn("cache_write_queue_pending 0\n", text)
+        self.assertIn("cache_writes_failed_total 0\n", self.metrics_of(self.get_factory()))
+
+    def test_l1_cache_exported(self):
+        (opts, _) = api.get_option_parser().parse_args(["--l1-size", "10"])
+        store_factory = api.StoreFactory(opts, MockEntryStore)
+        store = store_factory()
+        store.cache_get("uid:2")
+        store.cache_set("uid:1", 1.0, 60)
+        store.cache_get("uid:1")
+        text = self.metrics_of(store_factory)
+        self.assertIn("l1_cache_size 1\n", text)
+        self.assertIn("l1_cache_hits_total 1\n", text)
+        self.assertIn("l1_cache_misses_total 1\n", text)
+        self.assertIn("l1_cache_evicted_total 0\n", text)
+
+    def test_pool_exported(self):
+        store_factory = self.get_factory("--pool-max", "2")
+        store = store_factory()
+        store.get("i:1")
+        with store_factory.pool.connection():
+            text = self.metrics_of(store_factory)
+        self.assertIn("store_pool_size 1\n", text)
+        self.assertIn("store_pool_in_use 1\n", text)
+        self.assertIn("store_pool_checkouts_total 2\n", text)
+        self.assertIn("store_pool_timeouts_total 0\n", text)
+
+    def test_run_closes_after_failed_cleanup(self):
+        class FailingSweeper:
+            def start(self):
+                pass
+
+            def close(self):
+                raise RuntimeError("sweeper close failed")
+
+        (opts, _) = api.get_option_parser().parse_args(["--write-behind", "--log-async"])
+        store_factory = api.StoreFactory(opts, MockBatchStore)
+        store_factory().cache_set("uid:1", 1.0, 60)
+        make_server, serve = api.make_server, api.serve
+        api.make_server, api.serve = lambda *args: None, lambda server: None
+        try:
+            self.assertRaises(RuntimeError, api.run, opts, store_factory, FailingSweeper())
+        finally:
+            api.make_server, api.serve = make_server, serve
+        self.assertEqual(store_factory.write_queue.stats()["flushed"], 1)
+
+    def test_breaker_exported(self):
+        (opts, _) = api.get_option_parser().parse_args(["--breaker-threshold", "1", "--breaker-backoff", "60"])
+        store_factory = api.StoreFactory(opts)
+        store_factory()
+        store_factory.breaker.record_failure()
+        store_factory.breaker.allow()
+        text = self.metrics_of(store_factory)
+        store_factory.close()
+        self.assertIn("store_breaker_state 2\n", text)
+        self.assertIn("store_breaker_failures 1\n", text)
+        self.assertIn("store_breaker_rejected_total 1\n", text)
+        self.assertIn("store_breaker_probes_total 0\n", text)
+        self.assertIn("store_breaker_state 0\n", self.metrics_of(self.get_factory()))
+
+    def test_memory_store(self):
+        store_factory = self.get_factory("--store", "memory", "--memory-sweep-interval", "0")
+        self.assertIsInstance(store_factory(), api.MemoryStore)
+        self.assertIs(store_factory(), store_factory())
+        store_factory.close()
+
+
+class TestKeepAlive(unittest.TestCase):
+    def setUp(self):
+        self.server = api.ThreadPoolHTTPServer(("localhost", 0), api.MainHTTPHandler, MockAvailableStore, False,
+                                               keepalive_timeout=5, max_keepalive_requests=3, threads=2)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.port = self.server.server_address[1]
+        self.body = json.dumps({"login": "h&f"})
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def test_connection_reused_up_to_limit(self):
+        connection = http.client.HTTPConnection("localhost", self.port, timeout=5)
+        sockets = []
+        for _ in range(3):
+            connection.request("POST", "/method", self.body)
+            response = connection.getresponse()
+            self.assertEqual(json.loads(response.read())["code"], api.INVALID_REQUEST)
+            sockets.append(connection.sock)
+        self.assertEqual(response.getheader("Connection"), "close")
+        self.assertIs(sockets[0], sockets[1])
+        connection.close()
+
+    def test_pipelined_requests(self):
+        request = (f"POST /method HTTP/1.1\r\nHost: localhost\r\nContent-Length: {len(self.body)}\r\n\r\n"
+                   f"{self.body}").encode("utf8")
+        with socket.create_connection(("localhost", self.port), timeout=5) as sock:
+            sock.sendall(request * 2 + b"POST /method HTTP/1.1\r\nContent-Length: 4\r\n\r\n{bad")
+            data = b""
+            while data.count(b'"code":') < 3:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+        self.assertEqual(data.count(b"HTTP/1.1 422"), 2)
+        self.assertEqual(data.count(b"HTTP/1.1 400"), 1)
+
+    def request(self, connection):
+        connection.request("POST", "/method", self.body)
+        response = connection.getresponse()
+        return json.loads(response.read())["code"]
+
+    def test_idle_connections_do_not_hold_threads(self):
+        idle = [http.client.HTTPConnection("localhost", self.port, timeout=5) for _ in range(2)]
+        for connection in idle:
+            self.assertEqual(self.request(connection), api.INVALID_REQUEST)
+        start = time.monotonic()
+        connection = http.client.HTTPConnection("localhost", self.port, timeout=5)
+        self.assertEqual(self.request(connection), api.INVALID_REQUEST)
+        self.assertLess(time.monotonic() - start, 1)
+        # parked connections are served again
+        self.assertEqual(self.request(idle[0]), api.INVALID_REQUEST)
+        for connection in idle + [connection]:
+            connection.close()
+
+    def test_idle_connection_closed_after_timeout(self):
+        self.server.keepalive_timeout = 0.1
+        with socket.create_connection(("localhost", self.port), timeout=5) as sock:
+            sock.sendall((f"POST /method HTTP/1.1\r\nContent-Length: {len(self.body)}\r\n\r\n"
+                          f"{self.body}").encode("utf8"))
+            data = b""
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+        self.assertEqual(data.count(b"HTTP/1.1 422"), 1)
+
+    def test_no_content_length_closes_connection(self):
+        connection = http.client.HTTPConnection("localhost", self.port, timeout=5)
+        connection.putrequest("POST", "/method")
+        connection.endheaders()
+        response = connection.getresponse()
+        self.assertEqual(response.status, api.BAD_REQUEST)
+        self.assertEqual(response.getheader("Connection"), "close")
+        connection.close()
+
+
+class TestAccessLog(unittest.TestCase):
+    def test_access_line_logged(self):
+        handler = api.MainHTTPHandler.__new__(api.MainHTTPHandler)
+        handler.client_address = ("127.0.0.1", 5000)
+        with self.assertLogs(level="INFO") as logs:
+            handler.log_message('"%s" %s %s', "POST /method HTTP/1.1", "200", "-")
+        self.assertEqual(logs.output, ['INFO:root:127.0.0.1 - "POST /method HTTP/1.1" 200 -'])
+
+
+class TestRequestLogger(unittest.TestCase):
+    body = b'{"login": "h&f", "token": "55cc9ce545bcd144", "method": "online_score"}'
+
+    def get_context(self, code=api.OK):
+        return {"request_id": "42", "has": ["phone"], "response": {"score": 3.0}, "code": code}
+
+    def test_structured_record(self):
+        with self.assertLogs(level="INFO") as log:
+            logs.RequestLogger(structured=True).log("/method", "online_score", b"0123456789", self.get_context(),
+                                                    20, 0.0015)
+        self.assertEqual(len(log.records), 1)
+        self.assertEqual(json.loads(log.records[0].getMessage()), {"request_id": "42", "has": ["phone"],
+                                                                   "code": api.OK, "path": "/method",
+                                                                   "bytes_in": 10, "bytes_out": 20, "ms": 1.5})
+
+    def test_token_redacted(self):
+        with self.assertLogs(level="INFO") as log:
+            logs.RequestLogger().log("/method", "online_score", self.body, self.get_context(), 20, 0.001)
+        self.assertNotIn("55cc9ce545bcd144", log.output[0])
+        self.assertIn('"token": "***"', log.output[0])
+
+    def test_truncated(self):
+        with self.assertLogs(level="INFO") as log:
+            logs.RequestLogger(max_bytes=10).log("/method", "online_score", self.body, self.get_context(), 20, 0.001)
+        self.assertEqual(log.records[0].getMessage(), '/method: {"login": ...(58 bytes) 42')
+
+    @cases([
+        ({"sample_rate": 0}, "online_score", api.OK, False),
+        ({"sample_rate": 0}, "online_score", api.INVALID_REQUEST, True),
+        ({"sample_rate": 0, "method_rates": {"online_score": 1}}, "online_score", api.OK, True),
+        ({"method_rates": {"online_score": 0}}, "clients_interests", api.OK, True),
+        ({"method_rates": {"online_score": 1}, "code_rates": {api.OK: 0}}, "online_score", api.OK, False),
+        ({"sample_rate": 0.5}, "online_score", api.OK, True),
+    ])
+    def test_sampling(self, kwargs, method, code, logged):
+        request_logger = logs.RequestLogger(random=lambda: 0.4, **kwargs)
+        self.assertEqual(request_logger.sampled(method, code), logged)
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def test_counter_sums_threads(self):
+        counter = metrics.Counter("requests_total", "Requests", ("code",), registry=self.registry)
+        threads = [threading.Thread(target=lambda: [counter.inc(200) for _ in range(100)]) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        counter.inc(200)
+        counter.inc(404)
+        self.assertEqual(counter.value(200), 401)
+        # shards of finished threads are folded
+        self.assertEqual(len(counter.shards), 1)
+        self.assertEqual(counter.value(200), 401)
+        self.assertEqual(self.registry.render(), "# HELP requests_total Requests\n# TYPE requests_total counter\n"
+                                                 'requests_total{code="200"} 401\nrequests_total{code="404"} 1\n')
+
+    def test_const_labels(self):
+        counter = metrics.Counter("requests_total", "Requests", ("code",), registry=self.registry)
+        metrics.Gauge("pending", "Pending", lambda: 2, registry=self.registry)
+        counter.inc(200)
+        self.registry.const_labels = (("pid", 42),)
+        self.assertEqual(self.registry.render().splitlines()[2::3],
+                         ['requests_total{code="200",pid="42"} 1', 'pending{pid="42"} 2'])
+
+    def test_histogram(self):
+        histogram = metrics.Histogram("latency_seconds", "Latency", ("op",), buckets=(0.1, 1),
+                                      registry=self.registry)
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.observe(value, "get")
+        self.assertEqual(histogram.count("get"), 4)
+        self.assertEqual(histogram.render(), [
+            'latency_seconds_bucket{op="get",le="0.1"} 2',
+            'latency_seconds_bucket{op="get",le="1"} 3',
+            'latency_seconds_bucket{op="get",le="+Inf"} 4',
+            'latency_seconds_sum{op="get"} 2.65',
+            'latency_seconds_count{op="get"} 4',
+        ])
+
+    def test_histogram_time(self):
+        histogram = metrics.Histogram("latency_seconds", "Latency", ("op",), registry=self.registry)
+        func = histogram.time("get")(lambda: 42)
+        self.assertEqual(func(), 42)
+        self.assertEqual(histogram.count("get"), 1)
+
+    def test_hit_ratio(self):
+        counter = metrics.Counter("cache_total", "Cache", ("result",), registry=self.registry)
+        gauge = metrics.Gauge("cache_hit_ratio", "Ratio", lambda: metrics.hit_ratio(counter), registry=self.registry)
+        self.assertEqual(gauge.render(), ["cache_hit_ratio 0"])
+        for result in ("hit", "hit", "hit", "miss"):
+            counter.inc(result)
+        self.assertEqual(gauge.render(), ["cache_hit_ratio 0.75"])
+
+    def test_method_handler_observed(self):
+        requests = api.metrics.METHOD_REQUESTS
+        before = requests.value("unknown", api.INVALID_REQUEST), requests.value("online_score", api.FORBIDDEN)
+        api.method_handler({"body": {"method": ["x"]}, "headers": {}}, {}, MockAvailableStore())
+        api.method_handler({"body": {"account": "a", "login": "b", "method": "online_score", "token": "",
+                                     "arguments": {}}, "headers": {}}, {}, MockAvailableStore())
+        after = requests.value("unknown", api.INVALID_REQUEST), requests.value("online_score", api.FORBIDDEN)
+        self.assertEqual((after[0] - before[0], after[1] - before[1]), (1, 1))
+
+    def test_counter_func(self):
+        stats = {"checks": 2}
+        metrics.CounterFunc("checks_total", "Checks", lambda: stats["checks"], registry=self.registry)
+        stats["checks"] = 3
+        self.assertEqual(self.registry.render(), "# HELP checks_total Checks\n# TYPE checks_total counter\n"
+                                                 "checks_total 3\n")
+
+    def test_auth_exported(self):
+        request = api.MethodRequest.from_request({"account": "a", "login": "b", "token": "bad"})
+        before = api.authenticator.stats()
+        api.check_auth(request)
+        after = api.authenticator.stats()
+        text = api.metrics.REGISTRY.render()
+        self.assertEqual(after["checks"] - before["checks"], 1)
+        self.assertIn(f"auth_checks_total {after['checks']}\n", text)
+        self.assertIn(f"auth_hashes_total {after['hashes']}\n", text)
+        self.assertIn(f"auth_hashes_saved_total {after['hashes_saved']}\n", text)
+        self.assertIn(f"auth_cached_digests {after['cached_digests']}\n", text)
+
+    def test_score_cache_observed(self):
+        before = scoring.SCORE_CACHE.value("hit"), scoring.SCORE_CACHE.value("miss")
+        scoring.get_score(MockAvailableStore(), "79175002040", "a@b.c")
+        scoring.get_score(MockAvailableStore(3.0), "79175002040", "a@b.c")
+        after = scoring.SCORE_CACHE.value("hit"), scoring.SCORE_CACHE.value("miss")
+        self.assertEqual((after[0] - before[0], after[1] - before[1]), (1, 1))
+
+
+class TestMetricsEndpoint(unittest.TestCase):
+    def setUp(self):
+        self.server = api.ThreadPoolHTTPServer(("localhost", 0), api.MainHTTPHandler, MockAvailableStore, False,
+                                               keepalive_timeout=5, threads=2)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.connection = http.client.HTTPConnection("localhost", self.server.server_address[1], timeout=5)
+
+    def tearDown(self):
+        self.connection.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def test_metrics(self):
+        self.connection.request("POST", "/method", json.dumps({"login": "h&f"}))
+        self.connection.getresponse().read()
+        self.connection.request("GET", "/metrics")
+        response = self.connection.getresponse()
+        text = response.read().decode("utf8")
+        self.assertEqual(response.status, api.OK)
+        self.assertTrue(response.getheader("Content-Type").startswith("text/plain"))
+        self.assertIn("# TYPE method_latency_seconds histogram", text)
+        self.assertIn('method_latency_seconds_count{method="unknown"}', text)
+        self.assertIn('http_responses_total{code="422"}', text)
+
+    def test_unknown_path(self):
+        self.connection.request("GET", "/unknown")
+        response = self.connection.getresponse()
+        self.assertEqual(response.status, api.NOT_FOUND)
+        self.assertEqual(json.loads(response.read())["code"], api.NOT_FOUND)
+
+
+class TestProfiler(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.profiler = profiling.Profiler(self.dir.name, random=lambda: 0.3)
+
+    def tearDown(self):
+        api.profiler = None
+        self.dir.cleanup()
+
+    def get_request(self, login):
+        return api.MethodRequest.from_request({"account": "horns&hoofs", "login": login})
+
+    @cases([
+        ("admin", {profiling.PROFILE_HEADER: "1"}, 0, True),
+        ("h&f", {profiling.PROFILE_HEADER: "1"}, 0, False),
+        ("h&f", {}, 0, False),
+        ("h&f", {}, 3, True),
+        ("h&f", {}, 4, False),
+    ])
+    def test_wanted(self, login, headers, sample_every, wanted):
+        self.profiler.sample_every = sample_every
+        self.assertEqual(self.profiler.wanted(self.get_request(login), headers), wanted)
+
+    def test_stats_written(self):
+        self.assertEqual(self.profiler.run("../42", "online_score", sum, [1, 2]), 3)
+        files = os.listdir(self.dir.name)
+        self.assertEqual(len(files), 1)
+        self.assertTrue(files[0].endswith("-.._42-online_score.prof"))
+
+    def test_one_profile_at_a_time(self):
+        with self.profiler.lock:
+            self.assertEqual(self.profiler.run("42", "online_score", sum, [1, 2]), 3)
+        self.assertEqual(os.listdir(self.dir.name), [])
+        self.assertEqual(self.profiler.busy, 1)
+
+    def test_method_handler_profiled(self):
+        api.profiler = self.profiler
+        token = hashlib.sha512((datetime.datetime.now().strftime("%Y%m%d%H") + api.ADMIN_SALT).encode("utf8"))
+        request = {"account": "horns&hoofs", "login": "admin", "method": "online_score", "token": token.hexdigest(),
+                   "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"}}
+        response, code = api.method_handler({"body": request, "headers": {profiling.PROFILE_HEADER: "1"}},
+                                            {"request_id": "42"}, MockAvailableStore())
+        self.assertEqual((response, code), ({"score": 42}, api.OK))
+        self.assertEqual(self.profiler.profiled, 1)
+        self.assertTrue(os.listdir(self.dir.name)[0].endswith("-42-online_score.prof"))
+
+
+class TestBackgroundLogging(unittest.TestCase):
+    def test_records_written_by_background_thread(self):
+        with self.assertLogs(level="INFO") as log:
+            threads = []
+            capture = logging.getLogger().handlers[-1]
+            emit = capture.emit
+            capture.emit = lambda record: (threads.append(threading.current_thread()), emit(record))
+            with logs.BackgroundLogging(queue_size=10):
+                logging.info("message %s", 1)
+        self.assertEqual(log.output, ["INFO:root:message 1"])
+        self.assertIsNot(threads[0], threading.current_thread())
+
+    def test_drop_over_queue_size(self):
+        handler = logs.DroppingQueueHandler(queue.Queue(1))
+        dropped = logs.LOG_RECORDS_DROPPED.value()
+        for i in range(3):
+            handler.emit(logging.makeLogRecord({"msg": "message"}))
+        self.assertEqual(handler.dropped, 2)
+        self.assertEqual(logs.LOG_RECORDS_DROPPED.value() - dropped, 2)
+
 
 if __name__ == "__main__":
     unittest.main()